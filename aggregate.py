@@ -0,0 +1,184 @@
+# Streaming aggregation of metrics for the Solax PV monitoring client.
+#
+# Sits between the snapshots the client compiles per cycle and publishing them. For every metric
+# it keeps tumbling windows of configurable lengths (e.g. 1m, 15m, 1h) with min, max, mean and last
+# value and, for power metrics, the energy over the window integrated with the trapezoid rule.
+# When a window is over, its rollup gets handed back for publishing, so fast polling (e.g. with a
+# local source) doesn't have to push every raw sample into InfluxDB.
+#
+# Memory use is constant per metric: the accumulators of each window length are arrays with one
+# slot per metric, and the means of the last 'history' windows are kept in ring buffers.
+
+from array import array
+from math import floor, isnan, nan
+
+# Units of window lengths, e.g. "15m"
+PERIOD_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+# Convert a window length like "15m" or "1h" into seconds
+def parse_period(period):
+    return int(period[:-1]) * PERIOD_UNITS[period[-1]]
+
+
+# Accumulators for the current window of one window length, with one array slot per metric
+class Rollup:
+    def __init__(self, label, history):
+        self.label = label
+        self.period = parse_period(label)
+        self.start = None
+        self.min = array('d')
+        self.max = array('d')
+        self.sum = array('d')
+        self.count = array('L')
+        self.last = array('d')
+        self.energy = array('d')
+
+        # Ring buffers with the means of the last 'history' windows per metric
+        self.history = history
+        self.ring = []
+        self.ring_pos = 0
+
+    def grow(self):
+        self.min.append(nan)
+        self.max.append(nan)
+        self.sum.append(0.0)
+        self.count.append(0)
+        self.last.append(nan)
+        self.energy.append(0.0)
+        self.ring.append(array('d', [nan] * self.history))
+
+    def reset(self, start):
+        n = len(self.count)
+        self.start = start
+        self.min = array('d', [nan] * n)
+        self.max = array('d', [nan] * n)
+        self.sum = array('d', [0.0] * n)
+        self.count = array('L', [0] * n)
+        self.last = array('d', [nan] * n)
+        self.energy = array('d', [0.0] * n)
+
+
+# Trapezoid rule: energy in Wh for power going from v0 W at t0 to v1 W at t1 (seconds)
+def trapezoid(t0, v0, t1, v1):
+    return (v0 + v1) / 2.0 * (t1 - t0) / 3600.0
+
+
+# Linear interpolation of the value at time t between two samples
+def interpolate(t0, v0, t1, v1, t):
+    return v0 + (v1 - v0) * (t - t0) / (t1 - t0)
+
+
+class Aggregator:
+    def __init__(self, periods, energy_metrics=(), history=60, max_gap=None):
+        # Params:
+        #   :periods:           window lengths to aggregate, e.g. ["1m", "15m", "1h"]
+        #   :energy_metrics:    names of the (power) metrics to integrate into energy
+        #   :history:           number of past window means to keep per metric and window length
+        #   :max_gap:           don't integrate energy between samples further apart than this
+        #                       many seconds (e.g. because the client was down)
+        self.rollups = [Rollup(p, history) for p in periods]
+        self.energy_metrics = set(energy_metrics)
+        self.max_gap = max_gap
+
+        # Metrics are identified by their name and tags. Each gets a slot in the arrays
+        self.index = {}
+        self.keys = []
+        self.is_energy = array('b')
+        self.prev_t = array('d')
+        self.prev_v = array('d')
+
+    def _slot(self, name, tags):
+        key = (name, tuple(sorted(tags.items())) if tags else ())
+        i = self.index.get(key)
+        if i is None:
+            i = self.index[key] = len(self.keys)
+            self.keys.append(key)
+            self.is_energy.append(name in self.energy_metrics)
+            self.prev_t.append(nan)
+            self.prev_v.append(nan)
+            for r in self.rollups:
+                r.grow()
+        return i
+
+    # Add the samples of a snapshot taken at time ts (seconds since the epoch)
+    #
+    # Params:
+    #   :ts:        time of the snapshot
+    #   :samples:   list of (<metric name>, <tags dict or None>, <value>)
+    #
+    # Returns the rollups of all windows that ended with this snapshot as a list of
+    #     (<window label>, <window start>, [ (<tags dict>, <fields dict>), ... ])
+    def add(self, ts, samples):
+        slots = [(self._slot(name, tags), float(v)) for name, tags, v in samples if v is not None]
+        done = []
+
+        for r in self.rollups:
+            if r.start is None:
+                r.reset(floor(ts / r.period) * r.period)
+
+            end = r.start + r.period
+            if ts >= end:
+                # The window is over. Integrate power up to the window boundary, then hand it out
+                for i, v in slots:
+                    if self._integrate(i, ts):
+                        t0, v0 = self.prev_t[i], self.prev_v[i]
+                        if t0 < end:
+                            r.energy[i] += trapezoid(t0, v0, end, interpolate(t0, v0, ts, v, end))
+                done.append((r.label, r.start, self._close(r)))
+                r.reset(floor(ts / r.period) * r.period)
+
+            for i, v in slots:
+                if self._integrate(i, ts):
+                    t0, v0 = self.prev_t[i], self.prev_v[i]
+                    if t0 < r.start:
+                        t0, v0 = r.start, interpolate(t0, v0, ts, v, r.start)
+                    r.energy[i] += trapezoid(t0, v0, ts, v)
+                if r.count[i] == 0:
+                    r.min[i] = r.max[i] = v
+                else:
+                    r.min[i] = min(r.min[i], v)
+                    r.max[i] = max(r.max[i], v)
+                r.sum[i] += v
+                r.count[i] += 1
+                r.last[i] = v
+
+        for i, v in slots:
+            self.prev_t[i] = ts
+            self.prev_v[i] = v
+
+        return done
+
+    # Whether to integrate energy for metric i between its previous sample and ts
+    def _integrate(self, i, ts):
+        if not self.is_energy[i] or isnan(self.prev_t[i]) or ts <= self.prev_t[i]:
+            return False
+        return self.max_gap is None or ts - self.prev_t[i] <= self.max_gap
+
+    # Build the fields of a finished window, grouped by tags, and remember the window means
+    def _close(self, r):
+        series = {}
+        for i, (name, tags) in enumerate(self.keys):
+            mean = r.sum[i] / r.count[i] if r.count[i] else nan
+            r.ring[i][r.ring_pos] = mean
+            if not r.count[i]:
+                continue
+            fields = series.setdefault(tags, {})
+            fields[name + '_min'] = r.min[i]
+            fields[name + '_max'] = r.max[i]
+            fields[name + '_mean'] = mean
+            fields[name + '_last'] = r.last[i]
+            if self.is_energy[i]:
+                fields[name + '_wh'] = r.energy[i]
+        r.ring_pos = (r.ring_pos + 1) % r.history
+        return [(dict(tags), fields) for tags, fields in series.items()]
+
+    # The means of the last windows of the given length for a metric, oldest first
+    def history(self, label, name, tags=None):
+        i = self.index.get((name, tuple(sorted(tags.items())) if tags else ()))
+        for r in self.rollups:
+            if r.label == label and i is not None:
+                ring = r.ring[i]
+                values = list(ring[r.ring_pos:]) + list(ring[:r.ring_pos])
+                return [v for v in values if not isnan(v)]
+        return []
@@ -0,0 +1,471 @@
+# Local time series archive of the Solax PV monitoring client.
+#
+# All history used to live in InfluxDB only. Queries over years of data are slow there, and if its
+# volume is lost the data is gone. The client also appends every snapshot to an archive of its own:
+#     <dir>/<YYYY-MM-DD>.seg    blocks of snapshots of a (UTC) day, compressed column by column
+#     <dir>/<YYYY-MM-DD>.idx    time index of the blocks, (<first ts>, <last ts>, <offset>, <length>)
+#     <dir>/tail.jsonl          the snapshots not yet in a block, one JSON line each
+# Timestamps get delta-of-delta encoded and values XOR encoded against the previous value of their
+# column (as in Facebook's Gorilla), so steady values take a bit or two per snapshot. Columns are
+# the metrics of the snapshot and the power of the mapped inverter lines (see line_column()). A
+# block also stores count, sum, min and max of each column, so aggregates over buckets spanning
+# whole blocks don't need to decode them.
+#
+# A block gets written when it has 'block_rows' snapshots or the day is over, fsync'ed, and then
+# indexed. Snapshots wait in the tail file until then, which is read back after a restart. Readers
+# (e.g. utils/archive_tool.py next to the running client) map the segments with mmap and only
+# decode the blocks and columns a query needs.
+
+from array import array
+from datetime import datetime, timezone
+from json import dumps as json_dumps, loads as json_loads
+from math import floor, inf, nan
+from mmap import mmap, ACCESS_READ
+from os import fsync, listdir, makedirs, replace
+from os.path import isdir, join
+from struct import Struct
+
+MAGIC = b'SXA1'
+
+# Block: header, column directory (each entry followed by the column name), timestamps, columns
+BLOCK_HEAD = Struct('<4sHII')        # magic, columns, rows, bytes of timestamps
+COLUMN_HEAD = Struct('<HIIddd')      # bytes of name, bytes of data, count, sum, min, max
+INDEX_ENTRY = Struct('<ddQI')        # first ts, last ts, offset, length
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+TAIL_FILE = 'tail.jsonl'
+
+AGGREGATES = ('sum', 'mean', 'min', 'max', 'count')
+
+# Separates the metric name, inverter serial number and line in the column of an inverter line
+LINE_SEP = '/'
+
+MASK64 = (1 << 64) - 1
+
+
+# Column of the power of an inverter line, e.g. 'south/SYLASDWFG/powerdc1'
+def line_column(name, sn, line):
+    return f"{name}{LINE_SEP}{sn}{LINE_SEP}{line}"
+
+
+# The metric name of a column and the tags of its inverter line, None for site wide metrics
+def split_column(column):
+    parts = column.rsplit(LINE_SEP, 2)
+    if len(parts) < 3:
+        return column, None
+    return parts[0], {'sn': parts[1], 'line': parts[2]}
+
+
+# ---- Bit streams
+
+class BitWriter:
+    def __init__(self):
+        self.buf = bytearray()
+        self.acc = 0
+        self.n = 0
+
+    def write(self, value, bits):
+        self.acc = (self.acc << bits) | value
+        self.n += bits
+        while self.n >= 8:
+            self.n -= 8
+            self.buf.append((self.acc >> self.n) & 0xff)
+        self.acc &= (1 << self.n) - 1
+
+    def getvalue(self):
+        if self.n:
+            return bytes(self.buf) + bytes(((self.acc << (8 - self.n)) & 0xff,))
+        return bytes(self.buf)
+
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.acc = 0
+        self.n = 0
+
+    def read(self, bits):
+        if self.n < bits:
+            k = (bits - self.n + 7) >> 3
+            self.acc = (self.acc << (k * 8)) | int.from_bytes(self.data[self.pos:self.pos + k], 'big')
+            self.pos += k
+            self.n += k * 8
+        self.n -= bits
+        v = self.acc >> self.n
+        self.acc &= (1 << self.n) - 1
+        return v
+
+
+# ---- Column encodings
+
+# Timestamps in ms as delta of deltas. Snapshots come at a steady interval, so mostly 1 bit each
+def encode_times(times):
+    w = BitWriter()
+    w.write(times[0] & MASK64, 64)
+    prev, delta = times[0], 0
+    for t in times[1:]:
+        d = t - prev
+        dod = d - delta
+        if dod == 0:
+            w.write(0, 1)
+        elif -63 <= dod <= 64:
+            w.write(0b10, 2)
+            w.write(dod + 63, 7)
+        elif -255 <= dod <= 256:
+            w.write(0b110, 3)
+            w.write(dod + 255, 9)
+        elif -2047 <= dod <= 2048:
+            w.write(0b1110, 4)
+            w.write(dod + 2047, 12)
+        else:
+            w.write(0b1111, 4)
+            w.write(dod & MASK64, 64)
+        prev, delta = t, d
+    return w.getvalue()
+
+
+def decode_times(data, n):
+    r = BitReader(data)
+    prev = r.read(64)
+    times = array('q', [prev])
+    delta = 0
+    for _ in range(n - 1):
+        if not r.read(1):
+            dod = 0
+        elif not r.read(1):
+            dod = r.read(7) - 63
+        elif not r.read(1):
+            dod = r.read(9) - 255
+        elif not r.read(1):
+            dod = r.read(12) - 2047
+        else:
+            dod = r.read(64)
+            if dod >> 63:
+                dod -= 1 << 64
+        delta += dod
+        prev += delta
+        times.append(prev)
+    return times
+
+
+# Floats XOR'ed with their predecessor. An unchanged value takes 1 bit, otherwise the meaningful
+# bits of the XOR get stored, reusing the previous window of leading and trailing zeros if they fit
+def encode_floats(values):
+    bits = array('Q', array('d', values).tobytes())
+    w = BitWriter()
+    prev = bits[0]
+    w.write(prev, 64)
+    lead, trail = 65, 0
+    for x in bits[1:]:
+        xor = x ^ prev
+        prev = x
+        if xor == 0:
+            w.write(0, 1)
+            continue
+        lz = 64 - xor.bit_length()
+        tz = (xor & -xor).bit_length() - 1
+        if lz >= lead and tz >= trail:
+            w.write(0b10, 2)
+            w.write(xor >> trail, 64 - lead - trail)
+        else:
+            lead, trail = min(lz, 31), tz
+            n = 64 - lead - trail
+            w.write(0b11, 2)
+            w.write(lead, 5)
+            w.write(n - 1, 6)
+            w.write(xor >> trail, n)
+    return w.getvalue()
+
+
+def decode_floats(data, n):
+    r = BitReader(data)
+    prev = r.read(64)
+    bits = array('Q', [prev]) * n
+    lead = trail = 0
+    for i in range(1, n):
+        if r.read(1):
+            if r.read(1):
+                lead = r.read(5)
+                trail = 64 - lead - r.read(6) - 1
+            prev ^= r.read(64 - lead - trail) << trail
+        bits[i] = prev
+    return array('d', bits.tobytes())
+
+
+# ---- Blocks
+
+# Encode the snapshots given as timestamps (ms) and columns of values (NaN where missing)
+def encode_block(times, columns):
+    ts_data = encode_times(times)
+    head = [BLOCK_HEAD.pack(MAGIC, len(columns), len(times), len(ts_data))]
+    datas = []
+    for name, values in columns.items():
+        data = encode_floats(values)
+        present = [v for v in values if v == v]
+        b = name.encode()
+        head.append(COLUMN_HEAD.pack(len(b), len(data), len(present), sum(present),
+                                     min(present, default=nan), max(present, default=nan)) + b)
+        datas.append(data)
+    return b''.join(head) + ts_data + b''.join(datas)
+
+
+# The parts of an encoded block in buf. Returns (<rows>, <timestamps data>, <columns>) with
+# columns as {<name>: (<data>, <count>, <sum>, <min>, <max>)}
+def parse_block(buf):
+    magic, n_cols, n_rows, ts_len = BLOCK_HEAD.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Not an archive block")
+    pos = BLOCK_HEAD.size
+    heads = []
+    for _ in range(n_cols):
+        name_len, data_len, count, s, lo, hi = COLUMN_HEAD.unpack_from(buf, pos)
+        pos += COLUMN_HEAD.size
+        heads.append((bytes(buf[pos:pos + name_len]).decode(), data_len, count, s, lo, hi))
+        pos += name_len
+    ts_data = buf[pos:pos + ts_len]
+    pos += ts_len
+    columns = {}
+    for name, data_len, count, s, lo, hi in heads:
+        columns[name] = (buf[pos:pos + data_len], count, s, lo, hi)
+        pos += data_len
+    return n_rows, ts_data, columns
+
+
+def day_of(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d')
+
+
+class Archive:
+    def __init__(self, path, block_rows=360, readonly=False):
+        # Params:
+        #   :path:          directory of the archive
+        #   :block_rows:    snapshots per block. More compress better, but wait longer in the tail
+        #   :readonly:      only read the archive, e.g. while the client writes it
+        self.path = path
+        self.block_rows = block_rows
+        self.readonly = readonly
+
+        # Snapshots not in a block yet, as timestamps in ms and dicts of column to value
+        self.times = []
+        self.rows = []
+        # Mapped segments as day -> mmap
+        self.maps = {}
+        self.last = -inf
+
+        if not readonly:
+            makedirs(path, exist_ok=True)
+        days = self.days()
+        if days:
+            index = self.index(days[-1])
+            if index:
+                self.last = round(index[-1][1] * 1000)
+        self._load_tail()
+
+        self.tail = None
+        if not readonly:
+            # Write the tail back without a torn last line before appending to it
+            tmp = join(path, TAIL_FILE + '.tmp')
+            with open(tmp, 'w') as f:
+                for t, row in zip(self.times, self.rows):
+                    f.write(json_dumps([t, row], separators=(',', ':')) + '\n')
+                f.flush()
+                fsync(f.fileno())
+            replace(tmp, join(path, TAIL_FILE))
+            self.tail = open(join(path, TAIL_FILE), 'a')
+
+    def _load_tail(self):
+        try:
+            with open(join(self.path, TAIL_FILE)) as f:
+                for line in f:
+                    try:
+                        t, row = json_loads(line)
+                    except ValueError:
+                        break
+                    # Rows of a block that got written just before the tail could be cleared
+                    if t > self.last and (not self.times or t > self.times[-1]):
+                        self.times.append(t)
+                        self.rows.append(row)
+        except FileNotFoundError:
+            pass
+
+    # Add a snapshot. Snapshots not newer than the last one are ignored
+    #
+    # Params:
+    #   :ts:        time of the snapshot in seconds since the epoch
+    #   :fields:    dict of column name to value
+    def append(self, ts, fields):
+        t = round(ts * 1000)
+        if t <= self.last or (self.times and t <= self.times[-1]):
+            return
+        if self.times and (len(self.times) >= self.block_rows or day_of(t / 1000) != day_of(self.times[0] / 1000)):
+            self.seal()
+        row = {k: float(v) for k, v in fields.items() if v is not None}
+        self.times.append(t)
+        self.rows.append(row)
+        self.tail.write(json_dumps([t, row], separators=(',', ':')) + '\n')
+        self.tail.flush()
+
+    # Write the snapshots of the tail as a block to the segment of their day
+    def seal(self):
+        if not self.times:
+            return
+        names = sorted(set().union(*self.rows))
+        columns = {k: [row.get(k, nan) for row in self.rows] for k in names}
+        data = encode_block(self.times, columns)
+        day = day_of(self.times[0] / 1000)
+
+        with open(join(self.path, day + SEGMENT_SUFFIX), 'ab') as f:
+            offset = f.seek(0, 2)
+            f.write(data)
+            f.flush()
+            fsync(f.fileno())
+        with open(join(self.path, day + INDEX_SUFFIX), 'ab') as f:
+            # Drop a torn entry of a crash, it points at a block that didn't make it
+            size = f.seek(0, 2)
+            if size % INDEX_ENTRY.size:
+                f.truncate(size - size % INDEX_ENTRY.size)
+            f.write(INDEX_ENTRY.pack(self.times[0] / 1000, self.times[-1] / 1000, offset, len(data)))
+            f.flush()
+            fsync(f.fileno())
+
+        self.last = self.times[-1]
+        self.times, self.rows = [], []
+        self.tail.seek(0)
+        self.tail.truncate()
+
+    # The days with segments, oldest first
+    def days(self):
+        if not isdir(self.path):
+            return []
+        return sorted(f[:-len(SEGMENT_SUFFIX)] for f in listdir(self.path) if f.endswith(SEGMENT_SUFFIX))
+
+    # The index of a day as list of (<first ts>, <last ts>, <offset>, <length>)
+    def index(self, day):
+        try:
+            with open(join(self.path, day + INDEX_SUFFIX), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        return [INDEX_ENTRY.unpack_from(data, i) for i in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+
+    # The segment of a day mapped into memory, covering at least 'size' bytes. Segments grow while
+    # the day is on, so the mapping gets renewed when blocks were added
+    def _segment(self, day, size):
+        # Replaced mappings get closed once the blocks read from them are gone
+        m = self.maps.get(day)
+        if m is None or len(m) < size:
+            with open(join(self.path, day + SEGMENT_SUFFIX), 'rb') as f:
+                m = self.maps[day] = mmap(f.fileno(), 0, access=ACCESS_READ)
+        return m
+
+    # The blocks overlapping [start, end) as (<first ts>, <last ts>, <parsed block>)
+    def blocks(self, start=-inf, end=inf):
+        first_day = day_of(start) if start > -inf else ''
+        last_day = day_of(end) if end < inf else '9999'
+        for day in self.days():
+            if not first_day <= day <= last_day:
+                continue
+            for first, last, offset, length in self.index(day):
+                if last < start or first >= end:
+                    continue
+                m = self._segment(day, offset + length)
+                yield first, last, parse_block(memoryview(m)[offset:offset + length])
+
+    # The column names in [start, end)
+    def columns(self, start=-inf, end=inf):
+        names = set()
+        for _, _, (_, _, columns) in self.blocks(start, end):
+            names.update(columns)
+        for t, row in zip(self.times, self.rows):
+            if start * 1000 <= t < end * 1000:
+                names.update(row)
+        return sorted(names)
+
+    # The snapshots in [start, end), block by block, as (<timestamps>, {<column>: <values>}).
+    # Timestamps are in seconds since the epoch, missing values NaN. Only the given columns get
+    # decoded, all if 'fields' is None
+    def read(self, start=-inf, end=inf, fields=None):
+        wanted = set(fields) if fields is not None else None
+        for _, _, (n, ts_data, columns) in self.blocks(start, end):
+            times = [t / 1000 for t in decode_times(ts_data, n)]
+            values = {name: decode_floats(c[0], n) for name, c in columns.items()
+                      if wanted is None or name in wanted}
+            keep = [i for i, t in enumerate(times) if start <= t < end]
+            if len(keep) < n:
+                times = [times[i] for i in keep]
+                values = {name: array('d', [v[i] for i in keep]) for name, v in values.items()}
+            if times:
+                yield times, values
+
+        keep = [i for i, t in enumerate(self.times) if start * 1000 <= t < end * 1000]
+        if keep:
+            names = set().union(*(self.rows[i] for i in keep))
+            if wanted is not None:
+                names &= wanted
+            yield ([self.times[i] / 1000 for i in keep],
+                   {name: array('d', [self.rows[i].get(name, nan) for i in keep]) for name in sorted(names)})
+
+    # Aggregate the snapshots in [start, end) over buckets of 'bucket' seconds, starting at 'origin'
+    # (seconds since the epoch) plus a multiple of 'bucket'. Blocks within a single bucket are taken
+    # from their stored aggregates without being decoded.
+    #
+    # Returns [(<bucket start>, {<column>: <value>}), ...] for the buckets with data, with 'agg' one
+    # of AGGREGATES
+    def aggregate(self, start, end, bucket, agg='mean', fields=None, origin=0.0):
+        if agg not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate '{agg}', use one of {', '.join(AGGREGATES)}")
+        wanted = set(fields) if fields is not None else None
+        buckets = {}
+
+        def add(b, name, count, s, lo, hi):
+            acc = buckets.setdefault(b, {}).get(name)
+            if acc is None:
+                buckets[b][name] = [count, s, lo, hi]
+            else:
+                acc[0] += count
+                acc[1] += s
+                acc[2] = min(acc[2], lo)
+                acc[3] = max(acc[3], hi)
+
+        pending = []
+        for first, last, block in self.blocks(start, end):
+            b = floor((first - origin) / bucket)
+            if start <= first and last < end and b == floor((last - origin) / bucket):
+                for name, (_, count, s, lo, hi) in block[2].items():
+                    if count and (wanted is None or name in wanted):
+                        add(b, name, count, s, lo, hi)
+            else:
+                pending.append(block)
+
+        # Blocks crossing bucket or range boundaries, and the tail, go value by value
+        def rows():
+            for n, ts_data, columns in pending:
+                times = decode_times(ts_data, n)
+                for name, c in columns.items():
+                    if wanted is None or name in wanted:
+                        yield [t / 1000 for t in times], name, decode_floats(c[0], n)
+            for i, t in enumerate(self.times):
+                for name, v in self.rows[i].items():
+                    if wanted is None or name in wanted:
+                        yield [t / 1000], name, [v]
+
+        for times, name, values in rows():
+            for t, v in zip(times, values):
+                if start <= t < end and v == v:
+                    add(floor((t - origin) / bucket), name, 1, v, v, v)
+
+        result = []
+        for b in sorted(buckets):
+            values = {}
+            for name, (count, s, lo, hi) in sorted(buckets[b].items()):
+                values[name] = {'sum': s, 'mean': s / count, 'min': lo, 'max': hi, 'count': count}[agg]
+            result.append((origin + b * bucket, values))
+        return result
+
+    def close(self):
+        if self.tail is not None:
+            self.tail.close()
+            self.tail = None
+        self.maps = {}
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Benchmark of the local archive of the client (archive.py).
+#
+# Writes --days of simulated snapshots, one every --interval seconds, with the metrics of the
+# client and two inverter lines into an archive in a temporary directory and reports
+#   - the bytes per snapshot on disk, against the JSON lines the tail holds them as
+#   - the time per snapshot for appending (including the compression of the blocks)
+#   - the time of aggregate queries over the whole range with daily buckets, which mostly use the
+#     stored block aggregates, and hourly buckets, which need to decode the blocks
+#   - the time to read all snapshots back
+#
+# Run from the repository root with
+#     python3 bench/bench_archive.py [--days 30] [--interval 60]
+
+from argparse import ArgumentParser
+from json import dumps as json_dumps
+from math import pi, sin
+from os import listdir
+from os.path import dirname, abspath, getsize, join
+from random import gauss, seed
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from archive import Archive, line_column
+
+START = 1704067200.0    # 2024-01-01 00:00 UTC
+
+
+# Snapshot at ts, shaped like the archive fields of the client (see Solax.archive_fields())
+def snapshot(ts, i, interval):
+    hours = (ts % 86400) / 3600
+    pv = max(0.0, 8000.0 * sin(pi * (hours - 6) / 12)) if 6 <= hours <= 18 else 0.0
+    pv = round(max(0.0, pv + gauss(0, 50) * (pv > 0)))
+    load = round(600 + gauss(0, 30))
+    return {
+        'sol_pwr': float(pv), 'yield_total': round(5000 + i * 0.01, 1), 'yield_today': round(hours * 2, 1),
+        'to_grid': float(pv - load), 'to_grid_today': round(hours, 1), 'to_grid_total': round(2000 + i * 0.004, 1),
+        'from_grid': round(900 + i * 0.002, 1), 'bat_soc': float(round(50 + 30 * sin(i / 500))),
+        'ac_power': float(pv), 'to_bat': 0.0, 'to_house': float(load), 'to_wallbox': 0.0, 'interval': float(interval),
+        line_column('south', 'SYBENCH001', 'powerdc1'): round(pv * 0.6),
+        line_column('north', 'SYBENCH001', 'powerdc2'): round(pv * 0.4),
+    }
+
+
+def timed(f):
+    start = perf_counter()
+    result = f()
+    return perf_counter() - start, result
+
+
+def get_args():
+    parser = ArgumentParser(description="Benchmark the local archive of the Solax client.")
+    parser.add_argument("-d", "--days", help="Days of snapshots to write.", type=float, default=30)
+    parser.add_argument("-i", "--interval", help="Seconds between snapshots.", type=float, default=60)
+    parser.add_argument("-b", "--block-rows", help="Snapshots per block.", type=int, default=360)
+    return parser.parse_args()
+
+
+def run():
+    args = get_args()
+    seed(1)
+    n = int(args.days * 86400 / args.interval)
+    snapshots = [(START + i * args.interval, snapshot(START + i * args.interval, i, args.interval)) for i in range(n)]
+    json_bytes = sum(len(json_dumps([round(ts * 1000), s], separators=(',', ':'))) + 1 for ts, s in snapshots)
+
+    with TemporaryDirectory() as path:
+        archive = Archive(path, block_rows=args.block_rows)
+
+        def write():
+            for ts, s in snapshots:
+                archive.append(ts, s)
+            archive.seal()
+
+        t_write, _ = timed(write)
+        archive.close()
+        disk = sum(getsize(join(path, f)) for f in listdir(path))
+
+        reader = Archive(path, readonly=True)
+        end = START + n * args.interval
+        t_daily, daily = timed(lambda: reader.aggregate(START, end, 86400, 'mean', ['sol_pwr']))
+        t_hourly, hourly = timed(lambda: reader.aggregate(START, end, 3600, 'mean', ['sol_pwr']))
+        t_read, rows = timed(lambda: sum(len(t) for t, _ in reader.read(START, end)))
+        reader.close()
+
+    print(f"{n} snapshots over {args.days:g} days, {len(snapshots[0][1])} columns, {args.block_rows} per block")
+    print(f"size          {disk / n:8.1f} bytes per snapshot   (JSON lines {json_bytes / n:.1f}, "
+          f"{json_bytes / disk:.1f}x)")
+    print(f"append        {t_write / n * 1e6:8.1f} us per snapshot")
+    print(f"daily mean    {t_daily * 1000:8.1f} ms   ({len(daily)} buckets)")
+    print(f"hourly mean   {t_hourly * 1000:8.1f} ms   ({len(hourly)} buckets)")
+    print(f"read all      {t_read * 1000:8.1f} ms   ({rows} snapshots)")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Benchmark of the PV forecast of the client (forecast.py).
+#
+# Simulates --years of snapshots, one every --interval seconds, of a site with --lines inverter
+# lines of different orientation under weather that changes slowly (clear and cloudy spells) and
+# reports
+#   - the time to train a model on all of it with fit(), as when the client starts from the archive
+#   - the time per snapshot for adding a day of snapshots one by one, as the client does, and per
+#     forecast for predict()
+#   - the mean absolute error of the forecast of the site power per horizon over the last --test-days,
+#     against smart persistence (the current clear-sky index carried forward)
+#
+# Run from the repository root with
+#     python3 bench/bench_forecast.py [--years 3] [--interval 60]
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from os.path import dirname, abspath
+from time import perf_counter
+from zoneinfo import ZoneInfo
+import sys
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from forecast import Forecaster, clear_sky
+
+START = datetime(2021, 1, 1, tzinfo=timezone.utc).timestamp()
+LAT, LON = 52.52, 13.40
+TZ = ZoneInfo('Europe/Berlin')
+
+
+# Snapshots of the site at 'times': 'sol_pwr' and the power of each line. Clear-sky index of an
+# AR(1) process of about an hour, the lines face east to west with a shading dip
+def history(times, lines, rng):
+    cs = clear_sky(times, LAT, LON)
+    steps = len(times)
+    kc = np.empty(steps)
+    k = 0.7
+    noise = rng.normal(0.0, 0.03, steps)
+    for i in range(steps):
+        k = 0.98 * k + 0.02 * 0.7 + noise[i]
+        kc[i] = k
+    kc = np.clip(kc, 0.05, 1.2)
+    hours = (times % 86400) / 3600.0
+    values = {}
+    for j in range(lines):
+        shift = (j - (lines - 1) / 2) * 2.0
+        tilt = np.clip(np.cos((hours - 12.0 - shift) / 7.0), 0.2, None)
+        shade = 1.0 - 0.5 * np.exp(-((hours - 9.0 - j) / 0.5) ** 2)
+        values[f'line{j + 1}'] = cs * kc * tilt * shade * 4.0
+    values['sol_pwr'] = sum(values.values())
+    return values
+
+
+def timed(f):
+    start = perf_counter()
+    result = f()
+    return perf_counter() - start, result
+
+
+def get_args():
+    parser = ArgumentParser(description="Benchmark the PV forecast of the Solax client.")
+    parser.add_argument("-y", "--years", help="Years of history to simulate.", type=float, default=3)
+    parser.add_argument("-i", "--interval", help="Seconds between snapshots.", type=float, default=60)
+    parser.add_argument("-l", "--lines", help="Inverter lines of the site.", type=int, default=4)
+    parser.add_argument("-s", "--step", help="Forecast step in seconds.", type=int, default=900)
+    parser.add_argument("--horizon", help="Forecast horizon in seconds.", type=int, default=21600)
+    parser.add_argument("--test-days", help="Days at the end to measure the forecast error on.", type=int,
+                        default=30)
+    return parser.parse_args()
+
+
+def run():
+    args = get_args()
+    rng = np.random.default_rng(1)
+    n = int(args.years * 365 * 86400 / args.interval)
+    times = START + np.arange(n) * args.interval
+    values = history(times, args.lines, rng)
+    test = int(args.test_days * 86400 / args.interval)
+
+    # Training on everything but the test days
+    model = Forecaster(LAT, LON, TZ, step=args.step, horizon=args.horizon)
+    t_fit, _ = timed(lambda: model.fit(times[:-test], {k: v[:-test] for k, v in values.items()}))
+
+    # Adding the test days snapshot by snapshot, forecasting after every step
+    step_mean = {}
+    forecasts = []
+    t_add = t_predict = 0.0
+    names = list(values)
+    for i in range(n - test, n):
+        snapshot = {k: float(values[k][i]) for k in names}
+        start = perf_counter()
+        ready = model.add(times[i], snapshot)
+        t_add += perf_counter() - start
+        if ready:
+            t, forecast = timed(model.predict)
+            t_predict += t
+            forecasts.append((model.last_step, forecast[1][:, model.names.index('sol_pwr')]))
+
+    # Actual mean power per step of the test days, to score against
+    steps = (times[n - test:] // args.step) * args.step
+    for s in np.unique(steps):
+        step_mean[s] = values['sol_pwr'][n - test:][steps == s].mean()
+
+    horizons = model.horizons
+    err_model = np.zeros(horizons)
+    err_persist = np.zeros(horizons)
+    count = np.zeros(horizons)
+    for last, power in forecasts:
+        if last not in step_mean:
+            continue
+        cs_last = float(clear_sky(last + args.step / 2, LAT, LON))
+        kc_last = step_mean[last] / cs_last if cs_last > 20.0 else None
+        for h in range(horizons):
+            t = last + (h + 1) * args.step
+            if t not in step_mean:
+                continue
+            cs = float(clear_sky(t + args.step / 2, LAT, LON))
+            if cs <= 20.0 or kc_last is None:
+                continue
+            err_model[h] += abs(power[h] - step_mean[t])
+            err_persist[h] += abs(kc_last * cs - step_mean[t])
+            count[h] += 1
+
+    print(f"{n} snapshots over {args.years:g} years, {args.lines} lines, step {args.step} s, "
+          f"{horizons} steps ahead")
+    print(f"fit           {t_fit:8.2f} s    ({(n - test) / t_fit / 1e6:.1f} M snapshots/s)")
+    print(f"add           {t_add / test * 1e6:8.1f} us per snapshot (including the step updates)")
+    print(f"predict       {t_predict / max(1, len(forecasts)) * 1e3:8.2f} ms per forecast")
+    print("horizon    MAE forecast (W)   MAE smart persistence (W)")
+    for h in range(horizons):
+        if count[h]:
+            print(f"{(h + 1) * args.step / 60:5.0f} min  {err_model[h] / count[h]:14.0f}   "
+                  f"{err_persist[h] / count[h]:14.0f}")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Benchmark of the Solax API client with and without connection pooling.
+#
+# Starts a local stub HTTP server that answers like the Solax 'getRealtimeInfo.do' endpoint and
+# then measures the per-request latency of
+#   - a bare requests.get() per query, i.e. a new connection for every request (how the client
+#     used to query the API), and
+#   - the pooled SolaxApi client from client.py which keeps its connections alive.
+#
+# The stub server can add an artificial delay to every new connection to simulate the cost of the
+# TCP/TLS handshake with the Solax cloud (which is a lot more expensive than a local connect).
+#
+# Run from the repository root with
+#     python3 bench/bench_http.py [-n 200] [--connect-delay 0.05]
+
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from json import dumps as json_dumps
+from os.path import dirname, abspath
+from statistics import mean, median, quantiles
+from threading import Thread
+from time import perf_counter, sleep
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from requests import get as req_get
+from client import SolaxApi
+
+# Payload returned for every query. Matches the structure of a Solax API realtime response
+RESPONSE = json_dumps({
+    'success': True,
+    'exception': 'Query success!',
+    'result': {
+        'inverterSN': 'SYBENCH001', 'sn': 'SWBENCH001', 'acpower': 1200.0, 'yieldtoday': 10.5,
+        'yieldtotal': 5000.0, 'feedinpower': 300.0, 'feedinenergy': 2000.0, 'consumeenergy': 900.0,
+        'feedinpowerM2': 0.0, 'soc': 55.0, 'peps1': None, 'peps2': None, 'peps3': None,
+        'inverterType': '5', 'inverterStatus': '102', 'uploadTime': '2023-06-01 12:00:00',
+        'batPower': 100.0, 'powerdc1': 700.0, 'powerdc2': 600.0, 'powerdc3': None, 'powerdc4': None,
+        'batStatus': '0'
+    }
+}).encode()
+
+
+# Request handler of the stub server. Speaks HTTP/1.1 so clients can keep connections alive
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, so Nagle would delay keep-alive responses
+    disable_nagle_algorithm = True
+    connect_delay = 0.0
+
+    def setup(self):
+        # Called once per connection, so this is where we simulate the handshake cost
+        sleep(self.connect_delay)
+        super().setup()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(connect_delay):
+    StubHandler.connect_delay = connect_delay
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Time n calls of f and return the latencies in milliseconds
+def time_requests(f, n):
+    latencies = []
+    for _ in range(n):
+        start = perf_counter()
+        f()
+        latencies.append((perf_counter() - start) * 1000.0)
+    return latencies
+
+
+def report(name, latencies):
+    pct = quantiles(latencies, n=100)
+    print(f"{name:<12} mean {mean(latencies):8.3f} ms   p50 {median(latencies):8.3f} ms   "
+          f"p95 {pct[94]:8.3f} ms   max {max(latencies):8.3f} ms")
+
+
+def get_args():
+    parser = ArgumentParser(description="Benchmark Solax API requests with and without connection pooling.")
+    parser.add_argument("-n", "--requests", help="Number of requests per variant.", type=int, default=200)
+    parser.add_argument("-cd", "--connect-delay", help="Simulated handshake delay per new connection in seconds.",
+                        type=float, default=0.0)
+    return parser.parse_args()
+
+
+def run():
+    args = get_args()
+    server = start_stub_server(args.connect_delay)
+    url = f"http://127.0.0.1:{server.server_port}/proxyApp/proxy/api/getRealtimeInfo.do"
+    params = {'tokenId': 'bench', 'sn': 'SYBENCH001'}
+    headers = {'Content-Type': 'application/json'}
+
+    api = SolaxApi({'URL': url})
+
+    print(f"{args.requests} requests per variant, simulated connect delay {args.connect_delay * 1000.0:.1f} ms")
+    report('unpooled', time_requests(lambda: req_get(url, params=params, headers=headers).json(), args.requests))
+    report('pooled', time_requests(lambda: api.get(params=params, headers=headers), args.requests))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    run()
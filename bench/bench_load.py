@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+
+# Load test of the Solax PV monitoring client against a simulated Solax cloud and mqtt broker.
+#
+# Starts, in a separate process so they don't count towards the client's CPU and memory,
+#   - a fake 'getRealtimeInfo.do' endpoint with configurable latency, server errors, incomplete
+#     payloads (nulls, missing fields, empty results) and "several violations" rate limit responses
+#   - a minimal mqtt 3.1.1 broker accepting publishes with QoS 0 and 1 and counting what it gets
+# and then drives the client's Solax class with 1 to 10,000 simulated inverters through the same
+# steps as its polling loop: query all inverters concurrently, parse and check the results, publish
+# the snapshot and the client's own metrics. The rate limiter and sleeping between cycles are
+# taken out of the picture, so the cycles run back to back.
+#
+# Reports per number of inverters the cycle time (and its query and processing parts), the
+# messages, lines and bytes the broker received per second, the CPU time per cycle and the memory
+# of the client as JSON, e.g. to keep the results of a version and compare the next one with
+# --baseline, which exits with status 1 if something got worse by more than --tolerance.
+#
+# Run from the repository root with
+#     python3 bench/bench_load.py [--inverters 1 100 1000] [--cycles 10] [--latency 0.02]
+#                                 [--error-rate 0.01] [--incomplete-rate 0.02] [-o results.json]
+
+import asyncio
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from json import dumps as json_dumps, load as json_load
+from multiprocessing import Pipe, Process
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from os.path import dirname, abspath, join
+from platform import platform, python_version
+from random import Random
+from statistics import mean, median, quantiles
+from subprocess import run as run_cmd, DEVNULL
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread
+from time import monotonic, perf_counter, process_time, sleep, time
+from urllib.parse import urlsplit, parse_qs
+import resource
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from client import Mqtt, Solax, TokenBucket
+from instrument import Metrics
+from state import StateStore
+
+# Topic of the message marking the end of a run. The broker gets all messages of a connection in
+# order, so once it has this one it has all the others
+DONE_TOPIC = 'bench/done'
+
+# Fields of a reading the client can't do without (see REQUIRED_FIELDS in sample.py) and the
+# optional ones, to break payloads with
+REQUIRED = ('acpower', 'yieldtoday', 'yieldtotal', 'feedinpower', 'feedinenergy', 'consumeenergy')
+OPTIONAL = ('soc', 'batPower', 'powerdc1', 'powerdc2')
+
+VIOLATION = 'There have been several violations of the API limits'
+
+
+# ---- Simulated Solax cloud
+
+# Realtime response of the Solax API for an inverter. Values move a little from query to query
+def response(sn, n, rnd):
+    return {
+        'success': True, 'exception': 'Query success!',
+        'result': {
+            'inverterSN': sn, 'sn': 'SWLOAD0001', 'acpower': 1200.0 + rnd.uniform(-200, 200),
+            'yieldtoday': 10.5 + n * 0.001, 'yieldtotal': 5000.0 + n * 0.001, 'feedinpower': 300.0,
+            'feedinenergy': 2000.0 + n * 0.0005, 'consumeenergy': 900.0 + n * 0.0005, 'feedinpowerM2': 0.0,
+            'soc': 55.0, 'peps1': None, 'peps2': None, 'peps3': None, 'inverterType': '5',
+            'inverterStatus': '102', 'uploadTime': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'batPower': 100.0, 'powerdc1': 700.0 + rnd.uniform(-100, 100), 'powerdc2': 600.0,
+            'powerdc3': None, 'powerdc4': None, 'batStatus': '0'
+        }
+    }
+
+
+# Request handler of the fake cloud. Speaks HTTP/1.1 so the client can keep its connections alive
+class CloudHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    options = None
+    stats = None
+    lock = Lock()
+    rnd = Random(0)
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+            return self.stats['requests']
+
+    def do_GET(self):
+        o = self.options
+        n = self.count('requests')
+        if o['latency'] or o['jitter']:
+            sleep(o['latency'] + self.rnd.uniform(0, o['jitter']))
+
+        sn = parse_qs(urlsplit(self.path).query).get('sn', ['?'])[0]
+        p = self.rnd.random()
+        status = 200
+        if p < o['error_rate']:
+            self.count('errors')
+            status, body = 503, {'error': 'Service Unavailable'}
+        elif p < o['error_rate'] + o['violation_rate']:
+            self.count('violations')
+            body = {'success': False, 'exception': VIOLATION, 'result': None}
+        elif p < o['error_rate'] + o['violation_rate'] + o['incomplete_rate']:
+            self.count('incomplete')
+            body = response(sn, n, self.rnd)
+            # Like the real API: a required field null or missing, or no result at all
+            kind = self.rnd.randrange(4)
+            if kind == 0:
+                body['result'] = None
+            elif kind == 1:
+                body['result'][self.rnd.choice(REQUIRED)] = None
+            elif kind == 2:
+                del body['result'][self.rnd.choice(REQUIRED)]
+            else:
+                body['result'][self.rnd.choice(OPTIONAL)] = None
+        else:
+            body = response(sn, n, self.rnd)
+
+        data = json_dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# ---- Minimal mqtt broker
+
+# Takes connections and publishes of mqtt 3.1.1 clients and counts what gets published. Doesn't
+# deliver anything to subscribers
+class Broker:
+    def __init__(self):
+        self.stats = {'connections': 0, 'messages': 0, 'bytes': 0, 'lines': 0, 'done': 0}
+        self.topics = {}
+
+    async def handle(self, reader, writer):
+        self.stats['connections'] += 1
+        try:
+            while True:
+                head = (await reader.readexactly(1))[0]
+                # Remaining length, 7 bits per byte
+                length, shift = 0, 0
+                while True:
+                    b = (await reader.readexactly(1))[0]
+                    length |= (b & 0x7f) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                body = await reader.readexactly(length)
+
+                kind = head >> 4
+                if kind == 1:       # CONNECT
+                    writer.write(b'\x20\x02\x00\x00')
+                elif kind == 3:     # PUBLISH
+                    qos = (head >> 1) & 3
+                    n = int.from_bytes(body[:2], 'big')
+                    topic = body[2:2 + n].decode()
+                    offset = 2 + n
+                    if qos:
+                        writer.write(b'\x40\x02' + body[offset:offset + 2])
+                        offset += 2
+                    payload = body[offset:]
+                    if topic == DONE_TOPIC:
+                        self.stats['done'] += 1
+                        continue
+                    self.stats['messages'] += 1
+                    self.stats['bytes'] += len(payload)
+                    self.stats['lines'] += payload.count(b'\n') + 1
+                    self.topics[topic] = self.topics.get(topic, 0) + 1
+                elif kind == 8:     # SUBSCRIBE, granted with QoS 0
+                    writer.write(b'\x90\x03' + body[:2] + b'\x00')
+                elif kind == 12:    # PINGREQ
+                    writer.write(b'\xd0\x00')
+                elif kind == 14:    # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# Runs the fake cloud and broker until told to stop. Talks to the benchmark through 'conn': sends
+# the ports first and then answers 'stats' with the counters of both
+def serve(conn, options):
+    CloudHandler.options = options
+    CloudHandler.stats = {'requests': 0, 'errors': 0, 'violations': 0, 'incomplete': 0}
+    cloud = ThreadingHTTPServer(('127.0.0.1', 0), CloudHandler)
+    cloud.daemon_threads = True
+    Thread(target=cloud.serve_forever, daemon=True).start()
+
+    broker = Broker()
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(broker.handle, '127.0.0.1', 0))
+    Thread(target=loop.run_forever, daemon=True).start()
+
+    conn.send((cloud.server_port, server.sockets[0].getsockname()[1]))
+    while True:
+        cmd = conn.recv()
+        if cmd == 'stats':
+            with CloudHandler.lock:
+                cloud_stats = dict(CloudHandler.stats)
+            conn.send({'cloud': cloud_stats, 'broker': dict(broker.stats), 'topics': dict(broker.topics)})
+        else:
+            break
+    cloud.shutdown()
+
+
+# ---- The client under load
+
+def client_env(args, n, cloud_port, state_dir):
+    return {
+        'settings': {
+            'URL': f"http://127.0.0.1:{cloud_port}/proxyApp/proxy/api/getRealtimeInfo.do",
+            'TOKEN': 'bench',
+            'TOPIC': 'telegraf/solar',
+            'METRICS_TOPIC': 'telegraf/solax_client',
+            'BACKUP_FILE': join(state_dir, 'state.json'),
+            'QUERY_FREQUENCY': 60,
+            'API_RATE_LIMIT': 60 * n,
+            'BATCH_PUBLISH': args.batch,
+            'PUBLISH_TIMESTAMP': 'cycle',
+            'ROLLUPS': args.rollups,
+            'HTTP_RETRIES': args.retries,
+            'HTTP_BACKOFF': 0.01,
+            'HTTP_READ_TIMEOUT': 10.0 + args.latency + args.jitter,
+            'API_VIOLATION_BACKOFF': 0,
+        },
+        'inverter_sns': {f"sn{i + 1}": f"SYLOAD{i:05d}" for i in range(n)},
+        'inverter_types': {'5': 'X3-Hybiyd/Fit'},
+        'inverter_codes': {'102': 'Normal Mode'},
+    }
+
+
+# One cycle of the polling loop (see Solax.poll_loop()) without the sleep. Returns the seconds
+# spent querying and processing
+async def cycle(solax):
+    start = monotonic()
+    solax.cycle_ts = time()
+    due = list(solax.inverter_sns.values())
+    results = await asyncio.gather(*(solax.query_inverter(sn) for sn in due))
+    queried = monotonic()
+    solax.process_cycle(dict(zip(due, results)))
+    solax.scheduler.plan(start, due)
+    solax.metrics.observe('cycle_seconds', monotonic() - start)
+    solax.publish_metrics()
+    return queried - start, monotonic() - queried
+
+
+def counter(metrics, name):
+    return sum(v for (k, _), v in metrics.counters.items() if k == name)
+
+
+# Resident memory of this process in MB. The peak if the current value isn't available
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1048576
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1048576 if sys.platform == 'darwin' else peak / 1024
+
+
+def summary(values):
+    pct = quantiles(values, n=100, method='inclusive') if len(values) > 1 else values * 99
+    return {'mean': mean(values), 'p50': median(values), 'p95': pct[94], 'max': max(values)}
+
+
+def stats(conn):
+    conn.send('stats')
+    return conn.recv()
+
+
+# Run the client with n inverters for the given cycles and measure it
+def run_load(args, n, ports, conn):
+    cloud_port, broker_port = ports
+    with TemporaryDirectory() as state_dir:
+        env = client_env(args, n, cloud_port, state_dir)
+        inverter_map = {}
+        for sn in env['inverter_sns'].values():
+            inverter_map[(sn, 'powerdc1')] = 'south'
+            inverter_map[(sn, 'powerdc2')] = 'north'
+        metrics = Metrics()
+        mqtt = Mqtt('127.0.0.1', broker_port, qos=args.qos, max_queued=0, client_id=f"bench-{n}")
+        mqtt.connect_mqtt()
+        mqtt.client.loop_start()
+        state = StateStore(env['settings']['BACKUP_FILE'])
+        solax = Solax(env, mqtt, False, state=state, metrics=metrics, inverter_map=inverter_map)
+        # The benchmark is about the client, not about the quota of a Solax token
+        solax.source.limiter = TokenBucket(1e9, capacity=1e9)
+
+        async def cycles():
+            for _ in range(args.warmup):
+                await cycle(solax)
+            before = stats(conn)
+            cpu, wall = process_time(), perf_counter()
+            times = [await cycle(solax) for _ in range(args.cycles)]
+            return before, times, process_time() - cpu, wall
+
+        before, times, cpu, wall = asyncio.run(cycles())
+
+        # Wait for the broker to have everything
+        mqtt.client.publish(DONE_TOPIC, b'', qos=args.qos)
+        done = before['broker']['done']
+        while stats(conn)['broker']['done'] == done:
+            sleep(0.01)
+        wall = perf_counter() - wall
+        after = stats(conn)
+        mqtt.client.disconnect()
+        mqtt.close()
+        solax.source.close()
+        state.close()
+
+    received = {k: after['broker'][k] - before['broker'][k] for k in ('messages', 'lines', 'bytes')}
+    return {
+        'inverters': n,
+        'cycles': args.cycles,
+        'cycle_seconds': summary([q + p for q, p in times]),
+        'query_seconds': summary([q for q, _ in times]),
+        'process_seconds': summary([p for _, p in times]),
+        'publish': dict(received, **{f"{k}_per_second": v / wall for k, v in received.items()}),
+        'cloud': {k: after['cloud'][k] - before['cloud'][k] for k in after['cloud']},
+        'client': {k: counter(metrics, k) for k in ('inverter_errors_total', 'cycles_aborted_total',
+                                                    'http_retries_total', 'http_failures_total',
+                                                    'api_violations_total', 'repaired_fields_total')},
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_cycle': cpu / args.cycles,
+        'rss_mb': rss_mb(),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def git_version():
+    try:
+        out = run_cmd(['git', 'describe', '--always', '--dirty'], cwd=dirname(abspath(__file__)),
+                      capture_output=True, text=True, stdin=DEVNULL)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Metrics compared with a baseline and whether higher values are worse
+COMPARED = (
+    (('cycle_seconds', 'p50'), True),
+    (('process_seconds', 'p50'), True),
+    (('cpu_seconds_per_cycle',), True),
+    (('rss_mb',), True),
+    (('publish', 'lines_per_second'), False),
+)
+
+
+# Regressions of the results against a baseline run of the same benchmark, as text lines
+def regressions(results, baseline, tolerance):
+    found = []
+    base_runs = {r['inverters']: r for r in baseline['runs']}
+    for run in results['runs']:
+        base = base_runs.get(run['inverters'])
+        if base is None:
+            continue
+        for path, higher_is_worse in COMPARED:
+            new, old = run, base
+            for k in path:
+                new, old = new[k], old[k]
+            if not old:
+                continue
+            change = (new - old) / old
+            if (change if higher_is_worse else -change) > tolerance:
+                found.append(f"{run['inverters']} inverters: {'.'.join(path)} {old:.6g} -> {new:.6g} "
+                             f"({change:+.1%})")
+    return found
+
+
+def get_args():
+    parser = ArgumentParser(description="Load test the Solax client against a simulated cloud and mqtt broker.")
+    parser.add_argument("-i", "--inverters", help="Numbers of simulated inverters to run with.", type=int,
+                        nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument("-c", "--cycles", help="Measured cycles per run.", type=int, default=10)
+    parser.add_argument("-w", "--warmup", help="Cycles to run before measuring.", type=int, default=2)
+    parser.add_argument("--latency", help="Latency of the fake cloud per request in seconds.", type=float,
+                        default=0.0)
+    parser.add_argument("--jitter", help="Random extra latency of up to that many seconds.", type=float,
+                        default=0.0)
+    parser.add_argument("--error-rate", help="Share of requests answered with a server error (503).",
+                        type=float, default=0.0)
+    parser.add_argument("--incomplete-rate", help="Share of responses with nulls, missing fields or no result.",
+                        type=float, default=0.0)
+    parser.add_argument("--violation-rate", help="Share of responses reporting violations of the API limits.",
+                        type=float, default=0.0)
+    parser.add_argument("--retries", help="HTTP_RETRIES of the client.", type=int, default=2)
+    parser.add_argument("--qos", help="MQTT_QOS of the client.", type=int, choices=(0, 1), default=1)
+    parser.add_argument("--no-batch", help="Publish one message per metric (BATCH_PUBLISH = false).",
+                        dest='batch', action='store_false')
+    parser.add_argument("--rollups", help="ROLLUPS of the client, e.g. 1m 15m.", nargs='*', default=[])
+    parser.add_argument("-o", "--output", help="File to write the results to. Standard output if not given.")
+    parser.add_argument("-b", "--baseline", help="Results of an earlier run to compare with.")
+    parser.add_argument("-t", "--tolerance", help="Relative change counting as a regression.", type=float,
+                        default=0.1)
+    return parser.parse_args()
+
+
+def run():
+    args = get_args()
+    options = {'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+               'incomplete_rate': args.incomplete_rate, 'violation_rate': args.violation_rate}
+    conn, child_conn = Pipe()
+    servers = Process(target=serve, args=(child_conn, options), daemon=True)
+    servers.start()
+    ports = conn.recv()
+
+    results = {
+        'benchmark': 'load',
+        'version': git_version(),
+        'python': python_version(),
+        'platform': platform(),
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'options': dict(options, cycles=args.cycles, warmup=args.warmup, retries=args.retries, qos=args.qos,
+                        batch=args.batch, rollups=args.rollups),
+        'runs': [],
+    }
+    try:
+        for n in args.inverters:
+            print(f"Running {args.cycles} cycles with {n} inverters", file=sys.stderr)
+            # What the client prints goes to stderr, standard output is for the results
+            with redirect_stdout(sys.stderr):
+                results['runs'].append(run_load(args, n, ports, conn))
+    finally:
+        conn.send('stop')
+        servers.join(5)
+
+    text = json_dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json_load(f), args.tolerance)
+        for line in found:
+            print("Regression:", line, file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# Benchmark of parsing inverter readings into a snapshot.
+#
+# Compares the way the client used to parse the data of an inverter
+#   - json.loads() of the complete response, a fresh Stats object with a __dict__, the list of the
+#     'powerdc' keys built per reading and 'sn/line' strings to look up the inverter map
+# with the current parse path
+#   - a Sample with an array of values laid out by a Schema resolved once per inverter, a Stats
+#     object with __slots__ and the inverter map keyed by (sn, line)
+# for raw JSON responses (cloud API) and for dicts delivered by the local sources. For raw responses
+# it also measures extracting only the needed keys from the text with a regular expression instead
+# of parsing it completely with json.loads(), which turns out slower than the C parser.
+#
+# Reports the time per reading, the peak memory allocated while parsing a cycle and the memory
+# retained per parsed reading.
+#
+# Run from the repository root with
+#     python3 bench/bench_parse.py [-n 20000] [--inverters 10]
+
+from argparse import ArgumentParser
+from json import dumps as json_dumps, loads as json_loads
+from os.path import dirname, abspath
+from time import perf_counter_ns
+import re
+import sys
+import tracemalloc
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from client import Stats, add_sample
+from sample import Schema, SAMPLE_FIELDS
+
+
+# Response of the Solax API for an inverter. Matches the structure of a realtime response
+def response(sn, i):
+    return {
+        'success': True, 'exception': 'Query success!',
+        'result': {
+            'inverterSN': sn, 'sn': 'SWBENCH001', 'acpower': 1200.0 + i, 'yieldtoday': 10.5,
+            'yieldtotal': 5000.0, 'feedinpower': 300.0, 'feedinenergy': 2000.0, 'consumeenergy': 900.0,
+            'feedinpowerM2': 0.0, 'soc': 55.0, 'peps1': None, 'peps2': None, 'peps3': None,
+            'inverterType': '5', 'inverterStatus': '102', 'uploadTime': '2023-06-01 12:00:00',
+            'batPower': 100.0, 'powerdc1': 700.0 + i, 'powerdc2': 600.0, 'powerdc3': None, 'powerdc4': None,
+            'batStatus': '0'
+        }
+    }
+
+
+# ---- How the client used to parse
+
+class LegacyStats:
+    def __init__(self):
+        self.sol_pwr = 0.0
+        self.yield_total = 0.0
+        self.yield_today = 0.0
+        self.to_grid = 0.0
+        self.to_grid_today = 0.0
+        self.to_grid_total = 0.0
+        self.from_grid = 0.0
+        self.bat_soc = 0
+        self.ac_power = 0.0
+        self.to_bat = 0.0
+        self.to_house = 0.0
+        self.to_wallbox = 0.0
+
+
+def legacy_parse(stats, res, sn, inverter_map, line_stats):
+    stats.yield_total += float(res['yieldtotal'])
+    stats.yield_today += float(res['yieldtoday'])
+    stats.to_grid_total += float(res['feedinenergy'])
+    stats.to_grid += float(res['feedinpower'])
+    stats.from_grid += float(res['consumeenergy'])
+    stats.ac_power += float(res['acpower'])
+    to_bat = res['batPower']
+    if to_bat is not None:
+        stats.to_bat += float(to_bat)
+    bat = res['soc']
+    if bat is not None:
+        stats.bat_soc += bat
+    lines = [k for k in res.keys() if k.startswith('powerdc')]
+    for line in lines:
+        p = res[line]
+        if p is not None:
+            stats.sol_pwr += float(p)
+            k = sn + '/' + line
+            if k in inverter_map:
+                line_stats.append((sn, line, inverter_map[k], p))
+
+
+def legacy_cycle(readings, inverter_map, raw):
+    stats = LegacyStats()
+    line_stats = []
+    for sn, r in readings:
+        res = json_loads(r)['result'] if raw else r
+        legacy_parse(stats, res, sn, inverter_map, line_stats)
+    return stats, line_stats
+
+
+# ---- Extracting only the needed keys from the raw text
+
+KEY_PATTERN = re.compile(r'"(' + '|'.join(SAMPLE_FIELDS) + r')"\s*:\s*(null|-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)')
+
+
+def extract_fields(text):
+    return {k: None if v == 'null' else float(v) for k, v in KEY_PATTERN.findall(text)}
+
+
+# ---- The current parse path
+
+def current_cycle(readings, line_map, schemas, raw, parse=lambda r: json_loads(r)['result']):
+    stats = Stats()
+    line_stats = []
+    for sn, r in readings:
+        res = parse(r) if raw else r
+        schema = schemas.get(sn)
+        if schema is None:
+            schema = schemas[sn] = Schema(sn, res, line_map)
+        line_stats += add_sample(stats, schema.sample(res))
+    return stats, line_stats
+
+
+def time_per_reading(cycle, cycles, n_inverters):
+    start = perf_counter_ns()
+    for _ in range(cycles):
+        cycle()
+    return (perf_counter_ns() - start) / (cycles * n_inverters)
+
+
+# Peak bytes allocated while parsing one cycle
+def peak_per_cycle(cycle):
+    cycle()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    cycle()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return peak
+
+
+# Bytes retained per reading when keeping 'count' parsed readings
+def retained_per_reading(parse, count=1000):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    kept = [parse(i) for i in range(count)]
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del kept
+    return size / count
+
+
+def get_args():
+    parser = ArgumentParser(description="Benchmark parsing inverter readings into a snapshot.")
+    parser.add_argument("-n", "--readings", help="Number of readings to parse per path.", type=int, default=20000)
+    parser.add_argument("--inverters", help="Inverters per cycle.", type=int, default=10)
+    return parser.parse_args()
+
+
+def main(args):
+    sns = [f"SYBENCH{i:03d}" for i in range(args.inverters)]
+    inverter_map = {f"{sn}/powerdc{j}": f"{sn}_line{j}" for sn in sns for j in (1, 2)}
+    line_map = {(sn, f"powerdc{j}"): f"{sn}_line{j}" for sn in sns for j in (1, 2)}
+    texts = [(sn, json_dumps(response(sn, i))) for i, sn in enumerate(sns)]
+    dicts = [(sn, response(sn, i)['result']) for i, sn in enumerate(sns)]
+    cycles = max(1, args.readings // args.inverters)
+    schemas = {}
+    schema = Schema(sns[0], dicts[0][1], line_map)
+
+    paths = [
+        ('raw JSON, before', lambda: legacy_cycle(texts, inverter_map, True),
+         lambda i: json_loads(texts[i % len(texts)][1])['result']),
+        ('raw JSON, after', lambda: current_cycle(texts, line_map, schemas, True),
+         lambda i: schema.sample(json_loads(texts[i % len(texts)][1])['result'])),
+        ('raw JSON, keys', lambda: current_cycle(texts, line_map, schemas, True, extract_fields),
+         lambda i: schema.sample(extract_fields(texts[i % len(texts)][1]))),
+        ('dict, before', lambda: legacy_cycle(dicts, inverter_map, False), None),
+        ('dict, after', lambda: current_cycle(dicts, line_map, schemas, False), None),
+    ]
+
+    print(f"{args.inverters} inverters per cycle, {cycles * args.inverters} readings per path\n")
+    print(f"{'path':<18} {'ns/reading':>11} {'peak bytes/cycle':>17} {'retained bytes/reading':>23}")
+    for name, cycle, parse in paths:
+        ns = time_per_reading(cycle, cycles, args.inverters)
+        peak = peak_per_cycle(cycle)
+        retained = f"{retained_per_reading(parse):.0f}" if parse else '-'
+        print(f"{name:<18} {ns:>11.0f} {peak:>17} {retained:>23}")
+
+
+if __name__ == '__main__':
+    main(get_args())
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Startup benchmark of the Solax PV monitoring client.
+#
+# docker-compose restarts the client on failure, and every restart used to leave a gap: the client
+# imported requests and paho first and only published once its first poll of the Solax cloud came
+# back. This starts client.py as a new process, the way the container does, against a fake Solax
+# cloud (see bench_load.py) with --latency per request and a minimal mqtt broker, and measures the
+# time from starting the process to the first message on the snapshot topic
+#   - cold:     without state, i.e. the first message is the snapshot of the first poll
+#   - warm:     with the state of an earlier run, i.e. the first message is the persisted snapshot
+#               (see STARTUP_SNAPSHOT), for the 'requests' and the 'stdlib' HTTP client. The time
+#               to the first polled snapshot is reported as well
+# The time Python itself takes to start (python3 -c pass) is reported for reference.
+#
+# Run from the repository root with
+#     python3 bench/bench_startup.py [--runs 5] [--latency 0.1]
+
+import asyncio
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer
+from os import environ, makedirs
+from os.path import dirname, abspath, join
+from signal import SIGTERM
+from statistics import median
+from subprocess import Popen, DEVNULL, run as run_cmd
+from tempfile import TemporaryDirectory
+from threading import Thread, Event
+from time import time
+import sys
+
+from bench_load import CloudHandler
+
+REPO = dirname(dirname(abspath(__file__)))
+TOPIC = 'telegraf/solar'
+
+
+# ---- Minimal mqtt broker
+
+# Takes connections and publishes of mqtt 3.1.1 clients and records the messages on TOPIC with the
+# time they arrived
+class Broker:
+    def __init__(self):
+        self.arrivals = []
+        self.arrived = Event()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    b = (await reader.readexactly(1))[0]
+                    length |= (b & 0x7f) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                body = await reader.readexactly(length)
+
+                kind = head >> 4
+                if kind == 1:       # CONNECT
+                    writer.write(b'\x20\x02\x00\x00')
+                elif kind == 3:     # PUBLISH
+                    now = time()
+                    n = int.from_bytes(body[:2], 'big')
+                    if (head >> 1) & 3:
+                        writer.write(b'\x40\x02' + body[2 + n:4 + n])
+                    if body[2:2 + n].decode() == TOPIC:
+                        self.arrivals.append((now, body[2 + n + ((head >> 1) & 3 and 2):]))
+                        self.arrived.set()
+                elif kind == 12:    # PINGREQ
+                    writer.write(b'\xd0\x00')
+                elif kind == 14:    # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # Wait for the first message on TOPIC with a snapshot taken after 'start', i.e. not one
+    # persisted by an earlier run. Returns the arrival times of the first message and of that one,
+    # None if they didn't arrive within 'timeout'
+    def wait(self, start, timeout):
+        end = time() + timeout
+        while time() < end:
+            polled = [t for t, payload in self.arrivals if int(payload.split(b'\n')[0].split()[-1]) / 1e9 >= start]
+            if polled:
+                return self.arrivals[0][0], polled[0]
+            self.arrived.wait(0.005)
+            self.arrived.clear()
+        return (self.arrivals[0][0] if self.arrivals else None), None
+
+
+def toml_value(v):
+    if isinstance(v, bool):
+        return 'true' if v else 'false'
+    if isinstance(v, str):
+        return '"' + v + '"'
+    return repr(v)
+
+
+def write_env(path, settings, inverters):
+    lines = ['[settings]'] + [f'{k} = {toml_value(v)}' for k, v in settings.items()]
+    lines += ['[inverter_sns]'] + [f'sn{i + 1} = "SYSTART{i:03d}"' for i in range(inverters)]
+    lines += ['[inverter_types]', '"5" = "X3-Hybiyd/Fit"', '[inverter_codes]', '"102" = "Normal Mode"']
+    with open(join(path, '.client-env'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(join(path, '.inverter_line_map'), 'w') as f:
+        f.write(''.join(f'SYSTART{i:03d}:powerdc1:line{i + 1}\n' for i in range(inverters)))
+
+
+# Start the client in 'path' and return the seconds to its first message on TOPIC and to the
+# snapshot of its first poll
+def start_client(client, path, broker, timeout):
+    broker.arrivals = []
+    start = time()
+    proc = Popen([sys.executable, client], cwd=path, stdout=DEVNULL, stderr=DEVNULL,
+                 env=dict(environ, CLIENT_TEST='0'))
+    try:
+        first, polled = broker.wait(start, timeout)
+    finally:
+        proc.send_signal(SIGTERM)
+        proc.wait(10)
+    if polled is None:
+        raise RuntimeError(f"The client didn't publish a snapshot within {timeout}s, see {path}")
+    return first - start, polled - start
+
+
+def python_startup(runs):
+    times = []
+    for _ in range(runs):
+        start = time()
+        run_cmd([sys.executable, '-c', 'pass'])
+        times.append(time() - start)
+    return median(times)
+
+
+def get_args():
+    parser = ArgumentParser(description="Benchmark the time from starting the Solax client to its first publish.")
+    parser.add_argument("-r", "--runs", help="Runs per case, the median gets reported.", type=int, default=5)
+    parser.add_argument("--latency", help="Latency of the fake cloud per request in seconds.", type=float,
+                        default=0.1)
+    parser.add_argument("-i", "--inverters", help="Inverters of the site. The rate limiter spreads their queries "
+                                                  "over a second.", type=int, default=1)
+    parser.add_argument("--timeout", help="Seconds to wait for a publish.", type=float, default=20.0)
+    parser.add_argument("--client", help="client.py to start, e.g. of a checkout of an earlier version.",
+                        default=join(REPO, 'client.py'))
+    return parser.parse_args()
+
+
+def run():
+    args = get_args()
+    CloudHandler.options = {'latency': args.latency, 'jitter': 0.0, 'error_rate': 0.0, 'incomplete_rate': 0.0,
+                            'violation_rate': 0.0}
+    CloudHandler.stats = {'requests': 0, 'errors': 0, 'violations': 0, 'incomplete': 0}
+    cloud = ThreadingHTTPServer(('127.0.0.1', 0), CloudHandler)
+    cloud.daemon_threads = True
+    Thread(target=cloud.serve_forever, daemon=True).start()
+
+    broker = Broker()
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(broker.handle, '127.0.0.1', 0))
+    Thread(target=loop.run_forever, daemon=True).start()
+
+    def settings(path, http_client):
+        return {'URL': f"http://127.0.0.1:{cloud.server_port}/proxyApp/proxy/api/getRealtimeInfo.do",
+                'TOKEN': 'bench', 'TOPIC': TOPIC, 'BROKER_HOST': '127.0.0.1',
+                'BROKER_PORT': server.sockets[0].getsockname()[1], 'BACKUP_FILE': join(path, 'state.json'),
+                'QUERY_FREQUENCY': 60, 'API_RATE_LIMIT': 60 * args.inverters, 'BATCH_PUBLISH': True,
+                'PUBLISH_TIMESTAMP': 'cycle', 'SPOOL': True, 'MQTT_QOS': 1, 'RELOAD_INTERVAL': 0,
+                'HTTP_CLIENT': http_client}
+
+    print(f"python3 -c pass   {python_startup(args.runs) * 1000:7.0f} ms")
+    print(f"{'case':<18}{'first publish':>14}{'first poll':>12}   (median of {args.runs} runs, "
+          f"{args.latency * 1000:.0f} ms cloud latency)")
+    with TemporaryDirectory() as tmp:
+        for http_client in ('requests', 'stdlib'):
+            times = {'cold': [], 'warm': []}
+            for i in range(args.runs):
+                path = join(tmp, f'{http_client}-{i}')
+                makedirs(path)
+                write_env(path, settings(path, http_client), args.inverters)
+                times['cold'].append(start_client(args.client, path, broker, args.timeout))
+                # Again, with the state the first run left behind
+                times['warm'].append(start_client(args.client, path, broker, args.timeout))
+            for case, results in times.items():
+                print(f"{case + ' ' + http_client:<18}{median(r[0] for r in results) * 1000:11.0f} ms"
+                      f"{median(r[1] for r in results) * 1000:9.0f} ms")
+
+    cloud.shutdown()
+
+
+if __name__ == '__main__':
+    run()
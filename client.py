@@ -10,34 +10,91 @@
 # To test, run with
 # docker run -it --rm --name cl -v "$PWD":/usr/src/myapp -v "$PWD":/solar -e CLIENT_TEST=1 -w /usr/src/myapp python-paho python3 client.py
 
-from random import randint
-from requests import get as req_get, exceptions as req_exceptions
-from time import sleep
+from random import randint, uniform
+from math import nan
+from time import sleep, time, time_ns, monotonic
 from datetime import datetime
-from pprint import pprint
-from json import load as json_load, dump as json_dump
-from shutil import move
-from tempfile import mktemp
+from zoneinfo import ZoneInfo
+from json import dumps as json_dumps
 from tomllib import load as toml_load
 from os import getenv
-from os import remove as file_remove
-from os.path import isfile
-from paho.mqtt import client as mqtt_client
-from math import ceil
+from os.path import join, dirname
+from spool import Spool
+from state import StateStore
+from aggregate import Aggregator
+from energy import EnergyAccount
+from sample import Schema, FIELD_INDEX
+from quality import QualityCheck, CARRIED, MISSING
+from schedule import Scheduler
+from instrument import Metrics, LabelledMetrics, MetricsServer
+from sites import load_sites, hash_ring, shard_for, shard_key, shard_path
+from watch import ConfigWatcher
+from live import LiveCache, LiveServer
+from archive import Archive, line_column, split_column
+from events import EventDetector
+from local_source import ModbusSource, LocalHttpSource, MODBUS_MAP, LOCAL_HTTP_MAP, register_map
+from http_pool import make_session
+import asyncio
+from collections import Counter
+from signal import signal, SIGTERM
+from threading import Event
+from sys import exit as sys_exit
 
 # Generate a Client ID with the publish prefix to register with the mqtt broker
 client_id = f'publish-{randint(0, 1000)}'
 
+# Return code of paho for a message queued for sending (paho.mqtt.client.MQTT_ERR_SUCCESS). paho only
+# gets imported when connecting to the broker
+MQTT_ERR_SUCCESS = 0
+
+# Measurement name of the metrics we publish. Telegraf parses the mqtt messages as InfluxDB line
+# protocol, so this is the measurement the dashboards query
+MEASUREMENT = "telegraf_message"
+
+# Measurement and default topic prefix for the rollups of the aggregation stage
+ROLLUP_MEASUREMENT = "solar_rollup"
+ROLLUP_TOPIC = "telegraf/solar_rollup"
+
+# The Stats metrics holding power values (in W). These get integrated into energy by the
+# aggregation stage
+POWER_METRICS = ['sol_pwr', 'to_grid', 'ac_power', 'to_bat', 'to_house', 'to_wallbox']
+
+# Measurement and default topic of the energy accounting buckets (per 15 minutes, hour and day)
+ENERGY_MEASUREMENT = "solar_energy"
+ENERGY_TOPIC = "telegraf/solar_energy"
+
+# Power metrics (W) the energy accounting integrates and the API's cumulative energy counters
+# (kWh) it tracks per day
+ENERGY_POWER_METRICS = ['to_grid', 'to_bat', 'to_house', 'sol_pwr']
+ENERGY_COUNTERS = ['to_grid_total', 'from_grid', 'yield_total']
+
+# Measurement and default topic of the data quality per cycle: per inverter whether it was
+# available and its quality flags (see quality.py), and how complete the snapshot was
+QUALITY_MEASUREMENT = "solar_quality"
+QUALITY_TOPIC = "telegraf/solar_quality"
+
+# Measurement and default topic of the PV forecast per inverter line (see forecast.py)
+FORECAST_MEASUREMENT = "solar_forecast"
+FORECAST_TOPIC = "telegraf/solar_forecast"
+
+# Measurement and default topic of the per device series: one per inverter, per PV string (inverter
+# line) and per battery, tagged with 'device' and the inverter serial number 'sn' (and 'line' and
+# its 'name' from the inverter line map for strings). The tags only take the values of the
+# configured inverters and their lines, so the number of series stays bounded
+DEVICE_MEASUREMENT = "solar_device"
+DEVICE_TOPIC = "telegraf/solar_device"
+
+# Fields of the inverter and battery series and the sample fields they come from (see sample.py)
+INVERTER_FIELDS = [(k, FIELD_INDEX[f]) for k, f in (('yield_total', 'yieldtotal'), ('yield_today', 'yieldtoday'),
+                                                   ('to_grid_total', 'feedinenergy'), ('to_grid', 'feedinpower'),
+                                                   ('from_grid', 'consumeenergy'), ('ac_power', 'acpower'))]
+BATTERY_FIELDS = [(k, FIELD_INDEX[f]) for k, f in (('to_bat', 'batPower'), ('bat_soc', 'soc'))]
+
 # Settings file
 env_file = ".client-env"
 # File for mapping inverter serial no's and power lines to names, e.g. <inverter_sn> and 'powerdc1' to 'south'
 inverter_line_file = ".inverter_line_map"
 
-# File indicating that a checkpoint for 'to_grid_midnight' data should be done. If file exists a
-# checkpoint will be done and the file will get removed again.
-# This will typically be done before you shutown the client to have the previous data upon restart
-ckpt_file = "do_client_ckpt"
-
 # Get the map of inverter lines to metric names from file. The files has the syntax
 #     <inverter_sn>:<line>:<metric name>
 # e.g.
@@ -45,98 +102,391 @@ ckpt_file = "do_client_ckpt"
 # with each line in the file corresponding to an inverter line.
 #
 # Returns a dict of the form:
-#     { '<inverter_sn>/<line>' : <metric name>, ... }
+#     { (<inverter_sn>, <line>) : <metric name>, ... }
 def parse_inverter_line_file(inverter_line_file):
     map = {}
     with open(inverter_line_file) as myfile:
         for line in myfile:
             inverter, power_line, name = tuple(line[:-1].split(":"))
-            map[inverter + '/' + power_line] = name
+            map[(inverter, power_line)] = name
 
     return map
 
-# REST get request. Used to query the Solax API
-def make_get_request(url, params=None, headers=None):
-    try:
-        response = req_get(url, params=params, headers=headers)
-        response.raise_for_status()  # Raises an exception if the request was not successful (status code >= 400)
+# Class to query the Solax REST API. Keeps a pooled HTTP session (requests or the standard library
+# client of http_pool.py, see HTTP_CLIENT) so the TCP/TLS connections to the Solax cloud stay alive
+# between queries instead of doing a fresh handshake for every one of them. Requests time out after
+# the configured connect/read timeouts and get retried with exponential backoff and jitter on 5xx
+# responses and connection errors.
+class SolaxApi:
+    def __init__(self, settings, pool_size=1, metrics=None):
+        # Params:
+        #   :settings:  The 'settings' section of the client env file
+        #   :pool_size: Number of connections to keep in the pool, i.e. concurrent queries
+        #   :metrics:   Metrics registry to record retries, failures and API violations in
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.configure(settings)
 
-        # Assuming the response contains JSON data, we will parse it into a dictionary
-        response_json = response.json()
+        # Backoff state. There are cases where the API has repeated issues and then denys responses
+        # for an hour. We don't send any queries until 'blocked_until' has passed in that case.
+        self.blocked_until = 0.0
 
-        # There are cases where the API has repeated issues and then denys responses for
-        # an hour. Handle that case by sleeping an hour
-        if 'exception' in response_json and \
-           response_json['exception'].startswith('There have been several violations'):
-            sleep(3601)
+        # The session gets created with the first query, so importing the HTTP client doesn't hold
+        # up starting the client
+        self.pool_size = pool_size
+        self.session = None
+        self.errors = None
 
-        return response_json
+    # Apply the URL, timeout and retry settings. The pooled connections are kept
+    def configure(self, settings):
+        if settings.get('HTTP_CLIENT') not in (None, 'requests', 'stdlib'):
+            raise ValueError(f"Unknown HTTP_CLIENT '{settings['HTTP_CLIENT']}'")
+        self.http_client = settings.get('HTTP_CLIENT')
+        self.url = settings['URL']
+        self.timeout = (settings.get('HTTP_CONNECT_TIMEOUT', 5.0), settings.get('HTTP_READ_TIMEOUT', 20.0))
+        self.retries = settings.get('HTTP_RETRIES', 2)
+        self.backoff = settings.get('HTTP_BACKOFF', 1.0)
+        self.max_backoff = settings.get('HTTP_MAX_BACKOFF', 30.0)
+        self.violation_backoff = settings.get('API_VIOLATION_BACKOFF', 3601)
 
-    except req_exceptions.RequestException as e:
-        print("Error making the POST request:", e)
+    # Whether we are backing off because of API violations
+    def blocked(self):
+        return monotonic() < self.blocked_until
+
+    # Exponential backoff with full jitter for the given retry attempt (1, 2, ...)
+    def _retry_delay(self, attempt):
+        return uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    # REST get request. Returns the parsed JSON response or None if the request failed or we are
+    # in the backoff state
+    def get(self, params=None, headers=None):
+        if self.blocked():
+            return None
+        if self.session is None:
+            self.session, self.errors = make_session(self.http_client, self.pool_size)
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.metrics.inc('http_retries_total')
+                sleep(self._retry_delay(attempt))
+
+            try:
+                response = self.session.get(self.url, params=params, headers=headers, timeout=self.timeout)
+                if response.status_code >= 500:
+                    print(f"Server error {response.status_code} from the Solax API (attempt {attempt + 1})")
+                    continue
+                response.raise_for_status()  # Raises an exception if the request was not successful (status code >= 400)
+
+                # Assuming the response contains JSON data, we will parse it into a dictionary
+                response_json = response.json()
+
+            except (self.errors.ConnectionError, self.errors.Timeout) as e:
+                print(f"Error connecting to the Solax API (attempt {attempt + 1}):", e)
+                continue
+
+            # Versions of requests before 2.27 raise a plain ValueError for a body that isn't JSON
+            except (self.errors.RequestException, ValueError) as e:
+                print("Error making the GET request:", e)
+                self.metrics.inc('http_failures_total')
+                return None
+
+            # Enter the backoff state if the API tells us that we have been violating its limits
+            if isinstance(response_json, dict) and 'exception' in response_json and \
+               str(response_json['exception']).startswith('There have been several violations'):
+                self.blocked_until = monotonic() + self.violation_backoff
+                self.metrics.inc('api_violations_total')
+                print(f"Solax API reports violations. Backing off for {self.violation_backoff}s")
+
+            return response_json
+
+        print(f"Giving up on the Solax API after {self.retries + 1} attempts")
+        self.metrics.inc('http_failures_total')
         return None
 
-# Class for backing up state of the metrics collection. Allows to shutdown the collection while
-# maintaining reasonable values for daily metrics that get reset over midnight. Such metrics are
-# the only state we need to preserve in the metrics collection. Other state is managed by the
-# Solax API.
-class Backup:
-    def __init__(self, fname='backup.json'):
-        self.fname = fname
+# Token bucket rate limiter for the Solax API. The API only allows a limited number of queries per
+# token and minute and every query against an inverter counts, so all queries of a cycle have to
+# acquire a token from the bucket first. Tokens get refilled continuously at 'rate' per second up to
+# 'capacity' tokens, i.e. with a capacity of 1 the queries get spread evenly at 1/rate seconds.
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = monotonic()
+        self.lock = asyncio.Lock()
 
-    def save_backup(self, data):
-        temp_filename = mktemp()
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
 
-        try:
-            with open(temp_filename, 'w') as temp_file:
-                json_dump(data, temp_file)
+    # Wait for a token. Returns the number of seconds we had to wait for it
+    async def acquire(self):
+        start = monotonic()
+        # The lock makes waiting tasks get their tokens in the order they asked for them
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+        return monotonic() - start
 
-            move(temp_filename, self.fname)
-            # print(f"Data saved to '{self.fname}'")
-        except Exception as e:
-            print(f"Error while saving data: {str(e)}")
+# Data source querying the Solax cloud API. Sources deliver the data of an inverter in the format
+# of the API's response, so parse_api_data() doesn't need to care where it comes from. See
+# local_source.py for sources reading the inverters directly.
+class CloudSource:
+    def __init__(self, settings, inverter_sns, metrics, limiters=None, token_inverters=None):
+        # Params:
+        #   :settings:          The 'settings' section of the client env file
+        #   :inverter_sns:      The 'inverter_sns' section of the client env file
+        #   :metrics:           Metrics registry for the client's own metrics
+        #   :limiters:          Rate limiters per token, shared by the sites of a multi-site client
+        #   :token_inverters:   Number of inverters queried with our token over all sites
+        self.metrics = metrics
+        self.configure(settings, inverter_sns, limiters, token_inverters)
 
-    def load_backup(self):
-        try:
-            with open(self.fname, 'r') as file:
-                loaded_data = json_load(file)
-            return loaded_data
-        except FileNotFoundError:
-            print(f"File '{self.fname}' not found. Returning an empty dictionary.")
-            return {}
+        # Pooled client for the Solax API, one connection per inverter
+        self.api = SolaxApi(settings, len(inverter_sns), metrics)
+
+    # Apply (new) settings and inverters. Used at start and when the config changes while we run
+    def configure(self, settings, inverter_sns, limiters=None, token_inverters=None):
+        self.settings = settings
+
+        # Meanwhile the Solax API appears to be permitting only one query per minute, although
+        # this is documented differently. And each request against an inverter counts as a query.
+        # API_RATE_LIMIT configures the queries per minute the token allows. If not set we fall
+        # back to one query per QUERY_FREQUENCY, which is how the client always behaved.
+        rate = settings.get('API_RATE_LIMIT', 60 / settings['QUERY_FREQUENCY'])
+        if limiters is None:
+            self.limiter = TokenBucket(rate / 60)
+        else:
+            # The quota is per token, so sites sharing a token share its rate limiter
+            self.limiter = limiters.setdefault(settings['TOKEN'], TokenBucket(rate / 60))
+            self.limiter.rate = rate / 60
+
+        # A cycle queries every inverter once, so it cannot be shorter than the quota allows
+        n = token_inverters or len(inverter_sns)
+        self.cycle_interval = max(settings['QUERY_FREQUENCY'], n * 60 / rate)
+        # Queries per second our inverters may use, i.e. their share of the token's quota
+        self.query_budget = rate / 60 * len(inverter_sns) / n
+        if getattr(self, 'api', None) is not None:
+            self.api.configure(settings)
+
+    # Query the Solax API for a single inverter. The blocking request is run in a worker thread so
+    # the queries of a cycle can overlap
+    async def read(self, sn):
+        # Default API request attributes
+        headers = {'Content-Type': 'application/json'}
+        params = {'tokenId': self.settings['TOKEN'], 'sn': sn}
+
+        # Don't spend quota while backing off from API violations
+        if self.api.blocked():
+            return None
+
+        waited = await self.limiter.acquire()
+        if waited > 0.001:
+            self.metrics.inc('rate_limit_waits_total')
+            self.metrics.observe('rate_limit_wait_seconds', waited)
+
+        with self.metrics.timer('http_request_seconds', {'sn': sn}):
+            return await asyncio.to_thread(self.api.get, params=params, headers=headers)
+
+    def close(self):
+        if self.api.session is not None:
+            self.api.session.close()
+
+# Create the data source configured by SOURCE in the client env file: "cloud" (the default) for the
+# Solax cloud API, "modbus" or "local_http" to read the inverters in [local_inverters] directly. A
+# given 'source' of the configured kind gets reconfigured instead, keeping its connections
+def make_source(env, metrics, limiters=None, token_inverters=None, source=None):
+    settings = env['settings']
+    kind = settings.get('SOURCE', 'cloud')
+    if kind == 'cloud':
+        if isinstance(source, CloudSource):
+            source.configure(settings, env['inverter_sns'], limiters, token_inverters)
+            return source
+        return CloudSource(settings, env['inverter_sns'], metrics, limiters, token_inverters)
+
+    # Connection settings of the local inverters, in the order of [inverter_sns]
+    local = env.get('local_inverters', {})
+    inverters = {sn: local[sn] for sn in env['inverter_sns'].values()}
+    interval = settings.get('LOCAL_QUERY_FREQUENCY', 2.0)
+    overrides = env.get('local_register_map')
+    if kind == 'modbus':
+        if isinstance(source, ModbusSource):
+            source.configure(inverters, register_map(MODBUS_MAP, overrides), interval)
+            return source
+        return ModbusSource(inverters, register_map(MODBUS_MAP, overrides), interval, metrics)
+    if kind == 'local_http':
+        if isinstance(source, LocalHttpSource):
+            source.configure(inverters, register_map(LOCAL_HTTP_MAP, overrides), interval)
+            return source
+        return LocalHttpSource(inverters, register_map(LOCAL_HTTP_MAP, overrides), interval, metrics,
+                               http_client=settings.get('HTTP_CLIENT'))
+    raise ValueError(f"Unknown SOURCE '{kind}' in {env_file}")
+
+# Escape a measurement name, tag key/value or field key for the InfluxDB line protocol
+def lp_escape(s):
+    return str(s).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+# Format a field value for the InfluxDB line protocol. Numbers are written without the integer
+# suffix so that they end up as floats, like they always did with the per metric messages.
+def lp_value(v):
+    if isinstance(v, bool):
+        return 'true' if v else 'false'
+    if isinstance(v, (int, float)):
+        return repr(float(v))
+    return '"' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+# Build one line of InfluxDB line protocol, i.e.
+#     <measurement>[,<tag>=<value>...] <field>=<value>[,<field>=<value>...] [<timestamp>]
+# Fields with a value of None are left out. The timestamp is given in seconds since the epoch and
+# is written in nanoseconds, the default precision of telegraf's influx parser.
+def line_protocol(fields, tags=None, ts=None, measurement=None):
+    line = lp_escape(measurement or MEASUREMENT)
+    if tags:
+        line += ''.join(f",{lp_escape(k)}={lp_escape(v)}" for k, v in sorted(tags.items()))
+    line += ' ' + ','.join(f"{lp_escape(k)}={lp_value(v)}" for k, v in fields.items() if v is not None)
+    if ts is not None:
+        line += f" {int(ts * 1_000_000_000)}"
+    return line
 
 # Class to push metrics to the mqtt broker. Tested to work with mosquitto.
 class Mqtt:
-    def __init__(self, host, port):
+    def __init__(self, host, port, spool=None, max_queued=0, qos=0, client_id=client_id):
+        # Params:
+        #   :host:       The mqtt broker host
+        #   :port:       The mqtt broker port
+        #   :spool:      Optional Spool to hold messages while the broker is unavailable
+        #   :max_queued: Max number of messages paho holds in memory (0 means unlimited)
+        #   :qos:        QoS level for publishing
+        #   :client_id:  The client id to connect with, needs to be unique per connection
+        self.client_id = client_id
         self.host = host
         self.port = port
+        self.spool = spool
+        self.max_queued = max_queued
+        self.qos = qos
         self.client = None
+        self.connected = False
+        # Set by the network loop when the connection is up, to wait for it at startup
+        self.connected_event = Event()
+
+        # Messages handed to paho that the broker hasn't acknowledged yet, as (<message info>,
+        # <topic>, <message to spool>, <QoS>, <retain flag>). paho sends them again when it
+        # reconnects, they only go to the spool if we stop before they got acknowledged
+        self.inflight = []
 
     def connect_mqtt(self):
+        from paho.mqtt import client as mqtt_client
+
         def on_connect(client, userdata, flags, rc):
             if rc == 0:
                 print("Connected to MQTT Broker!")
+                self.connected = True
+                self.connected_event.set()
             else:
                 print("Failed to connect, return code %d\n", rc)
 
-        self.client = mqtt_client.Client(client_id)
+        def on_disconnect(client, userdata, rc):
+            if self.connected:
+                print("Disconnected from MQTT Broker, return code", rc)
+            self.connected = False
+            self.connected_event.clear()
+
+        self.client = mqtt_client.Client(self.client_id)
         # client.username_pw_set(username, password)
         self.client.on_connect = on_connect
-        self.client.connect(self.host,self.port)
-
-    def publish(self, topic, metric, value):
-        msg = f"telegraf_message {metric}={value}"
-        result = self.client.publish(topic, msg)
-        # result: [0, 1]
-        status = result[0]
-        if status == 0:
-            # print(f"Sent `{msg}` to topic `{topic}`")
-            pass
+        self.client.on_disconnect = on_disconnect
+        # Caps the memory paho uses for queueing messages. Anything beyond goes to the spool
+        self.client.max_queued_messages_set(self.max_queued)
+        if self.spool is not None:
+            # Let the network loop (re)connect in the background so we can spool messages while
+            # the broker is down, even at startup
+            self.client.connect_async(self.host, self.port)
         else:
-            print(f"Failed to send message to topic {topic}")
+            self.client.connect(self.host,self.port)
+
+    def publish(self, topic, metric, value, tags=None):
+        tags = ''.join(f",{lp_escape(k)}={lp_escape(v)}" for k, v in sorted(tags.items())) if tags else ''
+        msg = f"{MEASUREMENT}{tags} {metric}={value}"
+        # Spooled messages get replayed later, so they need the time they have been taken at
+        self.publish_message(topic, msg, spool_msg=f"{msg} {time_ns()}")
+
+    # Publish a preformatted message, e.g. several lines of InfluxDB line protocol at once
+    #
+    # Params:
+    #   :topic:     The topic to publish to
+    #   :msg:       The message
+    #   :spool_msg: Message to put into the spool instead of msg if it cannot be sent
+    #   :qos:       QoS level for this message instead of the default one
+    #   :retain:    Whether the broker keeps the message as last one of the topic
+    def publish_message(self, topic, msg, spool_msg=None, qos=None, retain=False):
+        if self.spool is None:
+            if not self._send(topic, msg, qos, retain):
+                print(f"Failed to send message to topic {topic}")
+            return
+
+        self._check_inflight()
+
+        # Replay older messages first to keep the order. Only send directly if nothing is waiting
+        # in the spool anymore
+        if self.connected and self.spool.pending():
+            self.flush_spool()
+        if not self.connected or self.spool.pending() or not self._send(topic, msg, qos, retain, spool_msg):
+            self.spool.append(topic, spool_msg or msg, qos, retain)
+
+    # Hand a message to paho. Returns True if it got queued for sending
+    def _send(self, topic, msg, qos=None, retain=False, spool_msg=None):
+        qos = self.qos if qos is None else qos
+        info = self.client.publish(topic, msg, qos=qos, retain=retain)
+        if info.rc != MQTT_ERR_SUCCESS:
+            return False
+        if self.spool is not None and qos > 0:
+            self.inflight.append((info, topic, spool_msg or msg, qos, retain))
+        return True
+
+    # Forget about acknowledged messages. The others stay with paho, which sends them again once
+    # it is reconnected, so they must not go to the spool as well while we run
+    def _check_inflight(self):
+        self.inflight = [m for m in self.inflight if not m[0].is_published()]
+
+    # Move the messages the broker didn't acknowledge to the spool. Only when we stop, as paho's
+    # copies are gone then
+    def _spool_inflight(self):
+        self._check_inflight()
+        for info, topic, msg, qos, retain in self.inflight:
+            self.spool.append(topic, msg, qos, retain)
+        self.inflight = []
+
+    # Wait up to 'timeout' seconds for the connection to the broker. Returns whether it is up
+    def wait_connected(self, timeout):
+        return self.connected_event.wait(timeout)
+
+    # Replay spooled messages as long as the broker accepts them
+    def flush_spool(self):
+        if self.spool is None or not self.connected:
+            return
+        replayed = self.spool.replay(self._send)
+        if replayed:
+            print(f"Replayed {replayed} spooled messages (queued {self.spool.queued}, "
+                  f"replayed {self.spool.replayed}, dropped {self.spool.dropped})")
+
+    # The network loop only ends by itself once the broker acknowledged everything, so we
+    # disconnect first. What it didn't acknowledge goes to the spool
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+        if self.spool is not None:
+            self._spool_inflight()
+            self.spool.close()
 
 # Class to act a metrics data container and for printing and publishing the metrics
 class Stats:
+    METRICS = ('sol_pwr', 'yield_total', 'yield_today', 'to_grid', 'to_grid_today', 'to_grid_total',
+               'from_grid', 'bat_soc', 'ac_power', 'to_bat', 'to_house', 'to_wallbox', 'interval')
+    __slots__ = METRICS + ('batteries',)
+
     # Initializing the list of stats we currently collect
     def __init__(self):
         self.sol_pwr = 0.0          # Current total PV yield (compiled from inverter line yields)
@@ -147,229 +497,986 @@ class Stats:
         self.to_grid_total = 0.0    # Total power fed to grid since system went live
         self.from_grid = 0.0        # Supposedly power from grid but doesn't seem to work
                                     # (self.to_grid if < 0 gives us this instead)
-        self.bat_soc = 0            # Current battery state of charge
+        self.bat_soc = 0            # Current battery state of charge, the mean over the batteries
         self.ac_power = 0.0         # Current AC power delivered by inverters aggregated
         self.to_bat = 0.0           # Current power feed to batteries
         self.to_house = 0.0         # Current power feed to house
         self.to_wallbox = 0.0       # Current power feed to wallbox (doesn't work at this point)
+        self.interval = 0.0         # Seconds the snapshot stands for, i.e. since the previous one
+        self.batteries = 0          # Number of batteries that reported their state of charge
+
+    # The metrics as (name, value) pairs
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.METRICS]
 
     def show(self):
-        pprint(self.__dict__,sort_dicts=True)
+        from pprint import pprint
+        pprint(dict(self.items()),sort_dicts=True)
+
+    # Compile the metrics the API doesn't deliver from the others
+    def derive(self):
+        # Trying to compile power delivered to wallbox. Doesn't work the way it is done here,
+        # unfortunately. The Solax app has this information and seems to get it from the
+        # wallbox directly but there doesn't seem to be an API for that
+        self.to_house = self.ac_power - self.to_grid
+        self.to_wallbox = self.sol_pwr - self.to_bat - self.to_house
+        if self.to_wallbox < 0.0:
+            self.to_wallbox = 0.0
 
     # We publish all class variables
     # Params:
     #   :f:     function used for publishing
     def publish(self, f):
-        for k,v in self.__dict__.items():
+        for k,v in self.items():
             f(k, v)
 
+    # The metrics as a single line of InfluxDB line protocol
+    def to_line(self, ts=None, tags=None):
+        return line_protocol(dict(self.items()), tags=tags, ts=ts)
+
+# Convert the 'uploadTime' reported by the API (local time of the site, e.g. "2023-06-01 12:00:00")
+# to seconds since the epoch. Returns None if it can't be parsed.
+def parse_upload_time(upload_time, tz=None):
+    try:
+        dt = datetime.strptime(upload_time, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    return dt.replace(tzinfo=tz).timestamp()
+
+# Add a sample of an inverter to the snapshot in stats. Shared by the polling loop and the backfill
+# tool
+#
+# Parameters
+#   :stats:     the Stats of the snapshot
+#   :sample:    the Sample of the inverter (see sample.py)
+#
+# Returns the power per mapped inverter line as a list of (<sn>, <line>, <metric name>, <power>)
+def add_sample(stats, sample):
+    v = sample.values
+
+    # The below metrics are delivered directly through the API but only per inverter. So need
+    # to sum them up over consequtive call of this function
+    stats.yield_total += v[0]
+    stats.yield_today += v[1]
+    stats.to_grid_total += v[2]
+    stats.to_grid += v[3]
+    stats.from_grid += v[4]
+    stats.ac_power += v[5]
+    if v[6] == v[6]:    # not NaN, i.e. the battery power was reported
+        stats.to_bat += v[6]
+    if v[7] == v[7]:
+        # The state of charge doesn't add up over batteries, keep the running mean
+        stats.batteries += 1
+        stats.bat_soc += (v[7] - stats.bat_soc) / stats.batteries
+
+    # The current PV yield is a bit more complicated because each inverter can have multiple
+    # lines connecting it to different PV panel areas. So need to aggregate all this but we
+    # also want to retain the power delivered per line so we can report on that separately.
+    # The schema of the inverter knows its lines and their metric names
+    line_stats = []
+    sn = sample.schema.sn
+    for i, line, name in sample.schema.lines:
+        p = v[i]
+        if p == p:
+            # Aggregate line yield into total PV power metric
+            stats.sol_pwr += p
+            if name is not None:
+                line_stats.append((sn, line, name, p))
+
+    return line_stats
+
 # Class to query the Solax rest API, do any metrics data manipulation and trigger publishing the
 # data to the mqtt broker
 class Solax:
-    def __init__(self, env, mqtt, test):
+    def __init__(self, env, mqtt, test, state=None, site=None, metrics=None, source=None, inverter_map=None,
+                 live=None):
         # Params:
-        #   :env:   The parsed contents of the client environment file
-        #   :mqtt:  The mqtt broker to talk to
-        #   :test:  Using the app in test mode (True) or not
+        #   :env:       The parsed contents of the client environment file
+        #   :mqtt:      The mqtt broker to talk to
+        #   :test:      Using the app in test mode (True) or not
+        #   :state:     The store to persist derived state in. Opened on BACKUP_FILE if not given
+        #   :site:      Name of the site in multi-site mode. Published metrics get tagged with it
+        #   :metrics:   Registry for the client's own metrics. A new one if not given
+        #   :source:    Where to get the inverter data from. Created from the settings if not given
+        #   :inverter_map: The map between inverter lines and metric names. Read from the inverter
+        #               line file if not given
+        #   :live:      Cache of the live data API to put the snapshots in, if it is served
 
-        # The 'settings' section in the client env file
-        self.settings = env['settings']
-        # The 'inverter_types' section in the lient env file
-        self.inverter_types = env['inverter_types']
-        # The 'inverter_codes' section in the lient env file
-        self.inverter_codes = env['inverter_codes']
-        # The 'inverter_sns' section in the lient env file
-        self.inverter_sns = env['inverter_sns']
-        # The map between inverter lines and metric names
-        self.inverter_map = parse_inverter_line_file(inverter_line_file)
         self.mqtt = mqtt
+        self.live = live
         self.test = test
+        self.site = site
+        self.tags = {'site': site} if site is not None else {}
+        settings = env['settings']
+
+        # Derived state is journaled every cycle so we resume exactly after a restart or crash
+        self.state = state if state is not None else StateStore(settings['BACKUP_FILE'])
 
-        # Settings needed for midnight rollover of daily metrics and back-ups done to prevent
-        # loosing state on those metrics
-        self.to_grid_midnight = 0.0
-        self.midnight_update_done = False
-        self.bkup = Backup(self.settings['BACKUP_FILE'])
+        # Local archive of the snapshots, independent of InfluxDB. Sites get a directory each
+        self.archive = None
+        if settings.get('ARCHIVE_DIR'):
+            self.archive = Archive(join(settings['ARCHIVE_DIR'], site) if site is not None else settings['ARCHIVE_DIR'],
+                                   block_rows=settings.get('ARCHIVE_BLOCK_ROWS', 360))
 
         # Used to store info per inverter as returned from API
         self.inverters = {}
+        # When we last got data of each inverter and its energy counters at that time
+        self.last_seen = {}
+        self.cycle_ts = time()
+
+        # Timezone of the site. The API reports upload times in local time of the site. Defaults to
+        # the local timezone of the system we are running on
+        self.tz = ZoneInfo(settings['TIMEZONE']) if 'TIMEZONE' in settings else None
+        self.line_stats = []
+        self.upload_times = []
+        # Per inverter of this cycle (<available>, <quality flags>, <repaired fields>, <age in s>)
+        self.inverter_quality = {}
+        # The last sample of each inverter, standing in while it isn't due for polling
+        self.samples = {}
+        self.prev_cycle_ts = None
+
+        # Registry for the client's own metrics (timings per stage, aborted cycles, etc.)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.describe('cycles_total', 'Polling cycles run')
+        self.metrics.describe('cycles_aborted_total', 'Cycles aborted because no inverter delivered usable data')
+        self.metrics.describe('inverter_errors_total', 'Inverter readings missing or failing the schema check')
+        self.metrics.describe('repaired_fields_total', 'Values failing a range or rate check, replaced by the last good one')
+        self.metrics.describe('rate_limit_waits_total', 'Queries that had to wait for the rate limiter')
+        self.metrics.describe('api_violations_total', 'Violation responses from the Solax API')
+        self.metrics.describe('http_request_seconds', 'Latency of Solax API queries including retries')
+        self.metrics.describe('parse_seconds', 'Time spent parsing API data per inverter')
+        self.metrics.describe('publish_seconds', 'Time spent publishing a snapshot')
+        self.metrics.describe('cycle_seconds', 'Time spent per polling cycle, excluding sleep')
+
+        # Where we get the inverter data from, the Solax cloud or the inverters directly
+        self.source = source if source is not None else make_source(env, self.metrics)
+
+        # Everything that can change while we run: settings, inverters, line map and what depends
+        # on them
+        self.quality = None
+        self.scheduler = None
+        self.aggregator = None
+        self.forecaster = None
+        self.events = None
+        self.configure(env, inverter_map, source=self.source)
+
+        # Energy accounting per 15 minutes, hour and day in the timezone of the site. Energy isn't
+        # integrated over gaps of more than 3 (of the longest) poll intervals
+        self.energy = EnergyAccount(ENERGY_POWER_METRICS, ENERGY_COUNTERS, tz=self.tz,
+                                    max_gap=3 * self.scheduler.max_interval)
+        self.energy_buckets = []
+        self.load_state()
+
+    # Apply a (new) client env and inverter line map. Used at start and when the config files
+    # change while we run (see ConfigWatcher). Everything gets built before anything gets swapped
+    # in, so a config that doesn't validate leaves the running one untouched. The state, the
+    # counters and the connections of the source are kept.
+    #
+    # Params:
+    #   :env:           The parsed contents of the client environment file (of the site)
+    #   :inverter_map:  The map between inverter lines and metric names. Read from the inverter
+    #                   line file if not given
+    #   :source:        The source to use. The current one gets reconfigured if not given
+    #   :limiters:      Rate limiters per token, see make_source()
+    #   :token_inverters: Number of inverters queried with the site's token over all sites
+    def configure(self, env, inverter_map=None, source=None, limiters=None, token_inverters=None):
+        settings = env['settings']
+        inverter_types = env['inverter_types']
+        inverter_codes = env['inverter_codes']
+        inverter_sns = env['inverter_sns']
+        if inverter_map is None:
+            inverter_map = parse_inverter_line_file(inverter_line_file)
+        sns = list(inverter_sns.values())
+
+        # The API reports upload times in local time of the site. Read in the timezone of the
+        # system, usually UTC in a container, they would shift every point
+        if settings.get('PUBLISH_TIMESTAMP', 'cycle') not in ('upload', 'cycle'):
+            raise ValueError(f"Unknown PUBLISH_TIMESTAMP '{settings['PUBLISH_TIMESTAMP']}'")
+        if settings.get('PUBLISH_TIMESTAMP', 'cycle') == 'upload' and self.tz is None:
+            raise ValueError("PUBLISH_TIMESTAMP 'upload' needs the TIMEZONE of the site")
+
+        # Validation and repair of the inverter data. Bad values get replaced by the last good ones
+        # and inverters without usable data get carried forward for up to CARRY_FOR seconds
+        quality = QualityCheck(max_power=settings.get('MAX_INVERTER_POWER', 30000.0),
+                               limits={k: tuple(v) for k, v in settings.get('QUALITY_LIMITS', {}).items()},
+                               stale_after=settings.get('STALE_AFTER', 900.0),
+                               carry_for=settings.get('CARRY_FOR', 900.0))
+
+        if source is None:
+            source = make_source(env, self.metrics, limiters, token_inverters, self.source)
+        cycle_interval = source.cycle_interval
+
+        # Poll interval per inverter. With ADAPTIVE_POLLING it follows the inverter status, daylight
+        # and how volatile the power is, within the query budget of the source. Every inverter gets
+        # polled every cycle interval otherwise
+        if settings.get('ADAPTIVE_POLLING', False):
+            scheduler = Scheduler(sns, cycle_interval,
+                                  min_interval=settings.get('MIN_QUERY_FREQUENCY'),
+                                  max_interval=settings.get('MAX_QUERY_FREQUENCY', 600.0),
+                                  budget=source.query_budget,
+                                  lat=settings.get('LATITUDE'), lon=settings.get('LONGITUDE'),
+                                  sun_margin=settings.get('SUN_MARGIN', 1800.0))
+        else:
+            scheduler = Scheduler(sns, cycle_interval)
+
+        # Aggregation of the metrics into rollups over the windows configured in ROLLUPS. Power
+        # metrics (including the inverter lines) get integrated into energy per window. Energy
+        # isn't integrated over gaps of more than 3 poll intervals, e.g. while the client was down.
+        # The running windows are kept unless the windows change
+        aggregator = None
+        if settings.get('ROLLUPS'):
+            energy_metrics = settings.get('ENERGY_METRICS', POWER_METRICS + list(inverter_map.values()))
+            if self.aggregator is not None and [r.label for r in self.aggregator.rollups] == settings['ROLLUPS']:
+                aggregator = self.aggregator
+                aggregator.energy_metrics = set(energy_metrics)
+                aggregator.max_gap = 3 * scheduler.max_interval
+            else:
+                aggregator = Aggregator(settings['ROLLUPS'], energy_metrics, max_gap=3 * scheduler.max_interval)
+
+        # Detection of status changes, strings going down and batteries crossing SOC thresholds,
+        # published as events to EVENT_TOPIC. What is known about the inverters we keep is kept
+        events = None
+        if settings.get('EVENT_TOPIC'):
+            events = EventDetector(fault_statuses=settings.get('FAULT_STATUSES', ["Fault Mode", "Permanent Fault Mode"]),
+                                   soc_thresholds=settings.get('SOC_THRESHOLDS', [10.0, 20.0, 90.0]),
+                                   soc_hysteresis=settings.get('SOC_HYSTERESIS', 1.0),
+                                   string_min_power=settings.get('STRING_MIN_POWER', 5.0),
+                                   string_sibling_power=settings.get('STRING_SIBLING_POWER', 200.0))
+            events.restore(self.events.state() if self.events is not None else self.state.get('events', {}))
+            events.retain(sns)
+
+        # Forecast of the PV power and yield of the site and per line. The model is kept unless its
+        # settings change
+        forecaster = self.make_forecaster(settings) if settings.get('FORECAST', False) else None
+
+        # Carry over what we learned about the inverters we keep
+        if self.quality is not None:
+            quality.good = {sn: v for sn, v in self.quality.good.items() if sn in sns}
+            quality.good_ts = {sn: v for sn, v in self.quality.good_ts.items() if sn in sns}
+        if self.scheduler is not None:
+            for sn in sns:
+                if sn in self.scheduler.next_due:
+                    scheduler.next_due[sn] = self.scheduler.next_due[sn]
+                    scheduler.powers[sn].extend(self.scheduler.powers[sn])
+
+        # Swap in the new config
+        # The 'settings' section in the client env file
+        self.settings = settings
+        # The 'inverter_types' section in the lient env file
+        self.inverter_types = inverter_types
+        # The 'inverter_codes' section in the lient env file
+        self.inverter_codes = inverter_codes
+        # The 'inverter_sns' section in the lient env file
+        self.inverter_sns = inverter_sns
+        # The map between inverter lines and metric names. The sample layouts of the inverters
+        # know the metric names of their lines, so they get resolved again if it changed
+        if getattr(self, 'inverter_map', None) != inverter_map:
+            self.schemas = {sn: Schema(sn, {line: None for _, line, _ in schema.lines}, inverter_map)
+                            for sn, schema in getattr(self, 'schemas', {}).items()}
+            for sample in list(self.samples.values()) + list(quality.good.values()):
+                sample.schema = self.schemas.get(sample.schema.sn, sample.schema)
+        self.inverter_map = inverter_map
+        self.samples = {sn: v for sn, v in self.samples.items() if sn in sns}
+        self.quality = quality
+        self.source = source
+        self.cycle_interval = cycle_interval
+        self.scheduler = scheduler
+        self.aggregator = aggregator
+        self.forecaster = forecaster
+        self.events = events
+        if getattr(self, 'energy', None) is not None:
+            self.energy.max_gap = 3 * scheduler.max_interval
+
+    # Forecaster for the settings, the running one if they don't change the model. A new one starts
+    # from the persisted model, or gets trained on the last FORECAST_TRAIN_DAYS of the local archive.
+    # NumPy only gets imported here, the client doesn't need it otherwise
+    def make_forecaster(self, settings):
+        try:
+            from forecast import Forecaster
+        except ImportError:
+            raise ValueError("FORECAST needs NumPy, install it with 'pip install numpy'")
+        if settings.get('LATITUDE') is None or settings.get('LONGITUDE') is None:
+            raise ValueError("FORECAST needs LATITUDE and LONGITUDE of the site")
+
+        forecaster = Forecaster(settings['LATITUDE'], settings['LONGITUDE'], tz=self.tz,
+                                step=settings.get('FORECAST_STEP', 900),
+                                horizon=settings.get('FORECAST_HORIZON', 21600))
+        if self.forecaster is not None and self.forecaster.params() == forecaster.params():
+            return self.forecaster
+        if forecaster.restore(self.state.get('forecast', {})):
+            return forecaster
+        if self.archive is not None:
+            start = time() - settings.get('FORECAST_TRAIN_DAYS', 365) * 86400
+            times, values = self.forecast_history(start)
+            forecaster.fit(times, values)
+            print(f"Trained the forecast on {len(times)} archived snapshots")
+        return forecaster
+
+    # The snapshots since start in the local archive as the series of the forecast: 'sol_pwr' and
+    # the power per line name, summed over the inverters. Returns (<timestamps>, {<series>: <values>})
+    def forecast_history(self, start):
+        lines = {}
+        for column in self.archive.columns(start):
+            name, tags = split_column(column)
+            if tags is not None:
+                lines.setdefault(name, []).append(column)
+        fields = ['sol_pwr'] + [c for columns in lines.values() for c in columns]
+
+        times = []
+        values = {k: [] for k in ['sol_pwr'] + list(lines)}
+        for block_times, columns in self.archive.read(start, fields=fields):
+            missing = [nan] * len(block_times)
+            times += block_times
+            values['sol_pwr'] += columns.get('sol_pwr', missing)
+            for name, line_columns in lines.items():
+                parts = [columns[c] for c in line_columns if c in columns]
+                values[name] += [sum(v) for v in zip(*parts)] if parts else missing
+        return times, values
 
     # Main loop over inverters doing all metrics manipulations and publishing of metrics in each run
     def loop_over_inverters(self):
+        asyncio.run(self.poll_loop())
 
-        # Default API request attributes
-        headers = {'Content-Type': 'application/json'}
-        params = None
-
+    # Asynchronous polling engine. Each cycle queries the inverters due according to the scheduler
+    # concurrently through a pooled HTTP session, with the token bucket making sure we stay within
+    # the Solax API quota. The results are then parsed together into one snapshot that is stamped
+    # with the cycle start time.
+    async def poll_loop(self):
         while True:
-            # Reset metrics for this run
-            self.stats = Stats()
+            start = monotonic()
+            self.cycle_ts = time()
 
-            # Iterate over inverter serial numbers, get metric data from each and parse the data
-            for sn_name, sn in self.inverter_sns.items():
-                params = {'tokenId': self.settings['TOKEN'], 'sn': sn}
-                result_dict = make_get_request(self.settings['URL'], params=params, headers=headers)
+            due = self.scheduler.due(start)
+            results = await asyncio.gather(*(self.query_inverter(sn) for sn in due))
+            self.process_cycle(dict(zip(due, results)))
+            self.scheduler.plan(start, due)
+            self.metrics.observe('cycle_seconds', monotonic() - start)
+            self.publish_metrics()
 
-                # Meanwhile the Solax API appears to be permitting only one query per minute, although
-                # this is documented differently. Andy each request against a inverter counts as a
-                # query, so if you have multiple inverters you have to pause in between querying
-                # them. Also be sure that QUERY_FREQUENCY is at least set to 1 min.
-                sleep(self.settings['QUERY_FREQUENCY'])
+            # Sleep until the next inverter is due
+            await asyncio.sleep(max(0.0, self.scheduler.next_wake(start) - monotonic()))
 
-                
-                if self.test:
-                    print(result_dict)
-                
-                # The data coming back from the Solax API is sometimes incomplete. Some of the 
-                # dictionaries access in the below parsing function are empty or are missing data.
-                # In that case, sleep and retry.
-                try:
+    # Query the data source for a single inverter
+    async def query_inverter(self, sn):
+        return await self.source.read(sn)
+
+    # Parse the API results of the inverters polled in a cycle and publish the resulting snapshot.
+    # Inverters not due for polling are part of the snapshot with their last sample
+    #
+    # Parameters
+    #   :results:   the API responses by inverter serial number
+    def process_cycle(self, results):
+        # Reset metrics for this run
+        self.stats = Stats()
+        self.line_stats = []
+        self.upload_times = []
+        prev_quality, self.inverter_quality = self.inverter_quality, {}
+        self.metrics.inc('cycles_total')
+
+        for sn in self.inverter_sns.values():
+            if sn not in results:
+                if sn in self.samples:
+                    self.inverter_quality[sn] = prev_quality[sn]
+                    self.line_stats += add_sample(self.stats, self.samples[sn])
+                continue
+
+            result_dict = results[sn]
+            if self.test:
+                print(result_dict)
+
+            # The data coming back from the Solax API is sometimes incomplete. The response is
+            # missing, its result is empty or fields are missing or null. Carry the inverter
+            # forward with its last good data in that case and go on with the others.
+            try:
+                with self.metrics.timer('parse_seconds'):
                     self.parse_api_data(result_dict['result'], sn)
-                except:
-                    sleep(self.settings['QUERY_FREQUENCY'])
-                    break
+            except (KeyError, TypeError, ValueError) as e:
+                self.metrics.inc('inverter_errors_total', labels={'sn': sn})
+                if self.test:
+                    print(f"Incomplete data of inverter {sn}:", repr(e))
+                self.carry_inverter(sn)
+
+        # Changes of the inverters get out right away, even if the snapshot doesn't
+        if self.events is not None:
+            self.publish_events()
+
+        # Nothing to publish if none of the inverters delivered usable data
+        if not any(not q[1] & MISSING for q in self.inverter_quality.values()):
+            self.metrics.inc('cycles_aborted_total')
+            return
+
+        # Power to grid today is not something delivered by the API. The energy accounting
+        # compiles it
+        self.account_energy()
 
-            # Only execute this part if we didn't break out of the for loop, i.e. if we were able
-            # to properly parse the API data
+        self.stats.derive()
+        self.stats.interval = self.cycle_ts - self.prev_cycle_ts if self.prev_cycle_ts is not None \
+            else min(self.scheduler.intervals.values())
+        self.prev_cycle_ts = self.cycle_ts
+
+        with self.metrics.timer('publish_seconds'):
+            self.publish_snapshot()
+
+    # Diff the state of the inverters against the previous cycle and publish the changes as events
+    # (see events.py), each to <EVENT_TOPIC>[/<site>]/<sn>/<kind>[/<line>] as compact JSON, retained
+    # and with QoS EVENT_QOS. Inverters without a usable reading, carried forward or not, count as
+    # unavailable
+    def publish_events(self):
+        inverters = {}
+        for sn in self.inverter_sns.values():
+            quality = self.inverter_quality.get(sn)
+            usable = quality is not None and not quality[1] & (CARRIED | MISSING)
+            status = self.inverters.get(sn, {}).get('status') if usable else None
+            inverters[sn] = (status, self.samples.get(sn))
+        events = self.events.detect(self.cycle_ts, inverters)
+        if not events:
+            return
+
+        self.state.set('events', self.events.state())
+        prefix = [self.settings['EVENT_TOPIC']] + ([self.site] if self.site is not None else [])
+        for key, event in events:
+            if self.site is not None:
+                event['site'] = self.site
+            topic = '/'.join(prefix + list(key))
+            msg = json_dumps(event, separators=(',', ':'))
+            if self.test:
+                print(topic, msg)
             else:
-                # Power to grid today is not something delivered by the API. The function tries to
-                # compile it
-                self.set_to_grid_today()
-
-                # Trying to compile power delivered to wallbox. Doesn't work the way it is done here,
-                # unfortunately. The Solax app has this information and seems to get it from the
-                # wallbox directly but there doesn't seem to be an API for that
-                self.stats.to_house = self.stats.ac_power - self.stats.to_grid
-                self.stats.to_wallbox = self.stats.sol_pwr - self.stats.to_bat - self.stats.to_house
-                if self.stats.to_wallbox < 0.0:
-                    self.stats.to_wallbox = 0.0
+                self.mqtt.publish_message(topic, msg, qos=self.settings.get('EVENT_QOS', 1), retain=True)
 
-                if self.test:
-                    self.stats.show()
-                else:
-                    # Publish the metrics data to the mqtt broker
-                    self.stats.publish(lambda k, v: self.mqtt.publish(self.settings['TOPIC'], k, v))
+    # Publish the last snapshot of the persisted state right at startup, so consumers of the topic
+    # and the live data API have the latest values without waiting for the first poll. It is sent
+    # as one line protocol message with its original timestamp, so InfluxDB ends up with the point
+    # it already has. Snapshots older than CARRY_FOR are left alone
+    def publish_last_snapshot(self):
+        last = self.state.get('snapshot')
+        if not last or not self.settings.get('STARTUP_SNAPSHOT', True) \
+                or time() - last['ts'] > self.settings.get('CARRY_FOR', 900.0):
+            return
+        if self.live is not None and last['live'] is not None:
+            self.live.update(self.site, last['live'])
+        if self.test:
+            print(last['message'])
+        elif self.settings.get('PUBLISH_RAW', True):
+            self.mqtt.publish_message(self.settings['TOPIC'], last['message'])
+
+    # Print the snapshot of this cycle in test mode, publish it to the mqtt broker otherwise
+    def publish_snapshot(self):
+        rollups = self.aggregate_snapshot()
+        if self.live is not None:
+            self.live.update(self.site, self.live_snapshot())
+        if self.archive is not None:
+            try:
+                self.archive.append(self.snapshot_ts(), self.archive_fields())
+            except OSError as e:
+                print("Failed to archive the snapshot:", e)
+        forecast = self.forecast_snapshot()
+        message = self.snapshot_message()
+        if self.settings.get('STARTUP_SNAPSHOT', True):
+            self.state.set('snapshot', {'ts': self.snapshot_ts(), 'message': message,
+                                        'live': self.live_snapshot() if self.live is not None else None})
+
+        if self.test:
+            self.stats.show()
+            for sn, line, name, p in self.line_stats:
+                print(name + ' :', p)
+            if self.settings.get('DEVICE_SERIES', False):
+                print(self.device_message())
+            for label, start, series in rollups:
+                print(self.rollup_message(label, start, series))
+            if self.energy_buckets:
+                print(self.energy_message())
+            print(self.quality_message())
+            if forecast:
+                print(forecast)
+            return
+
+        # Raw data can be turned off, e.g. when polling a local source every few seconds and only
+        # the rollups should go into InfluxDB
+        if not self.settings.get('PUBLISH_RAW', True):
+            pass
+        elif self.settings.get('BATCH_PUBLISH', False):
+            # Publish the whole snapshot as one line protocol message
+            self.mqtt.publish_message(self.settings['TOPIC'], message)
+        else:
+            # Publish the metrics data to the mqtt broker
+            self.stats.publish(lambda k, v: self.mqtt.publish(self.settings['TOPIC'], k, v, self.tags))
+            for sn, line, name, p in self.line_stats:
+                self.mqtt.publish(self.settings['TOPIC'], name, p, self.tags)
+
+        if self.settings.get('PUBLISH_RAW', True) and self.settings.get('DEVICE_SERIES', False):
+            self.mqtt.publish_message(self.settings.get('DEVICE_TOPIC', DEVICE_TOPIC), self.device_message())
+
+        if self.energy_buckets:
+            self.mqtt.publish_message(self.settings.get('ENERGY_TOPIC', ENERGY_TOPIC), self.energy_message())
+
+        self.mqtt.publish_message(self.settings.get('QUALITY_TOPIC', QUALITY_TOPIC), self.quality_message())
+
+        if forecast:
+            self.mqtt.publish_message(self.settings.get('FORECAST_TOPIC', FORECAST_TOPIC), forecast)
+
+        # Each window length goes to its own topic, e.g. telegraf/solar_rollup/15m
+        for label, start, series in rollups:
+            self.mqtt.publish_message(f"{self.settings.get('ROLLUP_TOPIC', ROLLUP_TOPIC)}/{label}",
+                                      self.rollup_message(label, start, series))
+
+    # Feed the PV power of this cycle, of the site and summed per line name, into the forecaster.
+    # Returns the line protocol message of the new forecast when this completed a forecast step,
+    # None otherwise
+    def forecast_snapshot(self):
+        if self.forecaster is None:
+            return None
+        values = {'sol_pwr': self.stats.sol_pwr}
+        for sn, line, name, p in self.line_stats:
+            values[name] = values.get(name, 0.0) + p
+        if not self.forecaster.add(self.snapshot_ts(), values):
+            return None
+        self.state.set('forecast', self.forecaster.state())
+        return self.forecast_message()
+
+    # Build a line protocol message for the forecast, one line per step and series. The points are
+    # stamped with the start of the step, so every new forecast overwrites the previous one for
+    # the same steps, and tagged with the line name ('total' for the site)
+    def forecast_message(self):
+        ts, power, yields = self.forecaster.predict()
+        lines = []
+        for j, name in enumerate(self.forecaster.names):
+            tags = dict(self.tags, line='total' if name == 'sol_pwr' else name)
+            for i, t in enumerate(ts):
+                fields = {'sol_pwr': round(float(power[i, j]), 1), 'yield_today': round(float(yields[i, j]), 3)}
+                lines.append(line_protocol(fields, tags=tags, ts=float(t), measurement=FORECAST_MEASUREMENT))
+        return '\n'.join(lines)
+
+    # Feed the snapshot of this cycle into the aggregator. Returns the rollups of the windows that
+    # ended with it (see Aggregator.add())
+    def aggregate_snapshot(self):
+        if self.aggregator is None:
+            return []
+        samples = [(k, None, v) for k, v in self.stats.items()]
+        samples += [(name, {'sn': sn, 'line': line}, p) for sn, line, name, p in self.line_stats]
+        return self.aggregator.add(self.snapshot_ts(), samples)
+
+    # Build a line protocol message for the rollup of a window. The points are stamped with the start
+    # of the window and tagged with the window length
+    def rollup_message(self, label, start, series):
+        return '\n'.join(line_protocol(fields, tags=dict(tags, window=label, **self.tags), ts=start,
+                                       measurement=ROLLUP_MEASUREMENT) for tags, fields in series)
+
+    # Publish the client's own metrics as the 'solax_client' measurement to METRICS_TOPIC, one line
+    # per label set (e.g. per inverter)
+    def publish_metrics(self):
+        if self.mqtt is not None and self.mqtt.spool is not None:
+            self.metrics.set('spool_queued', self.mqtt.spool.queued)
+            self.metrics.set('spool_replayed', self.mqtt.spool.replayed)
+            self.metrics.set('spool_dropped', self.mqtt.spool.dropped)
+            self.metrics.set('spool_bytes', self.mqtt.spool.size())
+
+        if self.test or 'METRICS_TOPIC' not in self.settings:
+            return
+
+        lines = [line_protocol(fields, tags=labels, measurement=self.metrics.prefix)
+                 for labels, fields in self.metrics.series()]
+        self.mqtt.publish_message(self.settings['METRICS_TOPIC'], '\n'.join(lines))
+
+    # The snapshot of this cycle as served by the live data API (see live.py)
+    def live_snapshot(self):
+        inverters = {}
+        for sn, (available, flags, repaired, age) in self.inverter_quality.items():
+            inverters[sn] = {'status': self.inverters.get(sn, {}).get('status'), 'available': available,
+                             'flags': flags, 'age': age, 'interval': self.scheduler.intervals.get(sn)}
+        return {
+            'ts': self.snapshot_ts(),
+            'site': self.site,
+            'metrics': dict(self.stats.items()),
+            'lines': [{'sn': sn, 'line': line, 'name': name, 'power': p} for sn, line, name, p in self.line_stats],
+            'inverters': inverters
+        }
+
+    # The snapshot of this cycle as columns of the archive (see archive.py)
+    def archive_fields(self):
+        fields = dict(self.stats.items())
+        for sn, line, name, p in self.line_stats:
+            fields[line_column(name, sn, line)] = p
+        return fields
+
+    # The timestamp of the current snapshot. With PUBLISH_TIMESTAMP set to "upload" this is the
+    # latest upload time reported by the API for the inverters of this cycle. Otherwise, or if the
+    # API didn't report any, it is the start time of the cycle.
+    def snapshot_ts(self):
+        if self.settings.get('PUBLISH_TIMESTAMP', 'cycle') == 'upload' and self.upload_times:
+            return max(self.upload_times)
+        return self.cycle_ts
+
+    # Build a single InfluxDB line protocol message for the snapshot of this cycle. The first line
+    # carries the site wide metrics, followed by one line per mapped inverter line tagged with the
+    # inverter serial number and the line name. All lines share the same timestamp so the points of
+    # a snapshot line up in InfluxDB.
+    def snapshot_message(self):
+        ts = self.snapshot_ts()
+        lines = [self.stats.to_line(ts, self.tags)]
+        for sn, line, name, p in self.line_stats:
+            lines.append(line_protocol({name: float(p)}, tags=dict(self.tags, sn=sn, line=line), ts=ts))
+        return '\n'.join(lines)
+
+    # Build a line protocol message with the per device series of this cycle's snapshot (see
+    # DEVICE_MEASUREMENT), taken from the samples of the inverters that make up the snapshot. All
+    # lines share the timestamp of the snapshot
+    def device_message(self):
+        ts = self.snapshot_ts()
+        lines = []
+        for sn, sample in self.samples.items():
+            v = sample.values
+            fields = {k: v[i] for k, i in INVERTER_FIELDS}
+            fields['sol_pwr'] = 0.0
+            strings = []
+            for i, line, name in sample.schema.lines:
+                if v[i] == v[i]:
+                    fields['sol_pwr'] += v[i]
+                    tags = dict(self.tags, device='string', sn=sn, line=line)
+                    if name is not None:
+                        tags['name'] = name
+                    strings.append(line_protocol({'sol_pwr': v[i]}, tags=tags, ts=ts, measurement=DEVICE_MEASUREMENT))
+            lines.append(line_protocol(fields, tags=dict(self.tags, device='inverter', sn=sn), ts=ts,
+                                       measurement=DEVICE_MEASUREMENT))
+            lines += strings
+            battery = {k: v[i] for k, i in BATTERY_FIELDS if v[i] == v[i]}
+            if battery:
+                lines.append(line_protocol(battery, tags=dict(self.tags, device='battery', sn=sn), ts=ts,
+                                           measurement=DEVICE_MEASUREMENT))
+        return '\n'.join(lines)
+
+    def parse_upload_time(self, upload_time):
+        return parse_upload_time(upload_time, self.tz)
 
     # Parses the data we get from the Solax API, compiles some derived matrics and stores the data
-    # in self.stats
+    # in self.stats. Raises KeyError, TypeError or ValueError if the data is incomplete
     #
     # Parameters
     #   :res:   the results from an API query for a given inverter
     #   :sn:    the inverter serial number
     def parse_api_data(self, res, sn):
         # The inverter types and their status
-        self.inverters[sn] = {
+        inverter = {
             'type': self.inverter_types[str(res['inverterType'])],
             'status': self.inverter_codes[str(res['inverterStatus'])]
         }
 
-        # The below metrics are delivered directly through the API but only per inverter. So need
-        # to sum them up over consequtive call of this function
-        self.stats.yield_total += float(res['yieldtotal'])
-        self.stats.yield_today += float(res['yieldtoday'])
-        self.stats.to_grid_total += float(res['feedinenergy'])
-        self.stats.to_grid += float(res['feedinpower'])
-        self.stats.from_grid += float(res['consumeenergy'])
-        self.stats.ac_power += float(res['acpower'])
-        to_bat = res['batPower']
-        if to_bat is not None:
-            self.stats.to_bat += float(to_bat)
-        bat = res['soc']
-        if bat is not None:
-            self.stats.bat_soc += bat
-
-        # The current PV yield is a bit more complicated because each inverter can have multiple
-        # lines connecting it to different PV panel areas. So need to aggregate all this but we
-        # also want to retain the power delivered per line so we can report on that separately
-        lines = [ k for k in res.keys() if k.startswith('powerdc')]
-        for line in lines:
-            p = res[line]
-            if p is not None:
-                # Aggregate line yield into total PV power metric
-                self.stats.sol_pwr += float(p)
-
-                # Determine metric name map for inverter line and publish the metric under that
-                # name seperately
-                k = sn + '/' + line
-                if k in self.inverter_map:
-                    if self.test:
-                        print(self.inverter_map[k] + ' :', p)
-                    else:
-                        self.mqtt.publish(self.settings['TOPIC'], self.inverter_map[k], p)
-                else:
-                    print(f'{k} not found in inverter map {self.inverter_map}')
-
-    # Determine a daily grid feed metric which is not part of the data delivered via the Solax API
-    def set_to_grid_today(self):
-        # We need to roll over at midnight while we aren't sure when we run exactly. The time the
-        # main loop sleeps is configurable and we might be off by an arbitrary amound of seconds
-        # from full minutes
-
-        now = datetime.now()
-        today = now.isocalendar()
-
-        # list with the first few minutes (after midnight) during which we check whether to
-        # initialize the daily grid yield metric. check_period contains a list such as [0, 1] or
-        # [0, 1, 2] enumberating the minutes after midnight during which we run this check. This
-        # is computed from the main look sleep time, i.e. the query frequency
-        check_period = list(range(ceil(self.settings['QUERY_FREQUENCY']/60)+1))
-
-        if now.hour == 0 and now.minute in check_period and not self.midnight_update_done:
-            # We are within the check period and the update hasn't been done yet ==>
-            # Set a midnight metric to the current grid delivery total and store a back-up if it
-            # in case metrics collection gets restarted at some point. We'll use the midnight
-            # metric to compute the daily delivery later
-            self.to_grid_midnight = self.stats.to_grid_total
-            persisted_data = { 'to_grid_midnight' : self.to_grid_midnight, 'date': today }
-            self.bkup.save_backup(persisted_data)
-            self.midnight_update_done = True
-            print('Persisted data at midnight:', persisted_data)
-
-        if self.to_grid_midnight == 0.0 or (self.stats.to_grid_total - self.to_grid_midnight) > self.stats.yield_today:
-            # Trying to do something reasonable in failure cases. self.to_grid_midnight should
-            # only be 0 when we (re)start metrics collection and what we have fed to the grid today
-            # (self.stats.to_grid_total - self.to_grid_midnight)) should never be more than what
-            # we have as PV yield today.
-
-            # In such a case try to load data from backup first
-            persisted_data = self.bkup.load_backup()
-            if 'date' in persisted_data and today != tuple(persisted_data['date']):
-                # Didn't backup today yet, so 'to_grid_midnight' in backup would not be valid for
-                # today
-                persisted_data = {}
-            if 'to_grid_midnight' in persisted_data and \
-               (self.stats.to_grid_total - persisted_data['to_grid_midnight']) <= self.stats.yield_today:
-                # Seems we've got OK data from the backup so let's use it
-                self.to_grid_midnight = persisted_data['to_grid_midnight']
-                print('to_grid_midnight set because its 0 and we got it from the backup:', self.to_grid_midnight)
-            else:
-                # we either have no persisted data or to_grid_midnight is obviously wrong, so set
-                # it such that to_grid_today will result in the maximum possible, which is the PV
-                # yield today
-                self.to_grid_midnight = self.stats.to_grid_total - self.stats.yield_today
-                persisted_data = { 'to_grid_midnight' : self.to_grid_midnight, 'date': today }
-                self.bkup.save_backup(persisted_data)
-                print('Resetting persisted data because it doesnt seem correct:', persisted_data)
-
-        # Now we can set the 'to_grid_today' metric
-        self.stats.to_grid_today = min(self.stats.to_grid_total - self.to_grid_midnight, self.stats.yield_today)
-
-        # The period (i.e. the minutes) after the check period
-        after_check = [check_period[-1]+i+1 for i in check_period]
-        # Reset self.midnight_update_done
-        if now.hour == 0 and now.minute in after_check and self.midnight_update_done:
-            self.midnight_update_done = False
+        # The sample layout of the inverter gets resolved with its first valid reading, and again if
+        # a reading has lines the layout doesn't have
+        schema = self.schemas.get(sn)
+        if schema is None or not schema.covers(res):
+            schema = Schema(sn, res, self.inverter_map)
+        upload_ts = self.parse_upload_time(res.get('uploadTime'))
+
+        # Values out of range or changing faster than they can get replaced by the last good ones
+        sample, flags, repaired = self.quality.check(sn, schema.sample(res), self.cycle_ts, upload_ts)
+        self.schemas[sn] = schema
+        if repaired:
+            self.metrics.inc('repaired_fields_total', repaired, {'sn': sn})
+        if sample is None:
+            raise ValueError(f"required fields of inverter {sn} out of range")
+
+        self.inverters[sn] = inverter
+        if upload_ts is not None:
+            self.upload_times.append(upload_ts)
+        self.last_seen[sn] = {
+            'ts': upload_ts if upload_ts is not None else self.cycle_ts,
+            'counters': {k: sample.get(k) for k in ('yieldtotal', 'feedinenergy', 'consumeenergy')}
+        }
+        age = self.cycle_ts - upload_ts if upload_ts is not None else 0.0
+        self.inverter_quality[sn] = (True, flags, repaired, age)
+        self.samples[sn] = sample
+        self.line_stats += add_sample(self.stats, sample)
+
+        # Work out when to poll the inverter next from what it reports
+        self.scheduler.update(sn, self.cycle_ts, inverter['status'], sample.get('acpower'))
+
+    # Use the last good data of an inverter that didn't deliver usable data this cycle, if it
+    # isn't too old. The snapshot is partial otherwise
+    def carry_inverter(self, sn):
+        sample, flags = self.quality.carry(sn, self.cycle_ts)
+        seen = self.last_seen.get(sn)
+        age = self.cycle_ts - seen['ts'] if seen is not None else 0.0
+        self.inverter_quality[sn] = (False, flags, 0, age)
+        self.samples.pop(sn, None)
+        if sample is not None:
+            self.samples[sn] = sample
+            self.line_stats += add_sample(self.stats, sample)
+
+    # Whether all inverters are part of the snapshot of this cycle, with fresh or carried data
+    def snapshot_complete(self):
+        return all(not q[1] & MISSING for q in self.inverter_quality.values())
+
+    # Account the energy of this cycle's snapshot and derive the daily grid feed metric, which is
+    # not part of the data delivered via the Solax API, from it
+    def account_energy(self):
+        powers = {m: getattr(self.stats, m) for m in ENERGY_POWER_METRICS}
+        # The counters are sums over the inverters, so only complete snapshots can be used
+        counters = {c: getattr(self.stats, c) for c in ENERGY_COUNTERS} if self.snapshot_complete() else None
+        self.energy_buckets = self.energy.add(self.snapshot_ts(), powers, counters)
+
+        # What we fed to the grid today is the increase of the grid feed counter since midnight.
+        # Use the integrated feed-in if we don't have the counter. It can never be more than what
+        # we have as PV yield today
+        today = self.energy.today_counters()
+        if 'to_grid_total' in today:
+            to_grid_today = today['to_grid_total']
+        else:
+            to_grid_today = self.energy.today_energy('to_grid')[0] / 1000.0
+        self.stats.to_grid_today = min(to_grid_today, self.stats.yield_today)
+
+        self.save_state()
+
+    # Journal the state we need to resume after a restart: the energy accounting and when we last
+    # saw each inverter
+    def save_state(self):
+        self.state.update({'energy': self.energy.state(), 'inverters': self.last_seen})
+
+    # Load the persisted state. Backups of older client versions only hold the grid feed counter at
+    # midnight, which is still good as baseline if it is from today
+    def load_state(self):
+        if self.state.get('energy') is not None:
+            self.energy.restore(self.state.get('energy'))
+        elif self.state.get('to_grid_midnight') is not None and \
+             tuple(self.state.get('date', ())) == tuple(datetime.now().isocalendar()):
+            self.energy.set_day_base(time(), {'to_grid_total': self.state.get('to_grid_midnight')})
+        self.last_seen = self.state.get('inverters', {})
+
+    # Build a line protocol message for energy buckets closed in this cycle. Points are stamped
+    # with the start of the bucket and tagged with its period. Daily buckets also carry the
+    # deltas of the API's energy counters and whether they cover the complete day
+    def energy_message(self):
+        lines = []
+        for period, b in self.energy_buckets:
+            fields = {}
+            for m in ENERGY_POWER_METRICS:
+                fields[m + '_pos_wh'] = b['pos'][m]
+                fields[m + '_neg_wh'] = b['neg'][m]
+            if period == '1d':
+                fields.update({c + '_kwh': v for c, v in b['counters'].items()})
+                fields['complete'] = b['complete']
+            lines.append(line_protocol(fields, tags=dict(self.tags, period=period), ts=b['start'],
+                                       measurement=ENERGY_MEASUREMENT))
+        return '\n'.join(lines)
+
+    # Build a line protocol message for the data quality of this cycle. The first line tells how
+    # many inverters delivered usable data and whether the snapshot is complete, followed by a line
+    # per inverter tagged with its serial number, which also carries its poll interval. Stamped
+    # like the snapshot
+    def quality_message(self):
+        ts = self.snapshot_ts()
+        quality = self.inverter_quality
+        fields = {
+            'inverters': len(quality),
+            'available': sum(1 for q in quality.values() if q[0]),
+            'carried': sum(1 for q in quality.values() if q[1] & CARRIED),
+            'complete': self.snapshot_complete()
+        }
+        lines = [line_protocol(fields, tags=self.tags, ts=ts, measurement=QUALITY_MEASUREMENT)]
+        for sn, (available, flags, repaired, age) in quality.items():
+            fields = {'available': available, 'flags': flags, 'repaired': repaired, 'age': age,
+                      'interval': self.scheduler.intervals.get(sn)}
+            lines.append(line_protocol(fields, tags=dict(self.tags, sn=sn), ts=ts,
+                                       measurement=QUALITY_MEASUREMENT))
+        return '\n'.join(lines)
+
         
-        if isfile(ckpt_file):
-            persisted_data = { 'to_grid_midnight' : self.to_grid_midnight, 'date': today }
-            self.bkup.save_backup(persisted_data)
-            print('Data checkpointed on demand:', persisted_data)
+# Settings that are only read at start. Changing them needs a restart of the client
+RESTART_SETTINGS = ('BROKER_HOST', 'BROKER_PORT', 'BACKUP_FILE', 'STATE_COMPACT_EVERY', 'SPOOL', 'SPOOL_DIR',
+                    'SPOOL_MAX_MB', 'SPOOL_SEGMENT_KB', 'SPOOL_FSYNC_BATCH', 'MQTT_MAX_QUEUED', 'MQTT_QOS',
+                    'METRICS_PORT', 'LIVE_PORT', 'LIVE_HISTORY', 'ARCHIVE_DIR',
+                    'ARCHIVE_BLOCK_ROWS', 'SHARDS', 'SITES_DIR', 'TIMEZONE')
+
+# Runs the collection for the given sites in this process. All sites share the mqtt connection, the
+# spool, the registry for the client's own metrics and, per Solax token, the rate limiter. Each
+# site has its own state.
+#
+# The client env file, the inverter line file and the site files in SITES_DIR get checked for
+# changes every RELOAD_INTERVAL seconds while we run. Changed settings, inverters and line names get
+# swapped into the running sites, and sites get started or stopped as they get added or removed,
+# without losing state, counters or connections. A config that fails to load is reported and the
+# current one kept.
+class Worker:
+    def __init__(self, env, sites, test, shard=None, shards=1):
+        # Params:
+        #   :env:       The parsed contents of the client environment file
+        #   :sites:     Dict of site name to site env (see sites.load_sites()). A single site named
+        #               None is the classic single site mode
+        #   :test:      Using the app in test mode (True) or not
+        #   :shard:     Number of the worker process if sites are sharded over several, None otherwise
+        #   :shards:    Number of worker processes
+        self.env = env
+        self.test = test
+        self.shard = shard
+        self.ring = hash_ring(shards) if shard is not None else None
+
+        # Store for the client's derived state. The spool keeps its replay offset in it as well
+        settings = env['settings']
+        self.state = StateStore(shard_path(settings['BACKUP_FILE'], shard),
+                                compact_every=settings.get('STATE_COMPACT_EVERY', 1000))
+
+        # Initialize mqtt connection
+        if test:
+            self.mqtt = None
+        else:
+            spool = None
+            if settings.get('SPOOL', False):
+                # Spool for messages the broker cannot take. Lives next to the backup file by default
+                spool = Spool(shard_path(settings.get('SPOOL_DIR', join(dirname(settings['BACKUP_FILE']), 'spool')), shard),
+                              max_bytes=settings.get('SPOOL_MAX_MB', 100) * 1024 * 1024,
+                              segment_bytes=settings.get('SPOOL_SEGMENT_KB', 1024) * 1024,
+                              fsync_batch=settings.get('SPOOL_FSYNC_BATCH', 10), state=self.state)
+            self.mqtt = Mqtt(settings['BROKER_HOST'], settings['BROKER_PORT'], spool=spool,
+                             max_queued=settings.get('MQTT_MAX_QUEUED', 0), qos=settings.get('MQTT_QOS', 0),
+                             client_id=shard_path(client_id, shard))
+            self.mqtt.connect_mqtt()
+            self.mqtt.client.loop_start()
+            # The broker is usually up right away. Messages published before the connection is up
+            # would go to the spool and only get replayed with the next cycle
+            if spool is not None:
+                self.mqtt.wait_connected(settings.get('MQTT_CONNECT_WAIT', 1.0))
+
+        # Sites sharing a Solax token share its quota, so the cycle interval of each of them depends
+        # on the number of inverters over all of them
+        self.metrics = Metrics()
+        self.limiters = {}
+
+        # Live data API serving the latest snapshots right from memory. Workers use consecutive ports
+        self.live = None
+        self.live_server = None
+        if settings.get('LIVE_PORT', 0):
+            self.live = LiveCache(history=settings.get('LIVE_HISTORY', 360))
+            self.live_server = LiveServer(self.live, settings['LIVE_PORT'] + (shard or 0))
+
+        token_inverters = self.token_inverters(sites)
+        self.solaxes = {}
+        self.tasks = {}
+        for name, site_env in sites.items():
+            self.add_site(name, site_env, token_inverters)
+
+        watched = [env_file, inverter_line_file]
+        if settings.get('SITES_DIR'):
+            watched.append(settings['SITES_DIR'])
+        self.watcher = ConfigWatcher(watched)
+
+    # Number of inverters per Solax token over the given sites
+    @staticmethod
+    def token_inverters(sites):
+        return Counter(e['settings'].get('TOKEN') for e in sites.values() for _ in e['inverter_sns'])
+
+    def add_site(self, name, site_env, token_inverters, inverter_map=None):
+        site_metrics = self.metrics if name is None else LabelledMetrics(self.metrics, {'site': name})
+        source = make_source(site_env, site_metrics, self.limiters, token_inverters[site_env['settings'].get('TOKEN')])
+        self.solaxes[name] = Solax(site_env, self.mqtt, self.test, self.state if name is None else None,
+                                   site=name, metrics=site_metrics, source=source, inverter_map=inverter_map,
+                                   live=self.live)
+
+    def remove_site(self, name):
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+        solax = self.solaxes.pop(name)
+        solax.source.close()
+        if solax.archive is not None:
+            solax.archive.close()
+        if name is not None:
+            solax.state.close()
+
+    def start_site(self, name):
+        self.solaxes[name].publish_last_snapshot()
+        self.tasks[name] = asyncio.create_task(self.solaxes[name].poll_loop())
+
+    # Run all sites until one of them fails, checking the config files for changes in between
+    async def run(self):
+        if self.live_server is not None:
+            await self.live_server.start()
+        for name in self.solaxes:
+            self.start_site(name)
+
+        interval = self.env['settings'].get('RELOAD_INTERVAL', 10)
+        while True:
+            if not self.tasks:
+                await asyncio.sleep(interval or 10)
+            else:
+                done, _ = await asyncio.wait(self.tasks.values(), timeout=interval or None,
+                                             return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    task.result()
+            if interval and self.watcher.changed():
+                self.reload()
+
+    # Load the changed config files and apply them to the running sites
+    def reload(self):
+        try:
+            with open(env_file, "rb") as f:
+                env = toml_load(f)
+            inverter_map = parse_inverter_line_file(inverter_line_file)
+            sites = load_sites(env) or {None: env}
+        except (OSError, ValueError, KeyError) as e:
+            print("Not reloading the config, it failed to load:", e)
+            return
+
+        # Single and multi-site mode use the state differently, so switching needs a restart
+        if (None in sites) != (None in self.solaxes):
+            print("Switching between single and multi-site mode needs a restart of the client")
+            return
+        if self.ring is not None:
+            sites = {name: e for name, e in sites.items() if shard_for(self.ring, shard_key(name, e)) == self.shard}
+        changed = [k for k in RESTART_SETTINGS if env['settings'].get(k) != self.env['settings'].get(k)]
+        if changed:
+            print(f"Changes of {', '.join(changed)} need a restart of the client to take effect")
+
+        token_inverters = self.token_inverters(sites)
+        for name in [n for n in self.solaxes if n not in sites]:
+            print(f"Stopping site {name}")
+            self.remove_site(name)
+        for name, site_env in sites.items():
             try:
-                file_remove(ckpt_file)
-            except:
-                pass
+                if name in self.solaxes:
+                    self.solaxes[name].configure(site_env, inverter_map, limiters=self.limiters,
+                                                 token_inverters=token_inverters[site_env['settings'].get('TOKEN')])
+                else:
+                    print(f"Starting site {name}")
+                    self.add_site(name, site_env, token_inverters, inverter_map)
+                    self.start_site(name)
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Keeping the current config of site {name}, the new one is invalid:", repr(e))
+        self.env = env
+        print(f"Reloaded {env_file} and {inverter_line_file}")
+
+    def close(self):
+        for task in self.tasks.values():
+            task.cancel()
+        if self.live_server is not None:
+            self.live_server.close()
+        for solax in self.solaxes.values():
+            solax.source.close()
+            if solax.archive is not None:
+                solax.archive.close()
+        if not self.test:
+            self.mqtt.close()
+        for name, solax in self.solaxes.items():
+            if name is not None:
+                solax.state.close()
+        self.state.close()
+
+
+# Run the collection for the given sites in this process. See Worker
+def run_worker(env, sites, test, shard=None, shards=1):
+    # Docker stops the client with SIGTERM. Turn that into a regular exit so we shut down cleanly
+    # and don't lose spooled messages
+    signal(SIGTERM, lambda signum, frame: sys_exit(0))
+
+    worker = Worker(env, sites, test, shard, shards)
+
+    # Serve the client's own metrics on /metrics if configured. Workers use consecutive ports
+    if env['settings'].get('METRICS_PORT', 0):
+        MetricsServer(worker.metrics, env['settings']['METRICS_PORT'] + (shard or 0)).start()
+    try:
+        asyncio.run(worker.run())
+    finally:
+        worker.close()
 
-        
 # Main function
 def run():
     if getenv("CLIENT_TEST") == '1':
@@ -381,20 +1488,31 @@ def run():
     with open(env_file, "rb") as f:
         env = toml_load(f)
 
-    # Initialize mqtt connection
-    if test:
-        mqtt = None
-    else:
-        mqtt = Mqtt(env['settings']['BROKER_HOST'], env['settings']['BROKER_PORT'])
-        mqtt.connect_mqtt()
-        mqtt.client.loop_start()
+    # Without sites configured we collect the data of a single site, as always
+    sites = load_sites(env)
+    if not sites:
+        run_worker(env, {None: env}, test)
+        return
+
+    shards = env['settings'].get('SHARDS', 1)
+    if shards <= 1:
+        run_worker(env, sites, test)
+        return
 
-    # Collect and publish metrics in a loop
-    solax = Solax(env, mqtt, test)
-    solax.loop_over_inverters()
+    # Spread the sites over worker processes by consistent hashing of their tokens, or names
+    from multiprocessing import Process
+    ring = hash_ring(shards)
+    workers = []
+    for shard in range(shards):
+        shard_sites = {name: e for name, e in sites.items() if shard_for(ring, shard_key(name, e)) == shard}
+        print(f"Worker {shard}: {len(shard_sites)} sites")
+        workers.append(Process(target=run_worker, args=(env, shard_sites, test, shard, shards)))
+        workers[-1].start()
 
-    if not test:
-        mqtt.client.loop_stop()
+    # Pass SIGTERM on to the workers so they shut down cleanly
+    signal(SIGTERM, lambda signum, frame: [w.terminate() for w in workers])
+    for w in workers:
+        w.join()
 
 
 if __name__ == '__main__':
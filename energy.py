@@ -0,0 +1,192 @@
+# Incremental energy accounting for the Solax PV monitoring client.
+#
+# Integrates instantaneous power values (W) between samples into energy counters (Wh) per 15
+# minutes, hour and day. Buckets follow the local calendar of the site, i.e. days start at local
+# midnight, and roll over at whatever time the first sample after a boundary arrives. Samples
+# spanning a boundary get split at the boundary. Timezones and DST are handled via zoneinfo, so a
+# day can have 23 or 25 hours.
+#
+# Positive and negative power get accounted separately (e.g. 'to_grid' is positive when feeding
+# into the grid and negative when drawing from it), with an interpolated zero crossing.
+#
+# Next to the integration the daily deltas of the cumulative energy counters the API delivers (e.g.
+# 'to_grid_total') are tracked. They are the reference: if we saw the day start, i.e. the client was
+# running over midnight, the counter deltas are exact. Otherwise they cover the part of the day
+# since the first sample and are flagged as incomplete.
+
+from datetime import datetime, timedelta, time as dt_time
+
+# Length of the sub-day buckets in seconds
+SUBDAY_PERIODS = {'15m': 900, '1h': 3600}
+
+
+# Trapezoid rule split by sign: returns the (positive, negative) energy in Wh for power going
+# linearly from va W at time a to vb W at time b. The negative part is returned as a positive value
+def signed_trapezoid(a, va, b, vb):
+    if va >= 0 and vb >= 0:
+        return (va + vb) / 2.0 * (b - a) / 3600.0, 0.0
+    if va <= 0 and vb <= 0:
+        return 0.0, -(va + vb) / 2.0 * (b - a) / 3600.0
+    # Sign change: split at the zero crossing
+    z = a + (b - a) * va / (va - vb)
+    e1 = va / 2.0 * (z - a) / 3600.0
+    e2 = vb / 2.0 * (b - z) / 3600.0
+    return (e1, -e2) if va > 0 else (e2, -e1)
+
+
+class EnergyAccount:
+    def __init__(self, power_metrics, counters, tz=None, periods=('15m', '1h', '1d'), max_gap=None):
+        # Params:
+        #   :power_metrics: names of the power metrics (W) to integrate
+        #   :counters:      names of the cumulative energy counters (kWh) to track daily deltas of
+        #   :tz:            ZoneInfo of the site, None for the local timezone of the system
+        #   :periods:       buckets to account energy in, any of '15m', '1h' and '1d'
+        #   :max_gap:       don't integrate between samples further apart than this many seconds
+        self.power_metrics = list(power_metrics)
+        self.counters = list(counters)
+        self.tz = tz
+        self.periods = list(periods)
+        self.max_gap = max_gap
+
+        # Open buckets per period: {'start': .., 'end': .., 'pos': {metric: Wh}, 'neg': {metric: Wh}}
+        self.buckets = {}
+        # Last sample: (ts, {metric: W})
+        self.prev = None
+        # Counter values at the start of the current day, whether they are exact (we saw midnight)
+        # and the latest counter values
+        self.day_base = {}
+        self.day_exact = False
+        self.last_counters = {}
+
+    def _local(self, ts):
+        if self.tz is None:
+            return datetime.fromtimestamp(ts).astimezone()
+        return datetime.fromtimestamp(ts, self.tz)
+
+    def _midnight(self, day):
+        if self.tz is None:
+            return datetime.combine(day, dt_time()).timestamp()
+        return datetime.combine(day, dt_time(), tzinfo=self.tz).timestamp()
+
+    # Start and end of the bucket of the given period containing ts
+    def bounds(self, period, ts):
+        local = self._local(ts)
+        if period == '1d':
+            day = local.date()
+            return self._midnight(day), self._midnight(day + timedelta(days=1))
+        length = SUBDAY_PERIODS[period]
+        start = ts - (ts + local.utcoffset().total_seconds()) % length
+        return start, start + length
+
+    def _open(self, period, ts):
+        start, end = self.bounds(period, ts)
+        self.buckets[period] = {'start': start, 'end': end,
+                                'pos': dict.fromkeys(self.power_metrics, 0.0),
+                                'neg': dict.fromkeys(self.power_metrics, 0.0)}
+
+    # Close all buckets ending at or before ts and open the ones containing ts. Returns the closed
+    # buckets as (period, bucket) tuples
+    def _roll(self, ts, continuous):
+        closed = []
+        for period in self.periods:
+            b = self.buckets.get(period)
+            if b is not None and ts < b['end']:
+                continue
+            if b is not None:
+                if period == '1d':
+                    b['counters'] = self.today_counters()
+                    b['complete'] = self.day_exact
+                closed.append((period, b))
+            self._open(period, ts)
+            if period == '1d':
+                # New day. If we have been running across midnight the latest counter values are
+                # the baseline for the day, otherwise the next ones we get
+                self.day_exact = continuous and bool(self.last_counters)
+                self.day_base = dict(self.last_counters) if self.day_exact else {}
+        return closed
+
+    # Boundaries of the buckets of a period strictly between t0 and t1
+    def _boundaries(self, period, t0, t1):
+        cuts = []
+        end = self.bounds(period, t0)[1]
+        while end < t1:
+            cuts.append(end)
+            end = self.bounds(period, end)[1]
+        return cuts
+
+    def _continuous(self, ts):
+        return self.prev is not None and ts > self.prev[0] and \
+            (self.max_gap is None or ts - self.prev[0] <= self.max_gap)
+
+    # Add a sample
+    #
+    # Params:
+    #   :ts:        time of the sample in seconds since the epoch
+    #   :powers:    dict of power metric to value in W
+    #   :counters:  dict of cumulative counter to value in kWh
+    #
+    # Returns the buckets that got closed by this sample as a list of (period, bucket)
+    def add(self, ts, powers, counters=None):
+        closed = []
+        continuous = self._continuous(ts)
+
+        if continuous:
+            t0, p0 = self.prev
+            cuts = sorted({c for period in self.periods for c in self._boundaries(period, t0, ts)})
+            points = [t0] + cuts + [ts]
+            for a, b in zip(points, points[1:]):
+                closed += self._roll(a, True)
+                for m in self.power_metrics:
+                    if p0.get(m) is None or powers.get(m) is None:
+                        continue
+                    va = p0[m] + (powers[m] - p0[m]) * (a - t0) / (ts - t0)
+                    vb = p0[m] + (powers[m] - p0[m]) * (b - t0) / (ts - t0)
+                    pos, neg = signed_trapezoid(a, va, b, vb)
+                    for bucket in self.buckets.values():
+                        bucket['pos'][m] += pos
+                        bucket['neg'][m] += neg
+
+        closed += self._roll(ts, continuous)
+
+        for k, v in (counters or {}).items():
+            if v is None:
+                continue
+            self.last_counters[k] = v
+            self.day_base.setdefault(k, v)
+
+        self.prev = (ts, {m: powers.get(m) for m in self.power_metrics})
+        return closed
+
+    # Deltas of the cumulative counters since the start of the day (or since the first sample of
+    # the day if we didn't see it start) in kWh
+    def today_counters(self):
+        return {k: self.last_counters[k] - self.day_base[k] for k in self.day_base if k in self.last_counters}
+
+    # Integrated energy of the current day in Wh as (positive, negative) for a power metric
+    def today_energy(self, metric):
+        b = self.buckets.get('1d')
+        if b is None:
+            return 0.0, 0.0
+        return b['pos'][metric], b['neg'][metric]
+
+    # Set the counter values at the start of the day containing ts, e.g. from an older backup
+    def set_day_base(self, ts, base):
+        self._open('1d', ts)
+        self.day_base = dict(base)
+        self.day_exact = True
+
+    # State to persist so accounting can resume after a restart
+    def state(self):
+        return {'buckets': self.buckets, 'prev': self.prev, 'day_base': self.day_base,
+                'day_exact': self.day_exact, 'last_counters': self.last_counters}
+
+    def restore(self, state):
+        self.buckets = state.get('buckets', {})
+        for b in self.buckets.values():
+            for m in self.power_metrics:
+                b['pos'].setdefault(m, 0.0)
+                b['neg'].setdefault(m, 0.0)
+        self.prev = tuple(state['prev']) if state.get('prev') else None
+        self.day_base = state.get('day_base', {})
+        self.day_exact = state.get('day_exact', False)
+        self.last_counters = state.get('last_counters', {})
@@ -0,0 +1,120 @@
+# Event detection for the Solax PV monitoring client.
+#
+# The client used to keep the status of the inverters to itself, so a fault only showed up as a
+# drop of power on the dashboards, after the fact. Instead, the state of every inverter gets
+# diffed against the previous cycle and changes become events right away:
+#   - status:   the inverter status (see [inverter_codes]) changed, or the inverter became
+#               unavailable or came back. Fault statuses are flagged as such
+#   - string:   a PV string stopped producing while other strings of the site produce, or it
+#               recovered
+#   - soc:      the state of charge of a battery crossed one of the thresholds
+# Events are small JSON objects, published by the client to a topic per inverter and kind of
+# event with QoS 1 and retained, so the topic always holds the current state and consumers get it
+# as soon as they subscribe. Nothing needs to scan InfluxDB for it.
+#
+# The state is kept per inverter as plain dicts, so it can be journaled in the state store and
+# there are no spurious events after a restart.
+
+from bisect import bisect_right
+
+# Status of an inverter without a usable reading (see quality.MISSING)
+UNAVAILABLE = "Unavailable"
+
+
+class EventDetector:
+    def __init__(self, fault_statuses=("Fault Mode", "Permanent Fault Mode"), soc_thresholds=(10.0, 20.0, 90.0),
+                 soc_hysteresis=1.0, string_min_power=5.0, string_sibling_power=200.0):
+        # Params:
+        #   :fault_statuses:        inverter statuses that are faults
+        #   :soc_thresholds:        states of charge (%) crossing which is an event
+        #   :soc_hysteresis:        percent the state of charge has to get past a threshold to
+        #                           cross it again, so it doesn't flap
+        #   :string_min_power:      power (W) below which a string counts as not producing
+        #   :string_sibling_power:  power (W) another string has to produce for a string that
+        #                           doesn't produce to count as down rather than dark
+        self.fault_statuses = set(fault_statuses)
+        self.soc_thresholds = sorted(soc_thresholds)
+        self.soc_hysteresis = soc_hysteresis
+        self.string_min_power = string_min_power
+        self.string_sibling_power = string_sibling_power
+        # Per inverter: its 'status', the 'down' strings and the 'soc' with its 'band', the number
+        # of thresholds at or below it
+        self.inverters = {}
+
+    # Diff the inverters of a cycle against the previous one. Returns the events as list of
+    # (<key>, <event>) with key (<sn>, <kind>[, <line>]) and the event as dict
+    #
+    # Params:
+    #   :ts:        timestamp of the cycle
+    #   :inverters: dict of sn to (<status>, <sample>), status None if the inverter has no usable
+    #               reading this cycle. Its sample, e.g. one carried forward, gets ignored then
+    def detect(self, ts, inverters):
+        events = []
+
+        # The strings of the site and their power, to tell a string that is down from darkness
+        strings = []
+        for sn, (status, sample) in inverters.items():
+            if status is not None and sample is not None:
+                v = sample.values
+                strings += [(sn, line, name, v[i]) for i, line, name in sample.schema.lines if v[i] == v[i]]
+        producing = sum(1 for _, _, _, p in strings if p >= self.string_sibling_power)
+
+        for sn, (status, sample) in inverters.items():
+            state = self.inverters.setdefault(sn, {'status': None, 'down': [], 'soc': None, 'band': None})
+            status = status if status is not None else UNAVAILABLE
+            if status != state['status']:
+                events.append(((sn, 'status'), {'ts': ts, 'sn': sn, 'kind': 'status', 'from': state['status'],
+                                                 'to': status, 'fault': status in self.fault_statuses}))
+                state['status'] = status
+            if sample is None or status == UNAVAILABLE:
+                continue
+
+            soc = sample.get('soc')
+            if soc == soc:
+                band = self._band(soc, state['band'])
+                if band != state['band']:
+                    events.append(((sn, 'soc'), {'ts': ts, 'sn': sn, 'kind': 'soc', 'soc': soc,
+                                                  'previous': state['soc'], **self._bounds(band)}))
+                    state['band'] = band
+                state['soc'] = soc
+
+        for sn, line, name, p in strings:
+            state = self.inverters[sn]
+            # A string is down if it doesn't produce while another one does
+            down = p < self.string_min_power and producing > 0
+            if down != (line in state['down']):
+                events.append(((sn, 'string', line), {'ts': ts, 'sn': sn, 'kind': 'string', 'line': line,
+                                                       'name': name, 'state': 'down' if down else 'up',
+                                                       'power': p}))
+                if down:
+                    state['down'].append(line)
+                else:
+                    state['down'].remove(line)
+
+        return events
+
+    # Number of thresholds at or below the state of charge, staying at 'band' within the hysteresis
+    def _band(self, soc, band):
+        new = bisect_right(self.soc_thresholds, soc)
+        if band is None or band > len(self.soc_thresholds) or new == band:
+            return new
+        if new < band and soc > self.soc_thresholds[band - 1] - self.soc_hysteresis:
+            return band
+        if new > band and soc < self.soc_thresholds[band] + self.soc_hysteresis:
+            return band
+        return new
+
+    # The thresholds around a band, None beyond the outermost ones
+    def _bounds(self, band):
+        return {'above': self.soc_thresholds[band - 1] if band > 0 else None,
+                'below': self.soc_thresholds[band] if band < len(self.soc_thresholds) else None}
+
+    # Forget about inverters that are gone
+    def retain(self, sns):
+        self.inverters = {sn: v for sn, v in self.inverters.items() if sn in sns}
+
+    def state(self):
+        return self.inverters
+
+    def restore(self, state):
+        self.inverters = {sn: dict(v) for sn, v in state.items()}
@@ -0,0 +1,292 @@
+# Short-term PV forecast for the Solax PV monitoring client.
+#
+# Forecasts the PV power of the site ('sol_pwr') and of each inverter line of the inverter line map
+# for the next hours, e.g. to schedule charging the battery or a car. Runs offline, from the data
+# the client collects. For every series, the power is modelled as
+#     clear-sky irradiance  x  envelope  x  clear-sky index
+#   - the clear-sky irradiance follows from the position of the sun at the site (Haurwitz model)
+#   - the envelope is the highest power per W/m2 clear-sky irradiance seen recently at that time of
+#     day. It captures the size, orientation and shading of the panels. It decays slowly (half-life
+#     'envelope_days'), so it follows soiling and the seasonal change of shading
+#   - the clear-sky index (how much of the envelope is reached, i.e. the clouds) is its seasonal
+#     mean at that time of day (over about 'seasonal_days'), corrected by persistence: the
+#     deviation of the latest step from its mean carries over into the next steps, with a weight
+#     per horizon fitted by least squares on the history
+# The data gets averaged over steps of 'step' seconds. Each completed step updates all series and
+# horizons at once with a few vectorized NumPy operations, nothing gets refitted. fit() runs the
+# same model over a history, e.g. from the local archive, a day at a time.
+#
+# Needs NumPy, which the client only imports with FORECAST turned on.
+
+from datetime import datetime
+from math import floor
+
+import numpy as np
+
+# Clear-sky irradiance (W/m2) below which the sun is too low to learn from
+CS_MIN = 20.0
+
+# Upper bound of the clear-sky index. Broken clouds can reflect more light onto the panels than a
+# clear sky
+KC_MAX = 1.3
+
+# Weight of the prior persistence, exp(-horizon / tau), against the fitted one
+RIDGE = 5.0
+
+
+# Clear-sky global horizontal irradiance in W/m2 at the given times (seconds since the epoch) and
+# coordinates. The position of the sun is computed with the low precision formulas of the
+# Astronomical Almanac, the irradiance with the Haurwitz model
+def clear_sky(ts, lat, lon):
+    n = np.asarray(ts, dtype=float) / 86400.0 - 10957.5     # days since J2000
+    mean_lon = np.radians(280.460 + 0.9856474 * n)
+    anomaly = np.radians(357.528 + 0.9856003 * n)
+    ecl = mean_lon + np.radians(1.915) * np.sin(anomaly) + np.radians(0.020) * np.sin(2 * anomaly)
+    obliquity = np.radians(23.439 - 0.0000004 * n)
+    decl = np.arcsin(np.sin(obliquity) * np.sin(ecl))
+    ra = np.arctan2(np.cos(obliquity) * np.sin(ecl), np.cos(ecl))
+    gmst = np.radians((280.46061837 + 360.98564736629 * n) % 360.0)
+    hour_angle = gmst + np.radians(lon) - ra
+    phi = np.radians(lat)
+    cosz = np.sin(phi) * np.sin(decl) + np.cos(phi) * np.cos(decl) * np.cos(hour_angle)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        ghi = 1098.0 * cosz * np.exp(-0.057 / cosz)
+    return np.where(cosz > 0.0, ghi, 0.0)
+
+
+class Forecaster:
+    def __init__(self, lat, lon, tz=None, step=900, horizon=21600, envelope_days=20.0, seasonal_days=14.0,
+                 persistence_days=30.0, tau=10800.0):
+        # Params:
+        #   :lat, lon:          coordinates of the site
+        #   :tz:                ZoneInfo of the site, days (for yield_today) start at its midnight
+        #   :step:              seconds the data gets averaged over and the forecast is given in.
+        #                       Must divide a day
+        #   :horizon:           seconds to forecast ahead
+        #   :envelope_days:     half-life of the envelope in days
+        #   :seasonal_days:     days the seasonal clear-sky index averages over
+        #   :persistence_days:  half-life of the history the persistence weights get fitted on
+        #   :tau:               seconds over which the persistence fades without history
+        self.lat = lat
+        self.lon = lon
+        self.tz = tz
+        self.step = step
+        self.bins = int(86400 // step)
+        self.horizons = max(1, int(horizon // step))
+        self.envelope_decay = 0.5 ** (1.0 / envelope_days)
+        self.seasonal_rate = 1.0 / seasonal_days
+        self.decay = 0.5 ** (step / (persistence_days * 86400.0))
+        self.prior = np.exp(-np.arange(1, self.horizons + 1) * step / tau)
+
+        # The model, with a column per series: envelope and seasonal clear-sky index per time of
+        # day, the persistence sums per horizon and the deviations of the clear-sky index from its
+        # seasonal mean of the latest steps, newest first
+        self.names = []
+        self.envelope = np.zeros((self.bins, 0))
+        self.seasonal = np.ones((self.bins, 0))
+        self.sxx = np.zeros((self.horizons, 0))
+        self.sxy = np.zeros((self.horizons, 0))
+        self.hist = np.full((self.horizons, 0), np.nan)
+        self.last_step = None
+        # Energy (Wh) per series of the day of the last step
+        self.energy = np.zeros(0)
+        self.day = None
+        # The step being collected: its start, and sum and count of the values per series
+        self.acc_start = None
+        self.acc_sum = np.zeros(0)
+        self.acc_n = np.zeros(0)
+
+    # Settings the model depends on. Another setting needs another model
+    def params(self):
+        return [self.lat, self.lon, self.step, self.horizons]
+
+    # Columns of the given series, adding new ones
+    def _columns(self, names):
+        new = [k for k in names if k not in self.names]
+        if new:
+            def grow(a, fill):
+                return np.hstack([a, np.full(a.shape[:-1] + (len(new),), fill)])
+
+            self.names += new
+            self.envelope = grow(self.envelope, 0.0)
+            self.seasonal = grow(self.seasonal, 1.0)
+            self.sxx = grow(self.sxx, 0.0)
+            self.sxy = grow(self.sxy, 0.0)
+            self.hist = grow(self.hist, np.nan)
+            self.energy = grow(self.energy, 0.0)
+            self.acc_sum = grow(self.acc_sum, 0.0)
+            self.acc_n = grow(self.acc_n, 0.0)
+        return [self.names.index(k) for k in names]
+
+    def _day(self, ts):
+        return datetime.fromtimestamp(ts, self.tz).date().isoformat()
+
+    # Add the values (W) of a snapshot taken at ts, as dict of series name to value. Returns True
+    # when this completed a step, i.e. there is a new forecast
+    def add(self, ts, values):
+        start = floor(ts / self.step) * self.step
+        if self.acc_start is not None and start < self.acc_start:
+            return False
+        cols = self._columns(list(values))
+
+        ready = False
+        if self.acc_start is not None and start > self.acc_start:
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                self.update(self.acc_start, self.acc_sum / self.acc_n)
+            self.acc_sum[:] = 0.0
+            self.acc_n[:] = 0.0
+            ready = True
+        self.acc_start = start
+        v = np.array([values[k] for k in values], dtype=float)
+        ok = ~np.isnan(v)
+        np.add.at(self.acc_sum, np.array(cols)[ok], v[ok])
+        np.add.at(self.acc_n, np.array(cols)[ok], 1.0)
+        return ready
+
+    # Update the model with the mean power (W) per series of the step starting at t. NaN for
+    # series without data
+    def update(self, t, p):
+        k = 1 if self.last_step is None else max(1, round((t - self.last_step) / self.step))
+        # Deviations of the steps k, k+1, ... steps ago, i.e. the predictors for horizon k, k+1, ...
+        x = np.full_like(self.hist, np.nan)
+        if k <= self.horizons:
+            x[k - 1:] = self.hist[:self.horizons - k + 1]
+
+        day = self._day(t)
+        if day != self.day:
+            self.day = day
+            self.energy[:] = 0.0
+        self.energy += np.nan_to_num(p) * self.step / 3600.0
+
+        b = int(t % 86400 // self.step)
+        cs = float(clear_sky(t + self.step / 2, self.lat, self.lon))
+        dev = np.full(len(p), np.nan)
+        if cs > CS_MIN:
+            ratio = p / cs
+            valid = ~np.isnan(ratio)
+            self.envelope[b] = np.where(valid, np.fmax(self.envelope[b] * self.envelope_decay, ratio),
+                                        self.envelope[b])
+            denom = self.envelope[b] * cs
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                kc = np.where(valid & (denom > 0.0), np.clip(p / denom, 0.0, KC_MAX), np.nan)
+            dev = kc - self.seasonal[b]
+            self.seasonal[b] = np.where(np.isnan(kc), self.seasonal[b], self.seasonal[b] + self.seasonal_rate * dev)
+
+        pair = ~np.isnan(x) & ~np.isnan(dev)
+        self.sxx = self.sxx * self.decay + np.where(pair, x * x, 0.0)
+        self.sxy = self.sxy * self.decay + np.where(pair, x * dev, 0.0)
+        self.hist = np.vstack([dev[None, :], x[:-1]])
+        self.last_step = t
+
+    # Train a new model on a history, e.g. from the local archive. Same as adding its data snapshot
+    # by snapshot, but processed a day at a time
+    #
+    # Params:
+    #   :times:     timestamps of the snapshots in seconds since the epoch, ascending
+    #   :values:    dict of series name to an array of values (W) at these times, NaN if missing
+    def fit(self, times, values):
+        if self.last_step is not None:
+            raise ValueError("Only a new model can be trained on a history")
+        times = np.asarray(times, dtype=float)
+        if not len(times):
+            return
+        cols = self._columns(list(values))
+        data = np.full((len(times), len(self.names)), np.nan)
+        for c, k in zip(cols, values):
+            data[:, c] = np.asarray(values[k], dtype=float)
+
+        # Mean per step on a grid of whole days
+        day0 = floor(times[0] / 86400) * 86400
+        idx = ((times - day0) // self.step).astype(int)
+        n = idx[-1] + 1
+        days = -(-n // self.bins)
+        sums = np.zeros((days * self.bins, len(self.names)))
+        counts = np.zeros_like(sums)
+        ok = ~np.isnan(data)
+        for c in range(len(self.names)):
+            sums[:, c] = np.bincount(idx[ok[:, c]], data[ok[:, c], c], minlength=days * self.bins)
+            counts[:, c] = np.bincount(idx[ok[:, c]], minlength=days * self.bins)
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            p = (sums / counts).reshape(days, self.bins, -1)
+
+        starts = day0 + np.arange(days * self.bins) * self.step
+        cs = clear_sky(starts + self.step / 2, self.lat, self.lon).reshape(days, self.bins)
+        dev = np.full_like(p, np.nan)
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            for d in range(days):
+                sun = (cs[d] > CS_MIN)[:, None]
+                ratio = p[d] / cs[d][:, None]
+                valid = sun & ~np.isnan(ratio)
+                self.envelope = np.where(valid, np.fmax(self.envelope * self.envelope_decay, ratio), self.envelope)
+                denom = self.envelope * cs[d][:, None]
+                kc = np.where(valid & (denom > 0.0), np.clip(p[d] / denom, 0.0, KC_MAX), np.nan)
+                dev[d] = kc - self.seasonal
+                self.seasonal = np.where(np.isnan(kc), self.seasonal, self.seasonal + self.seasonal_rate * dev[d])
+
+        # Persistence sums over all pairs of steps h apart, weighted by their age
+        dev = dev.reshape(-1, len(self.names))[:n]
+        weights = self.decay ** np.arange(n - 1, -1, -1)[:, None]
+        for h in range(1, min(self.horizons, n - 1) + 1):
+            x, y = dev[:-h], dev[h:]
+            pair = ~np.isnan(x) & ~np.isnan(y)
+            self.sxx[h - 1] = np.where(pair, weights[h:] * x * x, 0.0).sum(axis=0)
+            self.sxy[h - 1] = np.where(pair, weights[h:] * x * y, 0.0).sum(axis=0)
+        self.hist[:min(n, self.horizons)] = dev[::-1][:self.horizons]
+        self.last_step = float(day0 + (n - 1) * self.step)
+
+        # Energy of the day of the last step
+        self.day = self._day(self.last_step)
+        lo = max(0, n - self.bins - 1)
+        same_day = np.array([self._day(t) == self.day for t in starts[lo:n]])
+        self.energy = np.nan_to_num(p.reshape(-1, len(self.names))[lo:n])[same_day].sum(axis=0) * self.step / 3600.0
+
+    # Forecast for the steps after the last completed one. Returns (<step starts>, <power>,
+    # <yield today>) with power (W) and the yield of the day by the end of the step (kWh) as arrays
+    # of steps x series (see 'names')
+    def predict(self):
+        if self.last_step is None:
+            return np.zeros(0), np.zeros((0, len(self.names))), np.zeros((0, len(self.names)))
+        ts = self.last_step + self.step * np.arange(1, self.horizons + 1)
+        bins = (ts % 86400 // self.step).astype(int)
+        cs = clear_sky(ts + self.step / 2, self.lat, self.lon)[:, None]
+
+        alpha = np.clip((self.sxy + RIDGE * self.prior[:, None]) / (self.sxx + RIDGE), 0.0, 1.0)
+        kc = self.seasonal[bins] + alpha * np.nan_to_num(self.hist[0])
+        power = np.where(cs > CS_MIN, np.clip(self.envelope[bins] * cs * kc, 0.0, None), 0.0)
+
+        # Yield of the day, starting over at midnight
+        energy = power * self.step / 3600.0
+        total = self.energy.copy()
+        day = self.day
+        yields = np.empty_like(power)
+        for i, t in enumerate(ts):
+            d = self._day(t)
+            if d != day:
+                day = d
+                total = np.zeros_like(total)
+            total = total + energy[i]
+            yields[i] = total / 1000.0
+        return ts, power, yields
+
+    def state(self):
+        return {'params': self.params(), 'names': self.names, 'envelope': self.envelope.tolist(),
+                'seasonal': self.seasonal.tolist(), 'sxx': self.sxx.tolist(), 'sxy': self.sxy.tolist(),
+                'hist': self.hist.tolist(), 'energy': self.energy.tolist(), 'day': self.day,
+                'last_step': self.last_step}
+
+    # Restore a state of a model with the same params. Returns whether it was restored
+    def restore(self, state):
+        if state.get('params') != self.params():
+            return False
+        self.names = list(state['names'])
+        self.envelope = np.array(state['envelope'], dtype=float).reshape(self.bins, -1)
+        self.seasonal = np.array(state['seasonal'], dtype=float).reshape(self.bins, -1)
+        self.sxx = np.array(state['sxx'], dtype=float).reshape(self.horizons, -1)
+        self.sxy = np.array(state['sxy'], dtype=float).reshape(self.horizons, -1)
+        self.hist = np.array(state['hist'], dtype=float).reshape(self.horizons, -1)
+        self.energy = np.array(state['energy'], dtype=float)
+        self.day = state['day']
+        self.last_step = state['last_step']
+        self.acc_sum = np.zeros(len(self.names))
+        self.acc_n = np.zeros(len(self.names))
+        return True
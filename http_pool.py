@@ -0,0 +1,188 @@
+# Minimal HTTP client for the Solax PV monitoring client, on the standard library only.
+#
+# requests (with urllib3, charset_normalizer, idna and certifi) takes longer to import than the rest
+# of the client together, which adds to every restart of the container, and is a dependency the
+# client only needs for a few GET and POST requests. This client covers what the sources use of
+# it: query parameters, form and JSON bodies, (connect, read) timeouts, gzip and keep-alive
+# connections pooled per host. Responses and exceptions look like the ones of requests, so the
+# sources work with either (see make_session()).
+#
+# Connections are taken from the pool by one request at a time, so the session can be used from
+# several threads, e.g. by asyncio.to_thread() of the sources.
+
+from gzip import decompress as gzip_decompress
+from json import dumps as json_dumps, loads as json_loads
+from socket import timeout as socket_timeout
+from threading import Lock
+from types import SimpleNamespace
+from urllib.parse import urlencode, urlsplit
+
+
+class RequestException(OSError):
+    pass
+
+
+class ConnectionError(RequestException):
+    pass
+
+
+class Timeout(RequestException):
+    pass
+
+
+class HTTPError(RequestException):
+    pass
+
+
+# A body that isn't JSON. Also a ValueError, like the one of requests
+class JSONDecodeError(RequestException, ValueError):
+    pass
+
+
+# The exceptions in the layout of requests.exceptions
+exceptions = SimpleNamespace(RequestException=RequestException, ConnectionError=ConnectionError, Timeout=Timeout,
+                             HTTPError=HTTPError, JSONDecodeError=JSONDecodeError)
+
+
+class Response:
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        try:
+            return json_loads(self.content)
+        except ValueError as e:
+            raise JSONDecodeError(f"Invalid JSON from {self.url}: {e}") from e
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError(f"{self.status_code} error for url: {self.url}")
+
+
+class HttpSession:
+    def __init__(self, pool_size=1):
+        # Params:
+        #   :pool_size: Number of idle connections to keep per host
+        # http.client pulls in ssl and email, which take a while to import. Only needed once there
+        # is a session
+        import http.client
+
+        self.http = http.client
+        self.pool_size = max(pool_size, 1)
+        self.idle = {}
+        self.lock = Lock()
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        return self.request('GET', url, params=params, headers=headers, timeout=timeout)
+
+    def post(self, url, params=None, data=None, json=None, headers=None, timeout=None):
+        return self.request('POST', url, params=params, data=data, json=json, headers=headers, timeout=timeout)
+
+    # Send a request and read the whole response. A kept-alive connection the server closed in the
+    # meantime gets replaced by a new one once
+    #
+    # Params:
+    #   :timeout:   seconds to wait for connecting and for each read, or a tuple (<connect>, <read>)
+    def request(self, method, url, params=None, data=None, json=None, headers=None, timeout=None):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        if params:
+            path += ('&' if parts.query else '?') + urlencode({k: v for k, v in params.items() if v is not None})
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+
+        send_headers = {'Accept-Encoding': 'gzip', 'Accept': '*/*', 'Connection': 'keep-alive'}
+        body = None
+        if json is not None:
+            body = json_dumps(json).encode()
+            send_headers['Content-Type'] = 'application/json'
+        elif isinstance(data, dict):
+            body = urlencode(data).encode()
+            send_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif data is not None:
+            body = data.encode() if isinstance(data, str) else data
+        send_headers.update(headers or {})
+
+        while True:
+            conn, reused = self._connection(key, connect_timeout)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(read_timeout)
+                conn.request(method, path, body=body, headers=send_headers)
+                response = conn.getresponse()
+                content = response.read()
+            except (socket_timeout, TimeoutError) as e:
+                conn.close()
+                raise Timeout(f"{method} {url} timed out: {e}") from e
+            except (OSError, self.http.HTTPException) as e:
+                conn.close()
+                if reused:
+                    continue
+                raise ConnectionError(f"{method} {url} failed: {e!r}") from e
+
+            if response.getheader('Content-Encoding', '').lower() == 'gzip':
+                content = gzip_decompress(content)
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            return Response(url, response.status, dict(response.getheaders()), content)
+
+    # An idle connection to the host, or a new one. Returns (<connection>, <whether it was idle>)
+    def _connection(self, key, timeout):
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            return self.http.HTTPSConnection(host, port, timeout=timeout), False
+        if scheme == 'http':
+            return self.http.HTTPConnection(host, port, timeout=timeout), False
+        raise RequestException(f"Unsupported URL scheme '{scheme}'")
+
+    def _release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+
+# Session for the HTTP_CLIENT setting: "requests" for a requests session with a pool of
+# 'pool_size' connections, "stdlib" for an HttpSession. Without a setting requests gets used if it
+# is installed. Returns (<session>, <exceptions>) with the exceptions as in requests.exceptions.
+# requests only gets imported here, so it doesn't slow down starting the client unless it is used
+def make_session(kind=None, pool_size=1):
+    if kind not in (None, 'requests', 'stdlib'):
+        raise ValueError(f"Unknown HTTP_CLIENT '{kind}'")
+    if kind != 'stdlib':
+        try:
+            from requests import Session, exceptions as req_exceptions
+            from requests.adapters import HTTPAdapter
+        except ImportError:
+            if kind == 'requests':
+                raise ValueError("HTTP_CLIENT 'requests' needs requests, install it with 'pip install requests'")
+        else:
+            session = Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            return session, req_exceptions
+    return HttpSession(pool_size), exceptions
@@ -0,0 +1,202 @@
+# Self-instrumentation for the Solax PV monitoring client.
+#
+# Collects counters, gauges and histograms about what the client is doing (e.g. latency of the
+# Solax API per inverter, time spent parsing and publishing, aborted cycles, rate limit hits). The
+# metrics can be rendered in the Prometheus text format, e.g. for the /metrics endpoint served by
+# MetricsServer, or be turned into series of fields to be published as their own measurement.
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread
+from time import perf_counter
+
+# Default histogram buckets in seconds. Covers fast local stages as well as slow API requests
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Histogram with fixed buckets, Prometheus style
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.last = 0.0
+        self.max = 0.0
+
+    def observe(self, v):
+        self.counts[bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+        self.last = v
+        self.max = max(self.max, v)
+
+
+# Registry of all metrics of the client. Metrics are identified by name and an optional dict of
+# labels, e.g. ('http_request_seconds', {'sn': 'SYABCDEFG'}). Metrics get created on first use.
+class Metrics:
+    def __init__(self, prefix='solax_client'):
+        self.prefix = prefix
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())) if labels else ())
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, labels=None):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    # Context manager timing the enclosed block into a histogram
+    @contextmanager
+    def timer(self, name, labels=None):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, labels)
+
+    # The metrics as series of fields, one per label set:
+    #     [ ( {<label>: <value>, ...}, {<field>: <value>, ...} ), ... ]
+    # Histograms contribute their count, sum, last and max value.
+    def series(self):
+        series = {}
+        with self.lock:
+            for (name, labels), v in self.counters.items():
+                series.setdefault(labels, {})[name] = v
+            for (name, labels), v in self.gauges.items():
+                series.setdefault(labels, {})[name] = v
+            for (name, labels), h in self.histograms.items():
+                fields = series.setdefault(labels, {})
+                fields[name + '_count'] = h.count
+                fields[name + '_sum'] = h.sum
+                fields[name + '_last'] = h.last
+                fields[name + '_max'] = h.max
+        return [(dict(labels), fields) for labels, fields in series.items()]
+
+    # The metrics in the Prometheus text exposition format
+    def prometheus_text(self):
+        out = []
+
+        def labelstr(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+        def header(name, kind):
+            full = f"{self.prefix}_{name}"
+            if name in self.help:
+                out.append(f"# HELP {full} {self.help[name]}")
+            out.append(f"# TYPE {full} {kind}")
+            return full
+
+        with self.lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({n for n, _ in metrics}):
+                    full = header(name, kind)
+                    for (n, labels), v in sorted(metrics.items()):
+                        if n == name:
+                            out.append(f"{full}{labelstr(labels)} {v}")
+
+            for name in sorted({n for n, _ in self.histograms}):
+                full = header(name, 'histogram')
+                for (n, labels), h in sorted(self.histograms.items(), key=lambda i: i[0]):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for le, c in zip(h.buckets, h.counts):
+                        cumulative += c
+                        out.append(f"{full}_bucket{labelstr(labels, [('le', le)])} {cumulative}")
+                    out.append(f"{full}_bucket{labelstr(labels, [('le', '+Inf')])} {h.count}")
+                    out.append(f"{full}_sum{labelstr(labels)} {h.sum}")
+                    out.append(f"{full}_count{labelstr(labels)} {h.count}")
+
+        return '\n'.join(out) + '\n'
+
+
+# View on a registry that adds constant labels to every metric, e.g. the site in multi-site mode.
+# Offers the same interface as the registry, but series() only returns the series of the view.
+class LabelledMetrics:
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+        self.prefix = metrics.prefix
+
+    def _labels(self, labels):
+        return dict(self.labels, **labels) if labels else self.labels
+
+    def describe(self, name, text):
+        self.metrics.describe(name, text)
+
+    def inc(self, name, value=1, labels=None):
+        self.metrics.inc(name, value, self._labels(labels))
+
+    def set(self, name, value, labels=None):
+        self.metrics.set(name, value, self._labels(labels))
+
+    def observe(self, name, value, labels=None):
+        self.metrics.observe(name, value, self._labels(labels))
+
+    def timer(self, name, labels=None):
+        return self.metrics.timer(name, self._labels(labels))
+
+    def series(self):
+        return [(labels, fields) for labels, fields in self.metrics.series()
+                if all(labels.get(k) == v for k, v in self.labels.items())]
+
+    def prometheus_text(self):
+        return self.metrics.prometheus_text()
+
+
+# Lightweight HTTP server exposing the metrics on /metrics in the Prometheus text format. Runs in
+# a daemon thread next to the polling loop. http.server only gets imported if it is served, it
+# takes as long to import as most of the client
+class MetricsServer:
+    def __init__(self, metrics, port, host=''):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] != '/metrics':
+                    handler.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
@@ -0,0 +1,276 @@
+# Live data API of the Solax PV monitoring client.
+#
+# Going through mosquitto, telegraf (which flushes every 10s), InfluxDB and Grafana adds 10-20s to
+# the age of the data, and consumers polling InfluxDB for the latest values load it with queries.
+# The client keeps the latest snapshot of each site and a short history of them in memory instead,
+# and serves them right from the polling loop's event loop:
+#     GET /snapshot[?site=<name>]           the latest snapshot as JSON
+#     GET /history[?n=<count>&site=<name>]  the last n snapshots, oldest first
+#     GET /stream[?site=<name>]             server-sent events, one per new snapshot
+#     GET /ws[?site=<name>]                 WebSocket, one text message per new snapshot
+# Without 'site' the responses cover all sites, keyed by site name, unless there is only one.
+#
+# Snapshots get serialized once when they come in, not per request, and carry an ETag, so polling
+# with If-None-Match costs a 304 without a body until there is a new snapshot. Stream subscribers
+# get a bounded queue each. A subscriber too slow to keep up loses the oldest snapshots rather than
+# holding up the others.
+
+import asyncio
+from base64 import b64encode
+from collections import deque
+from hashlib import sha1
+from json import dumps as json_dumps
+from urllib.parse import urlsplit, parse_qs
+
+# Key to compute the Sec-WebSocket-Accept header from, see RFC 6455
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Max size of a request head and number of snapshots queued per subscriber
+MAX_HEAD = 16384
+QUEUE_SIZE = 16
+
+STATUS_TEXT = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found'}
+
+
+# Latest snapshot and history of one site
+class SiteCache:
+    def __init__(self, history):
+        self.version = 0
+        self.latest = b'null'
+        self.history = deque(maxlen=history)
+
+
+class LiveCache:
+    def __init__(self, history=360):
+        # Params:
+        #   :history:   number of snapshots to keep per site
+        self.history = history
+        self.sites = {}
+        self.subscribers = set()
+
+    # Add the snapshot of a site. Called by the polling loop for every snapshot it publishes
+    #
+    # Params:
+    #   :site:      name of the site, None in single site mode
+    #   :snapshot:  dict to serve as JSON
+    def update(self, site, snapshot):
+        cache = self.sites.get(site)
+        if cache is None:
+            cache = self.sites[site] = SiteCache(self.history)
+        cache.version += 1
+        cache.latest = json_dumps(snapshot, separators=(',', ':')).encode()
+        cache.history.append(cache.latest)
+
+        for site_filter, queue in self.subscribers:
+            if site_filter is not None and site_filter != site:
+                continue
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(cache.latest)
+
+    # The caches a request covers. Raises KeyError for unknown sites
+    def _select(self, site):
+        if site is not None:
+            return {site: self.sites[site]}
+        return self.sites
+
+    def _etag(self, caches, *extra):
+        return '"' + '-'.join([str(c.version) for c in caches.values()] + [str(e) for e in extra]) + '"'
+
+    @staticmethod
+    def _combine(caches, body):
+        if len(caches) == 1:
+            return body(next(iter(caches.values())))
+        return b'{' + b','.join(json_dumps(str(name)).encode() + b':' + body(c) for name, c in caches.items()) + b'}'
+
+    # The latest snapshot as (<etag>, <body>)
+    def snapshot(self, site=None):
+        caches = self._select(site)
+        return self._etag(caches), self._combine(caches, lambda c: c.latest)
+
+    # The last n snapshots as (<etag>, <body>)
+    def last(self, n, site=None):
+        caches = self._select(site)
+
+        def body(c):
+            return b'[' + b','.join(list(c.history)[-n:] if n else []) + b']'
+
+        return self._etag(caches, n), self._combine(caches, body)
+
+    def subscribe(self, site=None):
+        entry = (site, asyncio.Queue(QUEUE_SIZE))
+        self.subscribers.add(entry)
+        return entry
+
+    def unsubscribe(self, entry):
+        self.subscribers.discard(entry)
+
+
+# Serves a LiveCache over HTTP in the running event loop
+class LiveServer:
+    def __init__(self, cache, port, host=''):
+        self.cache = cache
+        self.port = port
+        self.host = host or None
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, limit=MAX_HEAD)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def handle(self, reader, writer):
+        try:
+            # Connections are kept alive for further requests until a stream takes them over
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                method, target, _ = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        k, v = line.split(':', 1)
+                        headers[k.strip().lower()] = v.strip()
+                if not await self.respond(method, target, headers, reader, writer):
+                    break
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def send(writer, status, body=b'', content_type='application/json', etag=None):
+        head = [f"HTTP/1.1 {status} {STATUS_TEXT[status]}", f"Content-Length: {len(body)}"]
+        if status != 304:
+            head.append(f"Content-Type: {content_type}")
+        if etag is not None:
+            head.append(f"ETag: {etag}")
+        head.append("Cache-Control: no-cache")
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+
+    # Answer a request. Returns whether the connection can take further requests
+    async def respond(self, method, target, headers, reader, writer):
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        site = query.get('site', [None])[0]
+        if method != 'GET':
+            self.send(writer, 400, b'{"error":"only GET is supported"}')
+            return False
+        try:
+            if url.path == '/snapshot':
+                etag, body = self.cache.snapshot(site)
+            elif url.path == '/history':
+                etag, body = self.cache.last(max(0, int(query.get('n', [self.cache.history])[0])), site)
+            elif url.path == '/stream':
+                await self.stream(writer, site)
+                return False
+            elif url.path == '/ws':
+                await self.websocket(reader, writer, headers, site)
+                return False
+            else:
+                self.send(writer, 404, b'{"error":"not found"}')
+                return True
+        except KeyError:
+            self.send(writer, 404, b'{"error":"unknown site"}')
+            return True
+        except ValueError:
+            self.send(writer, 400, b'{"error":"n must be a number"}')
+            return True
+
+        if headers.get('if-none-match') == etag:
+            self.send(writer, 304, etag=etag)
+        else:
+            self.send(writer, 200, body, etag=etag)
+        await writer.drain()
+        return True
+
+    # Server-sent events, starting with the latest snapshot
+    async def stream(self, writer, site):
+        entry = self.cache.subscribe(site)
+        try:
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n')
+            if site is None or site in self.cache.sites:
+                writer.write(b'data: ' + self.cache.snapshot(site)[1] + b'\n\n')
+            while True:
+                await writer.drain()
+                writer.write(b'data: ' + await entry[1].get() + b'\n\n')
+        finally:
+            self.cache.unsubscribe(entry)
+
+    # WebSocket (RFC 6455) pushing a text message per snapshot, starting with the latest. Frames
+    # from the client get read meanwhile (see ws_receive()), the connection ends when the client
+    # closes it or writing to it fails
+    async def websocket(self, reader, writer, headers, site):
+        key = headers.get('sec-websocket-key')
+        if headers.get('upgrade', '').lower() != 'websocket' or key is None:
+            self.send(writer, 400, b'{"error":"websocket upgrade expected"}')
+            return
+        accept = b64encode(sha1(key.encode() + WS_GUID).digest()).decode()
+        writer.write(f"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode())
+        entry = self.cache.subscribe(site)
+        receiver = asyncio.ensure_future(ws_receive(reader, writer))
+        try:
+            if site is None or site in self.cache.sites:
+                writer.write(ws_frame(self.cache.snapshot(site)[1]))
+            while not writer.is_closing():
+                await writer.drain()
+                snapshot = asyncio.ensure_future(entry[1].get())
+                await asyncio.wait((snapshot, receiver), return_when=asyncio.FIRST_COMPLETED)
+                if not snapshot.done():
+                    snapshot.cancel()
+                    break
+                writer.write(ws_frame(snapshot.result()))
+            await writer.drain()
+        finally:
+            receiver.cancel()
+            self.cache.unsubscribe(entry)
+
+
+# An unmasked, unfragmented WebSocket frame as sent by servers, a text frame by default
+def ws_frame(payload, opcode=0x1):
+    n = len(payload)
+    if n < 126:
+        head = bytes((0x80 | opcode, n))
+    elif n < 65536:
+        head = bytes((0x80 | opcode, 126)) + n.to_bytes(2, 'big')
+    else:
+        head = bytes((0x80 | opcode, 127)) + n.to_bytes(8, 'big')
+    return head + payload
+
+
+# Read the frames of a WebSocket client until it closes the connection. Pings get answered with a
+# pong and a close gets echoed, anything else gets discarded. Returns when the client closed the
+# connection, went away or sent something that isn't a masked frame, as clients have to send
+async def ws_receive(reader, writer):
+    try:
+        while True:
+            head = await reader.readexactly(2)
+            opcode = head[0] & 0x0f
+            n = head[1] & 0x7f
+            if n == 126:
+                n = int.from_bytes(await reader.readexactly(2), 'big')
+            elif n == 127:
+                n = int.from_bytes(await reader.readexactly(8), 'big')
+            if not head[1] & 0x80 or (opcode & 0x8 and n > 125):
+                writer.write(ws_frame((1002).to_bytes(2, 'big'), opcode=0x8))
+                return
+            mask = await reader.readexactly(4)
+
+            # Control frames are short, data frames get read in chunks and dropped
+            if not opcode & 0x8:
+                while n > 0:
+                    n -= len(await reader.readexactly(min(n, MAX_HEAD)))
+                continue
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(await reader.readexactly(n)))
+            if opcode == 0x8:
+                writer.write(ws_frame(payload[:2], opcode=0x8))
+                return
+            if opcode == 0x9:
+                writer.write(ws_frame(payload, opcode=0xA))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
@@ -0,0 +1,287 @@
+# Local data sources for the Solax PV monitoring client.
+#
+# Instead of going through the Solax cloud (which only allows about one query per minute) these
+# sources read the inverters directly on the local network, either via Modbus TCP or via the local
+# HTTP API of the inverter's WiFi/LAN dongle. Both can be polled every few seconds.
+#
+# The values read get mapped to a dictionary with the same keys the cloud API returns in its
+# 'result' (e.g. 'acpower', 'yieldtoday', 'powerdc1'), so the client parses them exactly like
+# cloud data.
+#
+# Register maps define where to find a value and how to decode it. Each entry is
+#     <api key> = (<register address or Data index>, <type>, <scale>)
+# with type one of 'u16', 's16', 'u32', 's32'. 32 bit values span two registers, low word first
+# (which is how Solax inverters encode them). The defaults below follow the Solax X1/X3-Hybrid G4
+# protocol. Other inverter models may use different addresses. The maps can be overridden in the
+# [local_register_map] section of the client env file.
+
+import asyncio
+from json import loads as json_loads
+from struct import pack, unpack
+from time import perf_counter
+
+from http_pool import make_session
+
+# Input registers (Modbus function 0x04) of Solax X1/X3-Hybrid G4 inverters
+MODBUS_MAP = {
+    'acpower':       (0x0002, 's16', 1),
+    'runmode':       (0x0009, 'u16', 1),
+    'powerdc1':      (0x000A, 'u16', 1),
+    'powerdc2':      (0x000B, 'u16', 1),
+    'batPower':      (0x0016, 's16', 1),
+    'soc':           (0x001C, 'u16', 1),
+    'feedinpower':   (0x0046, 's32', 1),
+    'feedinenergy':  (0x0048, 'u32', 0.01),
+    'consumeenergy': (0x004A, 'u32', 0.01),
+    'yieldtoday':    (0x0050, 'u16', 0.1),
+    'yieldtotal':    (0x0052, 'u32', 0.1),
+}
+
+# Indices into the 'Data' array returned by the dongle's local HTTP API (X1-Hybrid G4)
+LOCAL_HTTP_MAP = {
+    'acpower':       (2, 's16', 1),
+    'powerdc1':      (8, 'u16', 1),
+    'powerdc2':      (9, 'u16', 1),
+    'runmode':       (10, 'u16', 1),
+    'yieldtotal':    (11, 'u32', 0.1),
+    'yieldtoday':    (13, 'u16', 0.1),
+    'batPower':      (16, 's16', 1),
+    'soc':           (18, 'u16', 1),
+    'feedinpower':   (32, 's32', 1),
+    'feedinenergy':  (34, 'u32', 0.01),
+    'consumeenergy': (36, 'u32', 0.01),
+}
+
+# The run mode registers enumerate the same states as the cloud API's inverter status codes,
+# just without the offset of 100
+RUNMODE_OFFSET = 100
+
+# Max number of registers in a single Modbus read request
+MAX_REGISTERS = 125
+
+
+# Number of registers a value of the given type spans
+def reg_width(kind):
+    return 2 if kind in ('u32', 's32') else 1
+
+
+# Decode a value from a list of 16 bit registers
+def decode(regs, addr, kind, scale):
+    if kind == 'u16':
+        v = regs[addr]
+    elif kind == 's16':
+        v = regs[addr] - 0x10000 if regs[addr] & 0x8000 else regs[addr]
+    else:
+        v = regs[addr] | (regs[addr + 1] << 16)
+        if kind == 's32' and v & 0x80000000:
+            v -= 0x100000000
+    return v * scale
+
+
+# Encode a value into a dict of 16 bit registers. The inverse of decode(), used by the simulator
+def encode(regs, addr, kind, scale, value):
+    v = int(round(value / scale))
+    if kind in ('u16', 's16'):
+        regs[addr] = v & 0xFFFF
+    else:
+        v &= 0xFFFFFFFF
+        regs[addr] = v & 0xFFFF
+        regs[addr + 1] = v >> 16
+
+
+# Get the register map to use: the default map with entries overridden from the client env file
+def register_map(default, overrides):
+    m = dict(default)
+    for k, v in (overrides or {}).items():
+        m[k] = tuple(v)
+    return m
+
+
+# Map raw registers to a dict shaped like the 'result' of the cloud API
+def to_api_result(regs, regmap, sn, inverter_type):
+    res = {k: decode(regs, addr, kind, scale) for k, (addr, kind, scale) in regmap.items()}
+    res['inverterSN'] = sn
+    res['inverterType'] = inverter_type
+    res['inverterStatus'] = RUNMODE_OFFSET + int(res.pop('runmode', 2))
+    return res
+
+
+# Group the registers of a map into contiguous blocks of at most MAX_REGISTERS, so we need as few
+# requests as possible to read all of them. Returns a list of (start, count)
+def register_blocks(regmap, gap=16):
+    addrs = sorted({a + i for a, kind, _ in regmap.values() for i in range(reg_width(kind))})
+    blocks = []
+    for a in addrs:
+        if blocks and a - blocks[-1][0] < MAX_REGISTERS and a - (blocks[-1][0] + blocks[-1][1]) <= gap:
+            blocks[-1][1] = a - blocks[-1][0] + 1
+        else:
+            blocks.append([a, 1])
+    return [tuple(b) for b in blocks]
+
+
+# Minimal asynchronous Modbus TCP client. Only supports reading registers, which is all we need.
+# Keeps its connection open between reads.
+class ModbusTcpClient:
+    def __init__(self, host, port=502, unit=1, timeout=3.0):
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.tid = 0
+        self.lock = asyncio.Lock()
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    # Read 'count' registers starting at 'start'. Function 0x04 reads input registers, 0x03
+    # holding registers
+    async def read_registers(self, start, count, function=0x04):
+        async with self.lock:
+            if self.writer is None:
+                await self._connect()
+            self.tid = (self.tid + 1) & 0xFFFF
+            # MBAP header (transaction id, protocol id, length, unit id) followed by the PDU
+            self.writer.write(pack('>HHHBBHH', self.tid, 0, 6, self.unit, function, start, count))
+            try:
+                await self.writer.drain()
+                header = await asyncio.wait_for(self.reader.readexactly(7), self.timeout)
+                tid, _, length, _ = unpack('>HHHB', header)
+                # A PDU has a function code and a byte count or exception code, and at most 253 bytes
+                if not 3 <= length <= 254:
+                    raise IOError(f"Modbus response with invalid length {length}")
+                pdu = await asyncio.wait_for(self.reader.readexactly(length - 1), self.timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                self.close()
+                raise
+
+        if tid != self.tid:
+            self.close()
+            raise IOError(f"Modbus transaction id mismatch ({tid} != {self.tid})")
+        if pdu[0] & 0x80:
+            raise IOError(f"Modbus exception code {pdu[1]} reading {count} registers at {start}")
+        if pdu[0] != function or pdu[1] != 2 * count or len(pdu) != 2 + pdu[1]:
+            self.close()
+            raise IOError(f"Malformed Modbus response reading {count} registers at {start} (function {pdu[0]}, "
+                          f"{pdu[1]} bytes announced, {len(pdu) - 2} received)")
+        return list(unpack(f'>{count}H', pdu[2:]))
+
+
+# Data source reading inverters via Modbus TCP
+class ModbusSource:
+    def __init__(self, inverters, regmap=MODBUS_MAP, interval=2.0, metrics=None):
+        # Params:
+        #   :inverters: dict of inverter serial number to connection settings, i.e. a dict with
+        #               'host' and optionally 'port', 'unit' and 'type' (inverter type code)
+        #   :regmap:    register map to use
+        #   :interval:  poll interval in seconds
+        #   :metrics:   optional metrics registry to record read latencies and errors in
+        # No quota on reading the inverters locally
+        self.query_budget = None
+        self.metrics = metrics
+        self.inverters = {}
+        self.clients = {}
+        self.configure(inverters, regmap, interval)
+
+    # Apply (new) inverters, register map and poll interval. Connections to inverters whose
+    # connection settings didn't change are kept
+    def configure(self, inverters, regmap, interval):
+        self.regmap = regmap
+        self.blocks = register_blocks(regmap)
+        self.cycle_interval = interval
+        clients = {}
+        for sn, c in inverters.items():
+            old = self.inverters.get(sn)
+            if sn in self.clients and all(old.get(k) == c.get(k) for k in ('host', 'port', 'unit')):
+                clients[sn] = self.clients.pop(sn)
+            else:
+                clients[sn] = ModbusTcpClient(c['host'], c.get('port', 502), c.get('unit', 1))
+        for client in self.clients.values():
+            client.close()
+        self.inverters = inverters
+        self.clients = clients
+
+    # Read an inverter. Returns a response shaped like the one of the cloud API or None if the
+    # inverter could not be read
+    async def read(self, sn):
+        client = self.clients[sn]
+        start = perf_counter()
+        regs = {}
+        try:
+            for addr, count in self.blocks:
+                for i, v in enumerate(await client.read_registers(addr, count)):
+                    regs[addr + i] = v
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            print(f"Error reading inverter {sn} via Modbus:", e)
+            if self.metrics is not None:
+                self.metrics.inc('local_read_failures_total', labels={'sn': sn})
+            return None
+        if self.metrics is not None:
+            self.metrics.observe('local_read_seconds', perf_counter() - start, {'sn': sn})
+
+        res = to_api_result(regs, self.regmap, sn, self.inverters[sn].get('type', 14))
+        return {'success': True, 'result': res}
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+
+
+# Data source reading inverters via the local HTTP API of the Solax WiFi/LAN dongle
+class LocalHttpSource:
+    def __init__(self, inverters, regmap=LOCAL_HTTP_MAP, interval=5.0, metrics=None, timeout=3.0, http_client=None):
+        # Params:
+        #   :inverters: dict of inverter serial number to connection settings, i.e. a dict with
+        #               'host', 'password' (the dongle registration number) and optionally 'port'
+        #               and 'type' (inverter type code, by default taken from the response)
+        #   :regmap:    map of API keys to indices into the 'Data' array of the response
+        #   :interval:  poll interval in seconds
+        #   :metrics:   optional metrics registry to record read latencies and errors in
+        #   :http_client: HTTP client to use, see http_pool.make_session()
+        # No quota on reading the inverters locally
+        self.query_budget = None
+        self.metrics = metrics
+        self.timeout = timeout
+        self.session, self.errors = make_session(http_client, len(inverters))
+        self.configure(inverters, regmap, interval)
+
+    # Apply (new) inverters, register map and poll interval. The session is kept
+    def configure(self, inverters, regmap, interval):
+        self.regmap = regmap
+        self.cycle_interval = interval
+        self.inverters = inverters
+
+    def _post(self, sn):
+        c = self.inverters[sn]
+        url = f"http://{c['host']}:{c.get('port', 80)}/"
+        response = self.session.post(url, data={'optType': 'ReadRealTimeData', 'pwd': c.get('password', '')},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return json_loads(response.text)
+
+    # Read an inverter. Returns a response shaped like the one of the cloud API or None if the
+    # inverter could not be read
+    async def read(self, sn):
+        start = perf_counter()
+        try:
+            data = await asyncio.to_thread(self._post, sn)
+            regs = data['Data']
+            res = to_api_result(regs, self.regmap, sn, self.inverters[sn].get('type', data.get('type', 15)))
+        except (self.errors.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+            print(f"Error reading inverter {sn} via its local API:", e)
+            if self.metrics is not None:
+                self.metrics.inc('local_read_failures_total', labels={'sn': sn})
+            return None
+        if self.metrics is not None:
+            self.metrics.observe('local_read_seconds', perf_counter() - start, {'sn': sn})
+        return {'success': True, 'result': res}
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,147 @@
+# Data quality checks for the Solax PV monitoring client.
+#
+# The Solax API regularly returns incomplete data for single inverters: empty results, nulls for
+# fields that are normally there, counters dropping to 0 for a cycle or the last upload of an
+# inverter that went offline. The client used to drop the whole cycle then. Instead, the sample
+# of every inverter gets checked before it goes into the snapshot:
+#   - schema:         the reading has all required fields (see Schema.sample())
+#   - range:          values are within physical limits, e.g. SOC between 0 and 100%
+#   - rate of change: energy counters don't go backwards or grow faster than the inverter could
+#                     produce, the SOC doesn't jump
+#   - staleness:      the upload time reported by the API moves on
+# Fields failing a check get replaced by the last good value of the inverter. An inverter without
+# a usable reading gets carried forward with its last good sample for up to 'carry_for' seconds.
+# What has been repaired is reported per inverter as quality flags, so the dashboards can show how
+# far to trust the data.
+#
+# The limits are arrays laid out like the values of a sample, so checking a sample is a single
+# pass over its values.
+
+from array import array
+from math import inf, nan
+
+from sample import Sample, SAMPLE_FIELDS, REQUIRED_FIELDS
+
+# Quality flags of an inverter, or'ed together
+REPAIRED = 1    # Some fields failed a check and got replaced by their last good value
+STALE = 2       # The upload time reported by the API didn't move on for 'stale_after' seconds
+CARRIED = 4     # No usable reading this cycle, the last good sample was used instead
+MISSING = 8     # No usable reading and nothing to carry forward. Not part of the snapshot
+
+# Cumulative energy counters (kWh). They never go backwards
+COUNTER_FIELDS = ('yieldtotal', 'feedinenergy', 'consumeenergy')
+
+
+# Default limits per sample field as (<min>, <max>, <max rate of change per second>) for
+# inverters of up to 'max_power' W
+def default_limits(max_power):
+    kwh_per_s = max_power / 3600000.0
+    limits = {
+        'yieldtotal': (0.0, inf, kwh_per_s),
+        'yieldtoday': (0.0, max_power * 24 / 1000.0, inf),
+        'feedinenergy': (0.0, inf, kwh_per_s),
+        'feedinpower': (-max_power, max_power, inf),
+        'consumeenergy': (0.0, inf, kwh_per_s),
+        'acpower': (-max_power, max_power, inf),
+        'batPower': (-max_power, max_power, inf),
+        # Even fast charging batteries don't take much more than 1C
+        'soc': (0.0, 100.0, 0.1),
+    }
+    for k in SAMPLE_FIELDS:
+        limits.setdefault(k, (0.0, max_power, inf))
+    return limits
+
+
+class QualityCheck:
+    def __init__(self, max_power=30000.0, limits=None, stale_after=900.0, carry_for=900.0):
+        # Params:
+        #   :max_power:     the max power of an inverter in W, which the default limits derive from
+        #   :limits:        dict of sample field to (<min>, <max>, <max rate per second>),
+        #                   overriding the defaults
+        #   :stale_after:   seconds after which an upload time that doesn't move on marks the data
+        #                   of an inverter as stale
+        #   :carry_for:     seconds a last good value can stand in for a bad or missing one
+        limits = dict(default_limits(max_power), **(limits or {}))
+        self.low = array('d', [limits[k][0] for k in SAMPLE_FIELDS])
+        self.high = array('d', [limits[k][1] for k in SAMPLE_FIELDS])
+        self.rate = array('d', [limits[k][2] for k in SAMPLE_FIELDS])
+        # Counters must not go backwards, everything else may change in both directions
+        self.monotonic = array('b', [k in COUNTER_FIELDS for k in SAMPLE_FIELDS])
+        self.n_required = len(REQUIRED_FIELDS)
+        self.stale_after = stale_after
+        self.carry_for = carry_for
+
+        # Per inverter the last good sample and when each of its values was last good
+        self.good = {}
+        self.good_ts = {}
+
+    # Check the sample of an inverter and repair the values failing a check.
+    #
+    # Params:
+    #   :sn:        the inverter serial number
+    #   :sample:    the Sample of this cycle (see sample.py)
+    #   :ts:        start of the cycle in seconds since the epoch
+    #   :upload_ts: the upload time reported for the sample, None if unknown
+    #
+    # Returns (<sample>, <flags>, <number of repaired fields>). The sample is None if required
+    # fields failed and there is no good value to replace them with
+    def check(self, sn, sample, ts, upload_ts=None):
+        # Rates are computed against the time the values were measured if we know it
+        t = upload_ts if upload_ts is not None else ts
+        good = self.good.get(sn)
+        if good is None:
+            good_values = good_ts = None
+        else:
+            good_values, good_ts = good.values, self.good_ts[sn]
+
+        flags = 0
+        if upload_ts is not None and ts - upload_ts > self.stale_after:
+            flags |= STALE
+
+        values = sample.values
+        bad = []
+        for i, (v, low, high, rate, mono) in enumerate(zip(values, self.low, self.high, self.rate,
+                                                           self.monotonic)):
+            if v != v:
+                continue    # NaN, i.e. not reported
+            if v < low or v > high:
+                bad.append(i)
+            elif good_values is not None and t - good_ts[i] <= self.carry_for:
+                dt = t - good_ts[i]
+                delta = v - good_values[i]
+                if delta != delta:
+                    continue
+                if (mono and delta < 0.0) or (dt > 0.0 and abs(delta) > rate * dt):
+                    bad.append(i)
+
+        for i in bad:
+            if good_values is not None and ts - good_ts[i] <= self.carry_for:
+                values[i] = good_values[i]
+            elif i < self.n_required:
+                return None, flags | MISSING, len(bad)
+            else:
+                values[i] = nan
+        if bad:
+            flags |= REPAIRED
+
+        # Remember the values that passed as the last good ones
+        if good_values is None or not bad:
+            self.good_ts[sn] = array('d', [t]) * len(values)
+        else:
+            for i in set(range(len(values))).difference(bad):
+                good_ts[i] = t
+        self.good[sn] = Sample(sample.schema, array('d', values), sample.inverter_type,
+                               sample.inverter_status, sample.upload_time)
+        return sample, flags, len(bad)
+
+    # No usable reading of an inverter this cycle. Returns (<sample>, <flags>), with the last good
+    # sample if it isn't older than 'carry_for' seconds, None otherwise
+    def carry(self, sn, ts):
+        good = self.good.get(sn)
+        if good is None:
+            return None, MISSING
+        good_ts = self.good_ts[sn]
+        if any(ts - good_ts[i] > self.carry_for for i in range(self.n_required)):
+            return None, MISSING
+        values = array('d', (v if ts - t <= self.carry_for else nan for v, t in zip(good.values, good_ts)))
+        return Sample(good.schema, values, good.inverter_type, good.inverter_status, good.upload_time), CARRIED
@@ -0,0 +1,88 @@
+# Compact per inverter samples for the Solax PV monitoring client.
+#
+# Parsing the data of an inverter used to build the list of its 'powerdc' keys, convert every value
+# with float() and concatenate strings to look up the metric names of its lines, every cycle. With
+# local sources polled every second across many inverters that adds up. Instead:
+#   - a Schema gets built once per inverter. It knows the lines (PV strings) the inverter reports,
+#     where their values are in a sample and the metric names they get published under
+#   - a Sample holds the values of one reading in an array of doubles, NaN for missing values,
+#     picked from the reading with a precompiled itemgetter
+#
+# Responses of the cloud API still get parsed with json.loads(). Extracting just the needed keys
+# from the raw text in Python is slower than the C parser (see bench/bench_parse.py).
+
+from array import array
+from math import nan
+from operator import itemgetter
+
+# Fields the client needs from every reading. The API delivers them as numbers, the optional ones
+# can be null
+REQUIRED_FIELDS = ('yieldtotal', 'yieldtoday', 'feedinenergy', 'feedinpower', 'consumeenergy', 'acpower')
+OPTIONAL_FIELDS = ('batPower', 'soc')
+# Power per inverter line (PV string). Inverters report up to 4
+LINE_FIELDS = ('powerdc1', 'powerdc2', 'powerdc3', 'powerdc4')
+# Order of the values in a sample
+SAMPLE_FIELDS = REQUIRED_FIELDS + OPTIONAL_FIELDS + LINE_FIELDS
+FIELD_INDEX = {k: i for i, k in enumerate(SAMPLE_FIELDS)}
+
+_fields = itemgetter(*SAMPLE_FIELDS)
+_n_required = len(REQUIRED_FIELDS)
+
+
+# Layout of the samples of an inverter, built from its first reading
+class Schema:
+    __slots__ = ('sn', 'lines', 'line_names')
+
+    def __init__(self, sn, res, line_map):
+        # Params:
+        #   :sn:        the inverter serial number
+        #   :res:       a reading of the inverter, i.e. the 'result' of the API or local source
+        #   :line_map:  map of (<sn>, <line>) to metric name, see parse_inverter_line_file()
+        self.sn = sn
+
+        # The lines the inverter reports as (<index in the sample>, <line>, <metric name>). Lines
+        # without a metric name still count into the total PV power
+        lines = []
+        for line in LINE_FIELDS:
+            if line in res:
+                name = line_map.get((sn, line))
+                if name is None and res[line] is not None:
+                    print(f'{sn}/{line} not found in inverter map {line_map}')
+                lines.append((FIELD_INDEX[line], line, name))
+        self.lines = tuple(lines)
+        self.line_names = frozenset(line for _, line, _ in lines)
+
+    # Whether the schema has all lines of the reading. A reading with lines the first one didn't
+    # have, e.g. one taken while the inverter came up, needs a new schema
+    def covers(self, res):
+        return all(line in self.line_names for line in LINE_FIELDS if line in res)
+
+    # Turn a reading into a sample. Raises KeyError or TypeError if required fields are missing
+    def sample(self, res):
+        try:
+            values = _fields(res)
+            if None in values[:_n_required]:
+                raise TypeError('required field is null')
+            values = array('d', [nan if v is None else v for v in values])
+        except (KeyError, TypeError):
+            # Lines the inverter doesn't have or values delivered as strings. Missing required
+            # fields raise again
+            get = res.get
+            values = array('d', [float(res[k]) for k in REQUIRED_FIELDS])
+            values.extend([nan if (v := get(k)) is None else float(v) for k in SAMPLE_FIELDS[_n_required:]])
+        return Sample(self, values, res.get('inverterType'), res.get('inverterStatus'), res.get('uploadTime'))
+
+
+# One reading of an inverter
+class Sample:
+    __slots__ = ('schema', 'values', 'inverter_type', 'inverter_status', 'upload_time')
+
+    def __init__(self, schema, values, inverter_type, inverter_status, upload_time):
+        self.schema = schema
+        self.values = values
+        self.inverter_type = inverter_type
+        self.inverter_status = inverter_status
+        self.upload_time = upload_time
+
+    def get(self, field):
+        return self.values[FIELD_INDEX[field]]
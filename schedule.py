@@ -0,0 +1,147 @@
+# Adaptive polling schedule for the Solax PV monitoring client.
+#
+# Polling every inverter at QUERY_FREQUENCY around the clock spends most of the Solax API quota on
+# nights and on inverters in standby, when nothing changes. The scheduler instead gives every
+# inverter its own poll interval:
+#   - inverters waiting or in standby (see IDLE_STATUSES) and all inverters while the sun is down
+#     get polled every 'max_interval' seconds. Sunrise and sunset are computed from the
+#     coordinates of the site, with a margin of 'sun_margin' seconds
+#   - otherwise the interval goes down from 'interval' to 'min_interval' with the variation of the
+#     recent AC power of the inverter, i.e. volatile (cloudy) periods get polled more often
+#   - the intervals of all inverters together must stay within the query budget, e.g. the share of
+#     the Solax token's quota of a site. Intervals get stretched evenly if they don't
+# A cycle of the client polls the inverters that are due.
+
+from collections import deque
+from datetime import datetime, timezone
+from math import asin, acos, cos, degrees, inf, radians, sin, sqrt
+
+# Inverter states (see [inverter_codes]) in which the values don't change
+IDLE_STATUSES = ('Wait Mode', 'Standby Mode', 'Idle Mode')
+
+# Coefficient of variation of the recent power at which inverters get polled at 'min_interval'
+VOLATILE_CV = 0.3
+
+# Julian date of the Unix epoch and of J2000
+JD_EPOCH = 2440587.5
+JD_2000 = 2451545.0
+
+
+# Sunrise and sunset of the UTC day containing ts at the given coordinates, in seconds since the
+# epoch. Uses the sunrise equation, which is accurate to a minute or so. Returns (None, None) for
+# polar night and (-inf, inf) for polar day
+def sun_times(ts, lat, lon):
+    day = datetime.fromtimestamp(ts, timezone.utc).date()
+    n = day.toordinal() - datetime(2000, 1, 1).toordinal()
+    # Mean solar noon, solar mean anomaly, equation of the center and ecliptic longitude
+    j = n - lon / 360.0
+    m = (357.5291 + 0.98560028 * j) % 360.0
+    c = 1.9148 * sin(radians(m)) + 0.02 * sin(radians(2 * m)) + 0.0003 * sin(radians(3 * m))
+    ecl = (m + c + 180.0 + 102.9372) % 360.0
+    transit = JD_2000 + j + 0.0053 * sin(radians(m)) - 0.0069 * sin(radians(2 * ecl))
+    # Declination of the sun and its hour angle at sunrise and sunset
+    decl = asin(sin(radians(ecl)) * sin(radians(23.4397)))
+    cos_w = (sin(radians(-0.833)) - sin(radians(lat)) * sin(decl)) / (cos(radians(lat)) * cos(decl))
+    if cos_w > 1.0:
+        return None, None
+    if cos_w < -1.0:
+        return -inf, inf
+    w = degrees(acos(cos_w)) / 360.0
+    return (transit - w - JD_EPOCH) * 86400.0, (transit + w - JD_EPOCH) * 86400.0
+
+
+class Scheduler:
+    def __init__(self, sns, interval, min_interval=None, max_interval=None, budget=None,
+                 lat=None, lon=None, sun_margin=1800.0, history=10):
+        # Params:
+        #   :sns:           serial numbers of the inverters to poll
+        #   :interval:      poll interval in seconds while the values are steady
+        #   :min_interval:  poll interval while they are volatile. Defaults to 'interval'
+        #   :max_interval:  poll interval while inverters are idle or the sun is down. Defaults
+        #                   to 'interval'
+        #   :budget:        max queries per second over all inverters, None for no limit
+        #   :lat, lon:      coordinates of the site. Without them only the inverter status tells
+        #                   when it is night
+        #   :sun_margin:    seconds before sunrise and after sunset to still poll as by day
+        #   :history:       number of recent power values to judge the variation from
+        self.interval = interval
+        self.min_interval = min(min_interval or interval, interval)
+        self.max_interval = max(max_interval or interval, interval)
+        self.budget = budget
+        self.lat = lat
+        self.lon = lon
+        self.sun_margin = sun_margin
+        self.history = history
+        self.sun = (None, [])
+
+        # Per inverter the wanted interval, the effective one (within the budget), when it is due
+        # next and its recent power values
+        self.wanted = {sn: interval for sn in sns}
+        self.intervals = dict(self.wanted)
+        self.next_due = {sn: 0.0 for sn in sns}
+        self.powers = {sn: deque(maxlen=history) for sn in sns}
+        self.plan()
+
+    # Whether the sun is (about to be) up at ts. Always True if we don't know where the site is
+    def daylight(self, ts):
+        if self.lat is None or self.lon is None:
+            return True
+        # Far from Greenwich the days of the site span two UTC days, so look at the UTC days around
+        day = int(ts // 86400)
+        if self.sun[0] != day:
+            self.sun = (day, [sun_times((day + d) * 86400 + 43200, self.lat, self.lon) for d in (-1, 0, 1)])
+        return any(rise is not None and rise - self.sun_margin <= ts <= set_ + self.sun_margin
+                   for rise, set_ in self.sun[1])
+
+    # Coefficient of variation of the recent power of an inverter
+    def variation(self, sn):
+        p = self.powers[sn]
+        if len(p) < 2:
+            return 0.0
+        mean = sum(p) / len(p)
+        if mean == 0.0:
+            return 0.0
+        return sqrt(sum((x - mean) ** 2 for x in p) / (len(p) - 1)) / abs(mean)
+
+    # Record the reading of an inverter and work out its next interval.
+    #
+    # Params:
+    #   :sn:        the inverter serial number
+    #   :ts:        time of the reading in seconds since the epoch
+    #   :status:    the inverter status, e.g. "Normal Mode", None if unknown
+    #   :power:     its current AC power in W, None if unknown
+    def update(self, sn, ts, status, power):
+        if power is not None and power == power:
+            self.powers[sn].append(power)
+        if status in IDLE_STATUSES or not self.daylight(ts):
+            self.powers[sn].clear()
+            self.wanted[sn] = self.max_interval
+        else:
+            f = min(1.0, self.variation(sn) / VOLATILE_CV)
+            self.wanted[sn] = self.interval - (self.interval - self.min_interval) * f
+
+    # Work out the effective intervals and schedule the next poll of the inverters just polled. If
+    # the wanted intervals would need more queries than the budget allows they get stretched by the
+    # same factor
+    #
+    # Params:
+    #   :now:       a monotonic clock
+    #   :polled:    the inverters polled at 'now'
+    def plan(self, now=0.0, polled=()):
+        load = sum(1.0 / i for i in self.wanted.values())
+        stretch = load / self.budget if self.budget and load > self.budget else 1.0
+        self.intervals = {sn: i * stretch for sn, i in self.wanted.items()}
+        for sn in polled:
+            if sn in self.intervals:
+                self.next_due[sn] = now + self.intervals[sn]
+
+    # The inverters due for polling at 'now' (a monotonic clock). Inverters due within a tenth of
+    # the shortest interval get polled along, so inverters on the same interval stay in one cycle
+    def due(self, now):
+        now += 0.1 * self.min_interval
+        return [sn for sn, t in self.next_due.items() if t <= now]
+
+    # When the next inverter is due. Without inverters, e.g. a site all of whose inverters got
+    # removed from the config, 'now' (a monotonic clock) plus the idle interval
+    def next_wake(self, now):
+        return min(self.next_due.values(), default=now + self.max_interval)
@@ -0,0 +1,87 @@
+# Multi-site configuration for the Solax PV monitoring client.
+#
+# In multi-site mode one client collects the data of several sites, each with its own Solax token,
+# inverters and state. Sites are configured either inline in the client env file
+#     [sites.<name>.settings]         settings overriding the ones in [settings], e.g. TOKEN
+#     [sites.<name>.inverter_sns]     the inverters of the site
+#     [sites.<name>.local_inverters]  optional, for the local sources
+# or as one file per site in SITES_DIR, named <name>.toml and holding the same sections without
+# the 'sites.<name>.' prefix. Every site gets its own state file next to BACKUP_FILE unless it
+# configures its own.
+#
+# Sites can be spread over several worker processes (SHARDS). Sites get assigned to workers by
+# consistent hashing, so changing the number of workers only moves the sites of the workers'
+# share of the hash ring, i.e. their state files mostly stay with the same worker. The Solax cloud
+# limits the queries per token and each worker has its own rate limiters, so the sites sharing a
+# token go to the same worker (see shard_key()).
+
+from bisect import bisect_left
+from hashlib import md5
+from os import listdir
+from os.path import join, dirname, splitext
+from tomllib import load as toml_load
+
+# Sections a site config can provide. Everything else is shared by all sites
+SITE_SECTIONS = ('inverter_sns', 'local_inverters', 'local_register_map')
+
+
+# Load the site configs. Returns a dict of site name to a complete client env, i.e. the client env
+# with the site's settings and inverters merged in. Empty if there are no sites configured.
+def load_sites(env):
+    sites = dict(env.get('sites', {}))
+    sites_dir = env['settings'].get('SITES_DIR')
+    if sites_dir:
+        for f in sorted(listdir(sites_dir)):
+            name, ext = splitext(f)
+            if ext == '.toml':
+                with open(join(sites_dir, f), 'rb') as fh:
+                    sites[name] = toml_load(fh)
+
+    envs = {}
+    for name, site in sites.items():
+        site_env = {k: v for k, v in env.items() if k != 'sites'}
+        site_env['settings'] = dict(env['settings'], **site.get('settings', {}))
+        if 'BACKUP_FILE' not in site.get('settings', {}):
+            site_env['settings']['BACKUP_FILE'] = join(dirname(env['settings']['BACKUP_FILE']), f"{name}.json")
+        for section in SITE_SECTIONS:
+            if section in site:
+                site_env[section] = site[section]
+        if 'inverter_sns' not in site:
+            raise ValueError(f"Site '{name}' has no inverter_sns")
+        envs[name] = site_env
+    return envs
+
+
+def _hash(key):
+    return int.from_bytes(md5(key.encode()).digest()[:8], 'big')
+
+
+# Consistent hash ring over the given number of shards, with 'replicas' virtual nodes per shard to
+# even out the distribution. Returns (<sorted points>, <shard per point>)
+def hash_ring(shards, replicas=100):
+    points = sorted((_hash(f"shard-{s}-{r}"), s) for s in range(shards) for r in range(replicas))
+    return [p for p, _ in points], [s for _, s in points]
+
+
+# The shard a site belongs to: the first point on the ring at or after the hash of its key
+def shard_for(ring, key):
+    points, shards = ring
+    return shards[bisect_left(points, _hash(key)) % len(points)]
+
+
+# The key a site gets sharded by: the Solax token of the sites querying the cloud, so that one
+# worker holds the rate limiter of the token, and the name of the others
+def shard_key(name, site_env):
+    settings = site_env['settings']
+    if settings.get('SOURCE', 'cloud') == 'cloud' and settings.get('TOKEN'):
+        return f"token:{settings['TOKEN']}"
+    return name
+
+
+# Path of a per shard file, e.g. "/solar/cl_backup.json" becomes "/solar/cl_backup-2.json" for
+# shard 2. Unchanged if we don't shard
+def shard_path(path, shard):
+    if shard is None:
+        return path
+    base, ext = splitext(path)
+    return f"{base}-{shard}{ext}"
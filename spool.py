@@ -0,0 +1,225 @@
+# Durable on-disk publish queue for the Solax PV monitoring client.
+#
+# Messages that cannot be delivered to the mqtt broker (because it is down or restarting) get
+# appended to a spool on disk and are replayed in order when the broker becomes available again.
+# Since the messages carry their original timestamps, replayed metrics end up at the right place
+# in InfluxDB and replaying a message twice just overwrites the same point.
+#
+# The spool is a segmented, append-only log in a directory:
+#     seg-00000001.log, seg-00000002.log, ...   one JSON record per line
+#     offset.json                               segment and byte offset of the next record to replay
+# With a state store (see state.py) the offset is kept there instead of in offset.json, so it gets
+# persisted together with the rest of the client's state.
+# Appends get fsync'ed in batches. Segments that have been replayed completely get deleted, and if
+# the spool grows beyond its size cap the oldest segment gets dropped.
+
+from json import dumps as json_dumps, loads as json_loads, load as json_load, dump as json_dump
+from os import makedirs, listdir, fsync, replace, remove as file_remove
+from os.path import join, getsize, isfile
+
+SEGMENT_PREFIX = 'seg-'
+SEGMENT_SUFFIX = '.log'
+OFFSET_FILE = 'offset.json'
+
+
+class Spool:
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024, segment_bytes=1024 * 1024, fsync_batch=10,
+                 state=None):
+        # Params:
+        #   :directory:     Directory holding the segment files. Gets created if needed
+        #   :max_bytes:     Cap on the disk space used by the spool. Oldest data gets dropped beyond
+        #   :segment_bytes: Size after which we roll over to a new segment
+        #   :fsync_batch:   Number of appended records after which we fsync
+        #   :state:         Optional StateStore to keep the replay offset in
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_batch = fsync_batch
+        self.state = state
+
+        # Counters for queued, replayed and dropped messages since start
+        self.queued = 0
+        self.replayed = 0
+        self.dropped = 0
+
+        makedirs(directory, exist_ok=True)
+        self.segments = self._list_segments()
+        self.read_seg, self.read_pos = self._load_offset()
+        self.writer = None
+        self.unsynced = 0
+
+        # Drop a torn record at the tail of the last segment, e.g. from a crash in the middle of
+        # a write, so new records start on a fresh line
+        if self.segments:
+            self._truncate_torn_tail(self.segments[-1])
+
+    def _segment_path(self, seg):
+        return join(self.directory, f"{SEGMENT_PREFIX}{seg:08d}{SEGMENT_SUFFIX}")
+
+    def _list_segments(self):
+        segs = []
+        for f in listdir(self.directory):
+            if f.startswith(SEGMENT_PREFIX) and f.endswith(SEGMENT_SUFFIX):
+                try:
+                    segs.append(int(f[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(segs)
+
+    def _load_offset(self):
+        if self.state is not None and self.state.get('spool_offset'):
+            return tuple(self.state.get('spool_offset'))
+        try:
+            with open(join(self.directory, OFFSET_FILE), 'r') as f:
+                data = json_load(f)
+            return data['segment'], data['position']
+        except (FileNotFoundError, ValueError, KeyError):
+            return (self.segments[0] if self.segments else 1), 0
+
+    def _save_offset(self):
+        if self.state is not None:
+            if list(self.state.get('spool_offset') or ()) != [self.read_seg, self.read_pos]:
+                self.state.set('spool_offset', [self.read_seg, self.read_pos])
+            return
+        tmp = join(self.directory, OFFSET_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json_dump({'segment': self.read_seg, 'position': self.read_pos}, f)
+            f.flush()
+            fsync(f.fileno())
+        replace(tmp, join(self.directory, OFFSET_FILE))
+
+    def _truncate_torn_tail(self, seg):
+        path = self._segment_path(seg)
+        with open(path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                f.truncate(end)
+
+    # Number of bytes used by the spool on disk
+    def size(self):
+        return sum(getsize(self._segment_path(s)) for s in self.segments if isfile(self._segment_path(s)))
+
+    # Whether there are messages waiting to be replayed
+    def pending(self):
+        if not self.segments:
+            return False
+        if self.read_seg < self.segments[-1]:
+            return True
+        return self.read_seg == self.segments[-1] and self.read_pos < self._write_size(self.read_seg)
+
+    def _write_size(self, seg):
+        if self.writer is not None and seg == self.segments[-1]:
+            self.writer.flush()
+        return getsize(self._segment_path(seg))
+
+    # Append a message. The QoS and retain flag only get recorded if they differ from the default
+    # of the publisher
+    def append(self, topic, payload, qos=None, retain=False):
+        if self.writer is None or self.writer.tell() >= self.segment_bytes:
+            self._roll()
+
+        rec = {'topic': topic, 'payload': payload}
+        if qos is not None:
+            rec['qos'] = qos
+        if retain:
+            rec['retain'] = True
+        self.writer.write(json_dumps(rec) + '\n')
+        self.queued += 1
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_batch:
+            self.sync()
+
+        self._enforce_cap()
+
+    # Start a new segment
+    def _roll(self):
+        if self.writer is not None:
+            self.sync()
+            self.writer.close()
+        seg = self.segments[-1] + 1 if self.segments else max(self.read_seg, 1)
+        self.segments.append(seg)
+        self.writer = open(self._segment_path(seg), 'a')
+        self._drop_consumed()
+
+    # Remove segments that have been replayed completely and aren't written to anymore
+    def _drop_consumed(self):
+        while len(self.segments) > 1 and (self.segments[0] < self.read_seg or
+              (self.segments[0] == self.read_seg and self.read_pos >= getsize(self._segment_path(self.read_seg)))):
+            file_remove(self._segment_path(self.segments.pop(0)))
+            if self.read_seg < self.segments[0]:
+                self.read_seg, self.read_pos = self.segments[0], 0
+                self._save_offset()
+
+    # Flush appended records to disk
+    def sync(self):
+        if self.writer is not None and self.unsynced:
+            self.writer.flush()
+            fsync(self.writer.fileno())
+        self.unsynced = 0
+
+    # Drop the oldest segments while the spool is larger than its cap. Never drops the segment we
+    # are currently writing to
+    def _enforce_cap(self):
+        while len(self.segments) > 1 and self.size() > self.max_bytes:
+            seg = self.segments.pop(0)
+            if seg >= self.read_seg:
+                dropped = self._count_records(seg, self.read_pos if seg == self.read_seg else 0)
+                self.dropped += dropped
+                print(f"Spool exceeds {self.max_bytes} bytes. Dropped {dropped} messages")
+                self.read_seg, self.read_pos = self.segments[0], 0
+                self._save_offset()
+            file_remove(self._segment_path(seg))
+
+    def _count_records(self, seg, pos):
+        with open(self._segment_path(seg), 'rb') as f:
+            f.seek(pos)
+            return sum(1 for _ in f)
+
+    # Replay spooled messages in order by handing them to the 'publish' function as (<topic>,
+    # <payload>, <qos>, <retain>), which has to return True if it accepted the message. Stops at the first message that doesn't get accepted
+    # or after max_records messages. Returns the number of replayed messages.
+    def replay(self, publish, max_records=500):
+        count = 0
+        self.sync()
+
+        while count < max_records and self.pending():
+            if self.read_seg not in self.segments:
+                # Segment got dropped or we start out with an old offset
+                self.read_seg, self.read_pos = self.segments[0], 0
+                continue
+
+            start = (self.read_seg, self.read_pos)
+            with open(self._segment_path(self.read_seg), 'rb') as f:
+                f.seek(self.read_pos)
+                while count < max_records:
+                    line = f.readline()
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        rec = json_loads(line)
+                    except ValueError:
+                        # Skip records we can't read
+                        rec = None
+                    if rec is not None and not publish(rec['topic'], rec['payload'], rec.get('qos'),
+                                                       rec.get('retain', False)):
+                        self._save_offset()
+                        return count
+                    self.read_pos = f.tell()
+                    if rec is not None:
+                        count += 1
+                        self.replayed += 1
+
+            # Move on to the next segment if we are done with this one
+            self._drop_consumed()
+            if (self.read_seg, self.read_pos) == start:
+                break
+
+        self._save_offset()
+        return count
+
+    def close(self):
+        if self.writer is not None:
+            self.sync()
+            self.writer.close()
+            self.writer = None
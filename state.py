@@ -0,0 +1,129 @@
+# Crash-safe state store for the Solax PV monitoring client.
+#
+# Holds the state the client derives while running and needs to resume exactly after a restart or
+# crash: the energy accounting (counter baselines and integrators), when each inverter was last
+# seen and the replay offset of the spool.
+#
+# The state is a dictionary of top level keys to JSON values, kept on disk as
+#     <file>            snapshot: {"seq": <seq of the last journal record included>, "state": {...}}
+#     <file>.journal    append-only journal, one {"seq": .., "set": {<key>: <value>, ...}} per line
+# Every update gets appended to the journal and fsync'ed before it returns, so a record is either
+# complete on disk or it gets discarded as torn tail when loading. Once the journal holds
+# 'compact_every' records, the state gets written as new snapshot (to a temporary file that is
+# fsync'ed and atomically renamed) and the journal starts over. Loading reads the snapshot and
+# applies the journal records that are newer than it.
+#
+# A file in the format of the old backup (a plain JSON dictionary) is taken as initial state.
+
+from json import dumps as json_dumps, loads as json_loads, load as json_load, dump as json_dump
+from os import fsync, replace, open as os_open, close as os_close, O_RDONLY
+from os.path import dirname, abspath
+
+JOURNAL_SUFFIX = '.journal'
+
+
+class StateStore:
+    def __init__(self, fname, compact_every=1000):
+        # Params:
+        #   :fname:         Snapshot file. The journal lives next to it with JOURNAL_SUFFIX appended
+        #   :compact_every: Number of journal records after which the state gets compacted into a
+        #                   new snapshot
+        self.fname = fname
+        self.journal_fname = fname + JOURNAL_SUFFIX
+        self.compact_every = compact_every
+
+        self.state = {}
+        self.seq = 0
+        self.journal_records = 0
+        self._load()
+        self.journal = open(self.journal_fname, 'ab')
+
+    def _load(self):
+        try:
+            with open(self.fname, 'r') as f:
+                data = json_load(f)
+        except FileNotFoundError:
+            data = {}
+        except ValueError as e:
+            print(f"Error while loading state from '{self.fname}': {str(e)}. Starting from the journal only")
+            data = {}
+
+        if 'state' in data and 'seq' in data:
+            self.state, self.seq = data['state'], data['seq']
+        else:
+            # Backup file of an older client version
+            self.state = data
+
+        try:
+            with open(self.journal_fname, 'rb+') as f:
+                end = 0
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        rec = json_loads(line)
+                    except ValueError:
+                        break
+                    end += len(line)
+                    if rec['seq'] > self.seq:
+                        self.state.update(rec['set'])
+                        self.seq = rec['seq']
+                        self.journal_records += 1
+                # Drop a torn record, e.g. from a crash in the middle of a write
+                f.truncate(end)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    # Set one or more top level keys. The update is on disk when this returns
+    def update(self, values):
+        self.seq += 1
+        self.state.update(values)
+        self.journal.write((json_dumps({'seq': self.seq, 'set': values}) + '\n').encode())
+        self.journal.flush()
+        fsync(self.journal.fileno())
+
+        self.journal_records += 1
+        if self.journal_records >= self.compact_every:
+            self.compact()
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    # Write the complete state as new snapshot and start over with an empty journal
+    def compact(self):
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as f:
+            json_dump({'seq': self.seq, 'state': self.state}, f)
+            f.flush()
+            fsync(f.fileno())
+        replace(tmp, self.fname)
+        self._sync_dir()
+
+        # Records up to seq are in the snapshot now. Should we crash before truncating, they just
+        # get skipped when loading
+        self.journal.truncate(0)
+        self.journal.seek(0)
+        fsync(self.journal.fileno())
+        self.journal_records = 0
+
+    # Make the rename of the snapshot durable
+    def _sync_dir(self):
+        try:
+            fd = os_open(dirname(abspath(self.fname)), O_RDONLY)
+        except OSError:
+            return
+        try:
+            fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os_close(fd)
+
+    def close(self):
+        if self.journal is not None:
+            self.compact()
+            self.journal.close()
+            self.journal = None
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# Query and export tool for the local archive of the Solax PV monitoring client (see archive.py).
+#
+# Reads the archive in ARCHIVE_DIR of the client env file (or --dir) and
+#   - query:  prints the snapshots of a time range, or aggregates (sum, mean, min, max, count) of
+#             them per bucket, as CSV
+#   - export: writes the snapshots of a time range as InfluxDB line protocol, the same lines the
+#             client publishes, to a file or directly to InfluxDB, e.g. to rebuild it after its
+#             volume got lost. Or as Parquet file (needs pyarrow)
+# The archive only gets read, so this can run next to the client.
+#
+# Run from the repository root, e.g.
+#     python3 utils/archive_tool.py query --start 2024-01-01 --bucket 1d --agg sum --fields yield_today
+#     python3 utils/archive_tool.py export --start 2024-05-01 --end 2024-05-03 --influx
+#     python3 utils/archive_tool.py export --format parquet -o solar.parquet
+
+import csv
+from argparse import ArgumentParser
+from datetime import datetime
+from math import inf
+from os import getenv
+from os.path import dirname, abspath, join
+from tomllib import load as toml_load
+from zoneinfo import ZoneInfo
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from archive import Archive, split_column
+from client import line_protocol, env_file
+from backfill import InfluxSink, parse_time, format_time
+from aggregate import parse_period
+
+
+# Line protocol of the snapshots in [start, end), the way the client publishes them
+def snapshot_lines(archive, start, end, tags):
+    for times, columns in archive.read(start, end):
+        split = [(split_column(name), values) for name, values in columns.items()]
+        for i, ts in enumerate(times):
+            fields = {}
+            lines = []
+            for (name, line_tags), values in split:
+                v = values[i]
+                if v != v:
+                    continue
+                if line_tags is None:
+                    fields[name] = v
+                else:
+                    lines.append(line_protocol({name: v}, tags=dict(tags, **line_tags), ts=ts))
+            if fields:
+                lines.insert(0, line_protocol(fields, tags=tags, ts=ts))
+            yield from lines
+
+
+def query(archive, args, start, end, tz):
+    out = csv.writer(sys.stdout)
+    if args.bucket:
+        # Buckets start at midnight in the timezone of the site (standard time)
+        origin = datetime(2000, 1, 1, tzinfo=tz).timestamp()
+        rows = archive.aggregate(start, end, parse_period(args.bucket), args.agg, args.fields, origin)
+        names = args.fields or sorted(set().union(*(values for _, values in rows)))
+        out.writerow(['time'] + names)
+        for ts, values in rows:
+            out.writerow([format_time(ts, tz)] + [values.get(k, '') for k in names])
+        return
+
+    names = args.fields or archive.columns(start, end)
+    out.writerow(['time'] + names)
+    for times, columns in archive.read(start, end, names):
+        for i, ts in enumerate(times):
+            out.writerow([format_time(ts, tz)] + [columns[k][i] if k in columns and columns[k][i] == columns[k][i]
+                                                  else '' for k in names])
+
+
+def export_parquet(archive, start, end, path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Exporting to Parquet needs pyarrow, install it with 'pip install pyarrow'")
+
+    names = archive.columns(start, end)
+    schema = pa.schema([('time', pa.timestamp('ms', tz='UTC'))] + [(k, pa.float64()) for k in names])
+    rows = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        # A row group per block
+        for times, columns in archive.read(start, end):
+            data = {'time': [round(t * 1000) for t in times]}
+            for k in names:
+                values = columns.get(k)
+                data[k] = [None] * len(times) if values is None else [v if v == v else None for v in values]
+            writer.write_table(pa.Table.from_pydict(data, schema=schema))
+            rows += len(times)
+    print(f"Exported {rows} snapshots to {path}", file=sys.stderr)
+
+
+def export(archive, args, start, end):
+    if args.format == 'parquet':
+        if not args.output:
+            raise SystemExit("Exporting to Parquet needs an output file")
+        export_parquet(archive, start, end, args.output)
+        return
+
+    tags = {'site': args.site} if args.site else {}
+    lines = snapshot_lines(archive, start, end, tags)
+    written = 0
+    if args.influx:
+        sink = InfluxSink(args.influx_url, args.influx_org, args.influx_bucket, args.influx_token, args.batch)
+        for line in lines:
+            sink.write([line])
+        sink.close()
+        written = sink.written
+    else:
+        f = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            for line in lines:
+                f.write(line + '\n')
+                written += 1
+        finally:
+            if args.output:
+                f.close()
+    print(f"Exported {written} lines", file=sys.stderr)
+
+
+def get_args():
+    parser = ArgumentParser(description="Query and export the local archive of the Solax client.")
+    parser.add_argument("command", choices=['query', 'export'])
+    parser.add_argument("--start", help="Start of the time range in site time, e.g. '2024-05-01 06:00'.")
+    parser.add_argument("--end", help="End of the time range in site time. Defaults to now.")
+    parser.add_argument("--fields", nargs='+', help="Columns to query. All if not given.")
+    parser.add_argument("--bucket", help="Aggregate over buckets of this length, e.g. 15m, 1h or 1d.")
+    parser.add_argument("--agg", help="Aggregate per bucket.", choices=['sum', 'mean', 'min', 'max', 'count'],
+                        default='mean')
+    parser.add_argument("--format", help="Export format.", choices=['lp', 'parquet'], default='lp')
+    parser.add_argument("-o", "--output", help="File to export to. Standard output if not given.")
+    parser.add_argument("--influx", action='store_true', help="Export line protocol directly to InfluxDB.")
+    parser.add_argument("--influx-url", default=f"http://{getenv('DOCKER_INFLUXDB_INIT_HOST', 'localhost').strip()}:"
+                                                f"{getenv('DOCKER_INFLUXDB_INIT_PORT', '8086').strip()}")
+    parser.add_argument("--influx-org", default=getenv('DOCKER_INFLUXDB_INIT_ORG', 'solar').strip())
+    parser.add_argument("--influx-bucket", default=getenv('DOCKER_INFLUXDB_INIT_BUCKET', 'telegraf').strip())
+    parser.add_argument("--influx-token", default=getenv('DOCKER_INFLUXDB_INIT_ADMIN_TOKEN', '').strip())
+    parser.add_argument("--batch", help="Lines per write to InfluxDB.", type=int, default=5000)
+    parser.add_argument("--site", help="Site to read (multi-site mode). Its data gets tagged with it.")
+    parser.add_argument("--dir", help="Archive directory. Defaults to ARCHIVE_DIR of the client env file.")
+    parser.add_argument("--env", help="Client env file.", default=env_file)
+    return parser.parse_args()
+
+
+def main(args):
+    with open(args.env, 'rb') as f:
+        settings = toml_load(f)['settings']
+    tz = ZoneInfo(settings['TIMEZONE']) if 'TIMEZONE' in settings else None
+    path = args.dir or settings.get('ARCHIVE_DIR')
+    if not path:
+        raise SystemExit(f"No ARCHIVE_DIR in {args.env}")
+    if args.site:
+        path = join(path, args.site)
+
+    start = parse_time(args.start, tz) if args.start else -inf
+    end = parse_time(args.end, tz) if args.end else inf
+    archive = Archive(path, readonly=True)
+    try:
+        if args.command == 'query':
+            query(archive, args, start, end, tz)
+        else:
+            export(archive, args, start, end)
+    finally:
+        archive.close()
+
+
+if __name__ == '__main__':
+    try:
+        main(get_args())
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
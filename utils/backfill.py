@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+
+# Backfill tool for the Solax PV monitoring client. Fills gaps in InfluxDB, e.g. after an outage of
+# the client container, with historical data.
+#
+# Reads historical inverter records either from the history endpoint of the Solax cloud (HISTORY_URL
+# in the client env file, walked in windows of --window hours per inverter) or from exported CSV,
+# JSON or JSON lines files, with one record per inverter and point in time shaped like the 'result'
+# of the realtime API ('inverterSN', 'uploadTime', 'acpower', ...). The records of all inverters get
+# merged in time order and turned into the same snapshots the client publishes, one per
+# QUERY_FREQUENCY slot, stamped with the records' upload time.
+#
+# The snapshots get written as InfluxDB line protocol either directly to InfluxDB in large batches
+# or to the mqtt broker at a throttled rate, from where telegraf picks them up like live data.
+#
+# Everything is streamed: only the current window of history records and one batch of lines are
+# held in memory. After each batch has been written the time up to which we are done gets
+# checkpointed, so an interrupted backfill resumes where it stopped when run again with the same
+# range, sources and checkpoint file. It uses its own mqtt client id and doesn't touch the
+# client's state, so it can run next to the live client. Mind that queries of the history
+# endpoint count against the same API quota as the live client's, see --api-rate.
+#
+# Run from the repository root, e.g.
+#     python3 utils/backfill.py --start "2024-05-01" --end "2024-05-03" --output influx
+#     python3 utils/backfill.py --files export.csv --output mqtt --mqtt-rate 10
+#     python3 utils/backfill.py --stub --start "2024-05-01" --end "2024-05-02" --dry-run
+
+import csv
+from argparse import ArgumentParser
+from datetime import datetime
+from gzip import compress as gzip_compress
+from heapq import merge
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from json import JSONDecoder, loads as json_loads, dumps as json_dumps
+from math import floor, sin, cos, pi
+from os import getenv
+from os.path import dirname, abspath
+from threading import Thread
+from time import sleep, monotonic
+from tomllib import load as toml_load
+from urllib.parse import urlparse, parse_qs
+from zoneinfo import ZoneInfo
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from requests import Session, exceptions as req_exceptions
+
+from client import (SolaxApi, Mqtt, Stats, add_sample, parse_upload_time, parse_inverter_line_file,
+                    line_protocol, env_file, inverter_line_file, client_id)
+from energy import EnergyAccount
+from state import StateStore
+from sample import Schema
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Keys of a record that aren't numbers
+TEXT_KEYS = ('inverterSN', 'sn', 'uploadTime', 'inverterType', 'inverterStatus', 'batStatus')
+
+
+# Parse a time given on the command line, e.g. "2024-05-01" or "2024-05-01 12:00:00", in the
+# timezone of the site
+def parse_time(s, tz):
+    for fmt in (TIME_FORMAT, '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(s, fmt).replace(tzinfo=tz).timestamp()
+        except ValueError:
+            continue
+    raise ValueError(f"Can't parse time '{s}'")
+
+
+def format_time(ts, tz):
+    return datetime.fromtimestamp(ts, tz).strftime(TIME_FORMAT)
+
+
+# ---- Sources. Each yields (<ts>, <sn>, <record>) in time order
+
+# Records of an inverter from the history endpoint of the Solax cloud, fetched window by window
+#
+# Params:
+#   :api:       SolaxApi pointed at the history endpoint
+#   :token:     Solax API token
+#   :sn:        inverter serial number
+#   :start/end: time range in seconds since the epoch
+#   :window:    seconds of history per request
+#   :tz:        timezone of the site
+#   :pace:      function to call before every request, for rate limiting
+def history_records(api, token, sn, start, end, window, tz, pace):
+    t = start
+    while t < end:
+        t1 = min(t + window, end)
+        pace()
+        params = {'tokenId': token, 'sn': sn, 'startTime': format_time(t, tz), 'endTime': format_time(t1, tz)}
+        response = api.get(params=params, headers={'Content-Type': 'application/json'})
+        if response is None or not response.get('success', False):
+            raise IOError(f"History query for {sn} from {params['startTime']} failed: "
+                          f"{response.get('exception') if response else 'no response'}")
+
+        records = []
+        for rec in response.get('result') or []:
+            ts = parse_upload_time(rec.get('uploadTime'), tz)
+            if ts is not None and t <= ts < t1:
+                records.append((ts, sn, rec))
+        yield from sorted(records, key=lambda r: r[0])
+        t = t1
+
+
+# Convert a value read from a CSV file
+def csv_value(k, v):
+    if v == '' or v is None:
+        return None
+    if k in TEXT_KEYS:
+        return v
+    try:
+        return float(v)
+    except ValueError:
+        return v
+
+
+# Stream the items of a JSON array without loading the whole file
+def json_array_items(f, chunk_size=1 << 16):
+    decoder = JSONDecoder()
+    buf = f.read(chunk_size).lstrip()
+    if not buf.startswith('['):
+        raise ValueError(f"Expected a JSON array in {f.name}")
+    buf = buf[1:]
+    while True:
+        buf = buf.lstrip(' \t\r\n,')
+        if not buf:
+            buf = f.read(chunk_size)
+            if not buf:
+                raise ValueError(f"Unterminated JSON array in {f.name}")
+            continue
+        if buf[0] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf)
+        except ValueError:
+            more = f.read(chunk_size)
+            if not more:
+                raise
+            buf += more
+            continue
+        yield item
+        buf = buf[end:]
+
+
+# Records from an exported file: CSV with a header line, a JSON array or JSON lines (.jsonl or
+# .ndjson). Records have to be in time order within a file
+def file_records(path, tz):
+    with open(path, newline='' if path.endswith('.csv') else None) as f:
+        if path.endswith('.csv'):
+            items = ({k: csv_value(k, v) for k, v in row.items()} for row in csv.DictReader(f))
+        elif path.endswith(('.jsonl', '.ndjson')):
+            items = (json_loads(line) for line in f if line.strip())
+        else:
+            items = json_array_items(f)
+        for rec in items:
+            ts = parse_upload_time(rec.get('uploadTime'), tz)
+            if ts is None or not rec.get('inverterSN'):
+                print(f"Skipping record without upload time or inverter in {path}: {rec}")
+                continue
+            yield ts, rec['inverterSN'], rec
+
+
+# ---- Snapshots
+
+# Group the merged records into snapshots, one per slot of 'freq' seconds. Yields
+# (<slot start>, {<sn>: <record>}) with the latest record per inverter within the slot
+def snapshots(records, freq):
+    slot, group = None, {}
+    for ts, sn, rec in records:
+        s = floor(ts / freq) * freq
+        if slot is not None and s != slot:
+            yield slot, group
+            group = {}
+        slot = s
+        group[sn] = (ts, rec)
+    if group:
+        yield slot, group
+
+
+# Turns snapshots into line protocol, the same way the client does for live data
+class Converter:
+    def __init__(self, sns, inverter_map, tz, tags=None, interval=None):
+        self.sns = set(sns)
+        self.inverter_map = inverter_map
+        self.schemas = {}
+        self.tags = tags or {}
+        # Snapshots carry the seconds since the previous one like the client's do. 'interval' is
+        # used for the first one
+        self.interval = interval
+        self.prev_ts = None
+        # Only used for the counter deltas since midnight, i.e. 'to_grid_today'
+        self.energy = EnergyAccount([], ['to_grid_total'], tz=tz)
+        self.skipped = 0
+
+    # Lines for a snapshot, or an empty list if it misses inverters or has incomplete data (which
+    # the client skips as well)
+    def lines(self, group):
+        if set(group) != self.sns:
+            self.skipped += 1
+            return []
+
+        stats = Stats()
+        line_stats = []
+        try:
+            for sn in sorted(group):
+                res = group[sn][1]
+                schema = self.schemas.get(sn)
+                if schema is None or not schema.covers(res):
+                    schema = Schema(sn, res, self.inverter_map)
+                line_stats += add_sample(stats, schema.sample(res))
+                self.schemas[sn] = schema
+        except (KeyError, TypeError, ValueError):
+            self.skipped += 1
+            return []
+
+        ts = max(ts for ts, _ in group.values())
+        self.energy.add(ts, {}, {'to_grid_total': stats.to_grid_total})
+        stats.to_grid_today = min(self.energy.today_counters().get('to_grid_total', 0.0), stats.yield_today)
+        stats.derive()
+        stats.interval = ts - self.prev_ts if self.prev_ts is not None else self.interval
+        self.prev_ts = ts
+
+        lines = [stats.to_line(ts, self.tags)]
+        for sn, line, name, p in line_stats:
+            lines.append(line_protocol({name: float(p)}, tags=dict(self.tags, sn=sn, line=line), ts=ts))
+        return lines
+
+
+# ---- Sinks. Buffer lines and write them in batches. write() returns True when it flushed
+
+class InfluxSink:
+    def __init__(self, url, org, bucket, token, batch=5000, retries=3):
+        self.url = url.rstrip('/') + '/api/v2/write'
+        self.params = {'org': org, 'bucket': bucket, 'precision': 'ns'}
+        self.headers = {'Authorization': f'Token {token}', 'Content-Type': 'text/plain; charset=utf-8',
+                        'Content-Encoding': 'gzip'}
+        self.batch = batch
+        self.retries = retries
+        self.session = Session()
+        self.buffer = []
+        self.written = 0
+
+    def write(self, lines):
+        self.buffer += lines
+        if len(self.buffer) >= self.batch:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if not self.buffer:
+            return
+        body = gzip_compress('\n'.join(self.buffer).encode())
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.url, params=self.params, headers=self.headers, data=body,
+                                             timeout=(5.0, 60.0))
+                if response.status_code < 500 and response.status_code != 429:
+                    response.raise_for_status()
+                    break
+                print(f"InfluxDB returned {response.status_code} (attempt {attempt + 1})")
+            except (req_exceptions.ConnectionError, req_exceptions.Timeout) as e:
+                print(f"Error connecting to InfluxDB (attempt {attempt + 1}):", e)
+            sleep(2 ** attempt)
+        else:
+            raise IOError(f"Giving up writing to InfluxDB after {self.retries + 1} attempts")
+        self.written += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.session.close()
+
+
+class MqttSink:
+    def __init__(self, settings, topic, rate=5.0, batch=500, timeout=180.0):
+        # Params:
+        #   :settings:  The 'settings' section of the client env file
+        #   :topic:     Topic to publish to
+        #   :rate:      Max number of messages per second
+        #   :batch:     Lines per message
+        #   :timeout:   Seconds to wait for the broker to acknowledge a message
+        self.topic = topic
+        self.interval = 1.0 / rate
+        self.batch = batch
+        self.timeout = timeout
+        self.mqtt = Mqtt(settings['BROKER_HOST'], settings['BROKER_PORT'], qos=1, client_id=f'{client_id}-backfill')
+        self.mqtt.connect_mqtt()
+        self.mqtt.client.loop_start()
+        self.last = 0.0
+        self.buffer = []
+        self.written = 0
+
+    def write(self, lines):
+        self.buffer += lines
+        if len(self.buffer) >= self.batch:
+            self.flush()
+            return True
+        return False
+
+    # Publish the buffered lines and wait for the broker to acknowledge them, so we never
+    # checkpoint lines that didn't make it. Raises TimeoutError if it doesn't, the backfill can
+    # then resume from the checkpoint
+    def flush(self):
+        if not self.buffer:
+            return
+        sleep(max(0.0, self.last + self.interval - monotonic()))
+        self.last = monotonic()
+        info = self.mqtt.client.publish(self.topic, '\n'.join(self.buffer), qos=1)
+        info.wait_for_publish(self.timeout)
+        if not info.is_published():
+            raise TimeoutError(f"The mqtt broker didn't acknowledge a message within {self.timeout}s")
+        self.written += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.mqtt.client.loop_stop()
+        self.mqtt.client.disconnect()
+
+
+# Sink for --dry-run, just counts the lines and prints the first ones
+class PrintSink:
+    def __init__(self, show=10):
+        self.show = show
+        self.written = 0
+
+    def write(self, lines):
+        for line in lines:
+            if self.written < self.show:
+                print(line)
+            self.written += 1
+        return False
+
+    def close(self):
+        pass
+
+
+# ---- Stub of the history endpoint, for testing without using the Solax API
+
+# Deterministic history record of a simulated inverter at time ts
+def stub_record(sn, ts, tz):
+    t = datetime.fromtimestamp(ts, tz)
+    hours = t.hour + t.minute / 60 + t.second / 3600
+    pv = 5000.0 * max(0.0, sin(pi * (hours - 6) / 12))
+    days = ts / 86400
+    # Counters grow by the average daily energy, today's yield by the integral of the sine
+    yield_today = 5.0 * 12 / pi * (1 - cos(pi * (min(max(hours, 6), 18) - 6) / 12))
+    return {'inverterSN': sn, 'uploadTime': t.strftime(TIME_FORMAT), 'inverterType': 14, 'inverterStatus': 102,
+            'acpower': pv * 0.9, 'powerdc1': pv * 0.6, 'powerdc2': pv * 0.4, 'batPower': 0.0, 'soc': 50.0,
+            'feedinpower': pv * 0.9 - 600.0, 'feedinenergy': 400.0 + 12.0 * days,
+            'consumeenergy': 300.0 + 6.0 * days, 'yieldtoday': yield_today, 'yieldtotal': 1000.0 + 19.0 * days}
+
+
+# Serve the stub history endpoint on a free local port. Returns its URL
+def start_stub(tz, interval=300):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(handler):
+            q = parse_qs(urlparse(handler.path).query)
+            start = parse_time(q['startTime'][0], tz)
+            end = parse_time(q['endTime'][0], tz)
+            first = (floor(start / interval) + (start % interval > 0)) * interval
+            result = [stub_record(q['sn'][0], ts, tz) for ts in range(int(first), int(end), interval)]
+            body = json_dumps({'success': True, 'exception': 'Query success!', 'result': result}).encode()
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'application/json')
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+
+        def log_message(handler, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def get_args():
+    parser = ArgumentParser(description="Backfill historical Solax data into InfluxDB.")
+    parser.add_argument("--start", help="Start of the time range in site time, e.g. '2024-05-01 06:00'.")
+    parser.add_argument("--end", help="End of the time range in site time. Defaults to now.")
+    parser.add_argument("-f", "--files", nargs='+', help="Read exported CSV/JSON/JSON lines files instead of the Solax cloud.")
+    parser.add_argument("--stub", action='store_true', help="Query a local stub of the history endpoint.")
+    parser.add_argument("--window", help="Hours of history per query of the history endpoint.", type=float, default=24)
+    parser.add_argument("--api-rate", help="History queries per minute. Shares the quota with the live client.", type=float, default=1)
+    parser.add_argument("-o", "--output", help="Where to write to.", choices=['influx', 'mqtt'], default='mqtt')
+    parser.add_argument("--dry-run", action='store_true', help="Only print what would be written.")
+    parser.add_argument("--influx-url", default=f"http://{getenv('DOCKER_INFLUXDB_INIT_HOST', 'localhost').strip()}:"
+                                                f"{getenv('DOCKER_INFLUXDB_INIT_PORT', '8086').strip()}")
+    parser.add_argument("--influx-org", default=getenv('DOCKER_INFLUXDB_INIT_ORG', 'solar').strip())
+    parser.add_argument("--influx-bucket", default=getenv('DOCKER_INFLUXDB_INIT_BUCKET', 'telegraf').strip())
+    parser.add_argument("--influx-token", default=getenv('DOCKER_INFLUXDB_INIT_ADMIN_TOKEN', '').strip())
+    parser.add_argument("--batch", help="Lines per write (InfluxDB) or message (mqtt).", type=int)
+    parser.add_argument("--mqtt-rate", help="Max mqtt messages per second.", type=float, default=5.0)
+    parser.add_argument("--mqtt-timeout", help="Seconds to wait for the broker to acknowledge a message.",
+                        type=float, default=180.0)
+    parser.add_argument("--checkpoint", help="Checkpoint file to resume from.", default="backfill_ckpt.json")
+    parser.add_argument("--site", help="Tag the data with this site (multi-site mode).")
+    parser.add_argument("--env", help="Client env file.", default=env_file)
+    return parser.parse_args()
+
+
+def main(args):
+    with open(args.env, 'rb') as f:
+        env = toml_load(f)
+    settings = env['settings']
+    tz = ZoneInfo(settings['TIMEZONE']) if 'TIMEZONE' in settings else None
+    freq = settings['QUERY_FREQUENCY']
+    sns = list(env['inverter_sns'].values())
+
+    # Where we stopped last time with the same range and sources, so a backfill of another range
+    # doesn't resume from this one. A dry run neither reads nor writes the checkpoint
+    ckpt = StateStore(args.checkpoint, compact_every=100) if not args.dry_run else None
+    ckpt_key = f"until:{args.start}|{args.end}|{','.join(args.files or sns)}"
+    done_until = ckpt.get(ckpt_key, 0.0) if ckpt is not None else 0.0
+    start = max(parse_time(args.start, tz) if args.start else 0.0, done_until)
+    end = parse_time(args.end, tz) if args.end else datetime.now().timestamp()
+    if done_until >= end:
+        ckpt.close()
+        print(f"Already backfilled up to {format_time(done_until, tz)} according to {args.checkpoint}, nothing "
+              f"to do. Use another --checkpoint to backfill the range again")
+        return
+    if done_until:
+        print(f"Resuming from {format_time(done_until, tz)}")
+
+    if args.files:
+        sources = [file_records(path, tz) for path in args.files]
+    else:
+        if not args.start:
+            raise SystemExit("--start is needed to query the history endpoint")
+        url = start_stub(tz) if args.stub else settings.get('HISTORY_URL')
+        if not url:
+            raise SystemExit(f"No HISTORY_URL in {args.env}")
+        api = SolaxApi(dict(settings, URL=url))
+        last = [0.0]
+
+        def pace():
+            sleep(max(0.0, last[0] + 60.0 / args.api_rate - monotonic()))
+            last[0] = monotonic()
+
+        sources = [history_records(api, settings['TOKEN'], sn, start, end, args.window * 3600, tz,
+                                   pace if not args.stub else lambda: None) for sn in sns]
+
+    if args.dry_run:
+        sink = PrintSink()
+    elif args.output == 'influx':
+        sink = InfluxSink(args.influx_url, args.influx_org, args.influx_bucket, args.influx_token, args.batch or 5000)
+    else:
+        sink = MqttSink(settings, settings['TOPIC'], args.mqtt_rate, args.batch or 500, args.mqtt_timeout)
+
+    converter = Converter(sns, parse_inverter_line_file(inverter_line_file), tz,
+                          {'site': args.site} if args.site else None, freq)
+    records = merge(*sources, key=lambda r: r[0])
+    snapshot_count = 0
+    last_slot = None
+    try:
+        for slot, group in snapshots(records, freq):
+            if slot < start or slot >= end:
+                continue
+            snapshot_count += 1
+            last_slot = slot
+            if sink.write(converter.lines(group)) and ckpt is not None:
+                # Everything before the next slot is written
+                ckpt.set(ckpt_key, slot + freq)
+        sink.close()
+        if last_slot is not None and ckpt is not None:
+            ckpt.set(ckpt_key, last_slot + freq)
+    finally:
+        if ckpt is not None:
+            ckpt.close()
+
+    print(f"Backfilled {snapshot_count} snapshots as {sink.written} lines, skipped {converter.skipped} incomplete ones")
+    if not snapshot_count:
+        print(f"The sources have no data between {format_time(start, tz)} and {format_time(end, tz)}")
+
+
+if __name__ == '__main__':
+    try:
+        main(get_args())
+    except KeyboardInterrupt:
+        pass
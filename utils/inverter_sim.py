@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# Simulator for Solax inverters on the local network. Allows to test the local data sources of the
+# client (SOURCE = "modbus" or "local_http") without hardware.
+#
+# Each simulated inverter listens on its own ports and serves
+#   - Modbus TCP: read holding/input registers (functions 0x03 and 0x04)
+#   - the local HTTP API of the dongle: POST / with optType=ReadRealTimeData returns the 'Data' array
+# The register contents follow the register maps in local_source.py and get updated continuously
+# from a simple model of a PV system with a battery: PV power follows the sun over the day, the
+# battery takes or delivers the difference to the house consumption and energy counters integrate
+# the power values.
+#
+# Run from the repository root, e.g.
+#     python3 utils/inverter_sim.py --inverters 2 --modbus-port 5020 --http-port 8080
+# and configure the client with
+#     SOURCE = "modbus"
+#     [local_inverters]
+#     SIM00001 = { host = "127.0.0.1", port = 5020 }
+#     SIM00002 = { host = "127.0.0.1", port = 5021 }
+
+import asyncio
+from argparse import ArgumentParser
+from datetime import datetime
+from json import dumps as json_dumps
+from math import sin, pi
+from os.path import dirname, abspath
+from random import gauss
+from struct import pack, unpack
+from time import monotonic
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from local_source import MODBUS_MAP, LOCAL_HTTP_MAP, encode
+
+
+# Model of a single inverter with two PV strings and a battery
+class SimInverter:
+    def __init__(self, sn, peak_power=5000.0, house_load=600.0, inverter_type=14):
+        self.sn = sn
+        self.peak_power = peak_power
+        self.house_load = house_load
+        self.inverter_type = inverter_type
+        self.soc = 50.0
+        self.yield_today = 0.0
+        self.yield_total = 1000.0
+        self.feedin_energy = 400.0
+        self.consume_energy = 300.0
+        self.last = monotonic()
+        self.day = datetime.now().date()
+        self.values = {}
+        self.update()
+
+    def update(self):
+        now = monotonic()
+        dt = now - self.last
+        self.last = now
+
+        t = datetime.now()
+        if t.date() != self.day:
+            self.day = t.date()
+            self.yield_today = 0.0
+
+        # PV power follows a sine between 6am and 6pm, split over two strings
+        hours = t.hour + t.minute / 60 + t.second / 3600
+        sun = max(0.0, sin(pi * (hours - 6) / 12))
+        pv = max(0.0, self.peak_power * sun + gauss(0, 20) * sun)
+        pv1, pv2 = pv * 0.6, pv * 0.4
+
+        # The battery takes what the house doesn't need (or delivers what is missing) within its
+        # limits, the grid gets the rest
+        load = max(0.0, self.house_load + gauss(0, 30))
+        bat = max(-2500.0, min(2500.0, pv - load))
+        if (bat > 0 and self.soc >= 100.0) or (bat < 0 and self.soc <= 10.0):
+            bat = 0.0
+        self.soc = max(0.0, min(100.0, self.soc + bat * dt / 3600 / 100))
+        ac = pv - bat
+        feedin = ac - load
+
+        kwh = dt / 3600 / 1000
+        self.yield_today += pv * kwh
+        self.yield_total += pv * kwh
+        if feedin > 0:
+            self.feedin_energy += feedin * kwh
+        else:
+            self.consume_energy -= feedin * kwh
+
+        self.values = {
+            'acpower': ac, 'runmode': 2 if pv > 0 else 0, 'powerdc1': pv1, 'powerdc2': pv2,
+            'batPower': bat, 'soc': self.soc, 'feedinpower': feedin,
+            'feedinenergy': self.feedin_energy, 'consumeenergy': self.consume_energy,
+            'yieldtoday': self.yield_today, 'yieldtotal': self.yield_total,
+        }
+
+    # Registers for the given register map
+    def registers(self, regmap):
+        regs = {}
+        for k, (addr, kind, scale) in regmap.items():
+            encode(regs, addr, kind, scale, self.values.get(k, 0))
+        return regs
+
+
+# Modbus TCP server for one simulated inverter
+async def serve_modbus(inverter, reader, writer):
+    try:
+        while True:
+            header = await reader.readexactly(7)
+            tid, pid, length, unit = unpack('>HHHB', header)
+            pdu = await reader.readexactly(length - 1)
+            function = pdu[0]
+            if function not in (0x03, 0x04):
+                resp = pack('>BB', function | 0x80, 0x01)
+            else:
+                start, count = unpack('>HH', pdu[1:5])
+                inverter.update()
+                regs = inverter.registers(MODBUS_MAP)
+                data = [regs.get(start + i, 0) for i in range(count)]
+                resp = pack(f'>BB{count}H', function, count * 2, *data)
+            writer.write(pack('>HHHB', tid, pid, len(resp) + 1, unit) + resp)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+# Local HTTP API server for one simulated inverter. Just enough HTTP to answer the dongle's
+# ReadRealTimeData request
+async def serve_http(inverter, reader, writer):
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = 0
+        for line in head.split(b'\r\n'):
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+
+        inverter.update()
+        regs = inverter.registers(LOCAL_HTTP_MAP)
+        data = [regs.get(i, 0) for i in range(max(regs) + 1)]
+        body = json_dumps({'sn': inverter.sn, 'ver': 'sim', 'type': inverter.inverter_type,
+                           'Data': data, 'Information': [inverter.peak_power / 1000, inverter.inverter_type,
+                                                         inverter.sn]}).encode()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                     + f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+# Start the servers for n simulated inverters. Returns the inverters and servers
+async def start_simulators(n, modbus_port=5020, http_port=8080, host='127.0.0.1'):
+    inverters, servers = [], []
+    for i in range(n):
+        inv = SimInverter(f"SIM{i + 1:05d}")
+        inverters.append(inv)
+        if modbus_port is not None:
+            servers.append(await asyncio.start_server(lambda r, w, inv=inv: serve_modbus(inv, r, w),
+                                                      host, modbus_port + i if modbus_port else 0))
+        if http_port is not None:
+            servers.append(await asyncio.start_server(lambda r, w, inv=inv: serve_http(inv, r, w),
+                                                      host, http_port + i if http_port else 0))
+    return inverters, servers
+
+
+def get_args():
+    parser = ArgumentParser(description="Simulate Solax inverters serving Modbus TCP and the dongle's local HTTP API.")
+    parser.add_argument("-n", "--inverters", help="Number of inverters to simulate.", type=int, default=1)
+    parser.add_argument("-mp", "--modbus-port", help="Modbus TCP port of the first inverter.", type=int, default=5020)
+    parser.add_argument("-hp", "--http-port", help="Local HTTP API port of the first inverter.", type=int, default=8080)
+    parser.add_argument("--host", help="Address to listen on.", default='127.0.0.1')
+    return parser.parse_args()
+
+
+async def main(args):
+    inverters, servers = await start_simulators(args.inverters, args.modbus_port, args.http_port, args.host)
+    for i, inv in enumerate(inverters):
+        print(f"{inv.sn}: Modbus TCP on {args.host}:{args.modbus_port + i}, local HTTP API on {args.host}:{args.http_port + i}")
+    await asyncio.gather(*(s.serve_forever() for s in servers))
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main(get_args()))
+    except KeyboardInterrupt:
+        pass
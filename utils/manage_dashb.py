@@ -10,20 +10,73 @@
 # tool to automatically modify the dashboard json file to represent the desired language. You can
 # then import it into Grafana to get a dashboard with the desired language support.
 #
+# It also helps with dashboards over long time ranges, which otherwise read every raw point:
+#   - it generates InfluxDB buckets with rollups of all metrics the client publishes over 5m, 1h and
+#     1d, and the tasks keeping them up to date, and can compute the rollups of the existing data
+#   - it rewrites the panel queries to read from the coarsest rollup that is still finer than the
+#     interval Grafana asks for
+#   - it times the panel queries against InfluxDB and reports the slowest ones
+#
+# For a fleet of dashboards in several languages and for several sites there is a batch mode. It
+# reads a manifest of dashboards x label maps x sites, applies all transforms to each variant in one
+# pass, spreads the variants over a process pool and only writes the outputs whose inputs changed
+# (by content hash). Grafana can be told to reload its provisioned dashboards afterwards.
+#
 # Use the --help / -h option for usage information
 
-from tempfile import mktemp
-from json import load as json_load, dump as json_dump
+from tempfile import mktemp, NamedTemporaryFile
+from json import load as json_load, dump as json_dump, loads as json_loads, dumps as json_dumps
 from tomllib import load as toml_load
+from io import BytesIO
 from argparse import ArgumentParser
 from shutil import move
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from hashlib import sha1, sha256
+from os import getenv, makedirs, replace, cpu_count
+from os.path import join, dirname, abspath, basename, splitext, exists
+from statistics import median
+from time import perf_counter, time
+from zoneinfo import ZoneInfo
+import re
+import sys
 
 dashb_infile = "dashboard.json"
 dashb_outfile = "dashb_out.json"
 map_file = "dashb_map.toml"
 client_env = ".client-env"
+rollup_dir = "rollups"
+batch_state_file = ".dashb_batch.json"
 QUERY_FREQ_LABEL = "QueryFrequency"
 
+# Measurement the client publishes its snapshots as and the bucket telegraf writes them to
+MEASUREMENT = "telegraf_message"
+BUCKET = getenv('DOCKER_INFLUXDB_INIT_BUCKET', 'telegraf').strip()
+
+# Rollup levels as (<window>, <seconds>), each computed from the previous one, the first from the
+# raw data. A rollup bucket is named after the raw bucket and the window, e.g. 'telegraf_5m', and
+# holds the mean, min, max and last value per window of every field, tagged with 'agg' and stamped
+# with the start of the window
+ROLLUPS = [('5m', 300), ('1h', 3600), ('1d', 86400)]
+ROLLUP_AGGS = ['mean', 'min', 'max', 'last']
+
+# The intervals (s) Grafana rounds v.windowPeriod to
+GRAFANA_INTERVALS = [1, 5, 10, 15, 30, 60, 300, 600, 900, 1800, 3600, 7200, 10800, 21600, 43200, 86400,
+                     604800, 2592000]
+
+# Flux function computing the rollups of a stream over windows of 'every'. Works on raw data and
+# on rollups, whose aggregates get aggregated with the same function
+ROLLUP_FN = """rollup = (tables=<-, every, offset=0s) => {
+    agg = (name, fn) => tables
+        |> filter(fn: (r) => not exists r.agg or r.agg == name)
+        |> drop(fn: (column) => column == "agg")
+        |> aggregateWindow(every: every, offset: offset, fn: fn, timeSrc: "_start", createEmpty: false)
+        |> set(key: "agg", value: name)
+
+    return union(tables: [%s])
+}
+""" % ', '.join(f'agg(name: "{a}", fn: {a})' for a in ROLLUP_AGGS)
+
 
 class LabelMap():
     # Class to handle the simple label map toml format
@@ -42,7 +95,7 @@ class LabelMap():
     def get_map_from_dashboard(self, dashboard):
         # Creates a map from a Grafana JSON dashboard. The function doesn't parse the complete
         # JSON file but focuses on variable definitions under 'templating'
-        with open(self.outf, "a") as f:
+        with open(self.outf, "w") as f:
             for rec in dashboard['templating']['list']:
                 # Depending on the type of variable, there is either a 'label' attribute
                 # containing the label test we are looking for or it is in a 'text' attribute
@@ -84,24 +137,7 @@ class Dashboard():
         dashboard = self.read_dashb()
 
         for rec in dashboard['templating']['list']:
-            # Also here we need to handle the two types of variable which have the label either in
-            # a 'label' attributed or under 'current/test', 'current/value', 'options[0]/text' and
-            # 'options[0]/value'. In each we have to set our label text from the map
-            nm = rec['name']
-            if nm not in map:
-                continue
-            label = map[nm]
-            if 'label' in rec:
-                rec['label'] = label
-            elif 'text' in rec['current']:
-                rec['current']['text'] = label
-                rec['current']['value'] = label
-                rec['options'][0]['text'] = label
-                rec['options'][0]['value'] = label
-                rec['query'] = label
-            else:
-                print('Neither "label" nor "text" in templating record. Skipping ...')
-                continue
+            map_label(rec, map)
 
         self._safe_write(dashboard)
 
@@ -111,32 +147,22 @@ class Dashboard():
         # we are configuring for our InfluDB data source as name
         dashboard = self.read_dashb()
 
-        for rec in dashboard['panels']:
-            if 'targets' in rec:
-                for tgts in rec['targets']:
-                    if 'datasource' in tgts and 'uid' in tgts['datasource']:
-                        # print(tgts['datasource']['uid'] = "influxdb")
-                        tgts['datasource']['uid'] = "influxdb"
+        for rec in panels(dashboard):
+            for tgts in rec.get('targets', []):
+                fix_target_datasource(tgts)
 
         self._safe_write(dashboard)
 
     def set_query_freq(self):
         # Set the QueryFrequency variable in a dashboard file to the value configured in the
         # .client_env config file
-
-        # Query frequency variable is used for calculations in dashboard to need to append .0
-        query_freq = str(self._get_query_freq()) + ".0"
+        query_freq = format_query_freq(self._get_query_freq())
 
         dashboard = self.read_dashb()
 
         for rec in dashboard['templating']['list']:
-            nm = rec['name']
-            if nm == QUERY_FREQ_LABEL:
-                rec['current']['text'] = query_freq
-                rec['current']['value'] = query_freq
-                rec['options'][0]['text'] = query_freq
-                rec['options'][0]['value'] = query_freq
-                rec['query'] = query_freq
+            if rec['name'] == QUERY_FREQ_LABEL:
+                set_text(rec, query_freq)
 
         self._safe_write(dashboard)
 
@@ -148,6 +174,491 @@ class Dashboard():
             cl_env = toml_load(f)
         return cl_env['settings']['QUERY_FREQUENCY']
 
+    def rewrite_queries(self):
+        # Let the panel queries read from the rollup buckets (see Rollups). Only queries that
+        # aggregate the raw data over Grafana's interval (v.windowPeriod) with one of the rollup
+        # aggregates can be answered from a rollup. They get a bucket picked by that interval: the
+        # coarsest rollup that is at most as long, the raw bucket below the shortest rollup
+        dashboard = self.read_dashb()
+
+        rewritten = skipped = 0
+        for panel in panels(dashboard):
+            for tgt in panel.get('targets', []):
+                query = tgt.get('query')
+                if not query:
+                    continue
+                new_query = rollup_query(query)
+                if new_query is None:
+                    skipped += 1
+                elif new_query != query:
+                    tgt['query'] = new_query
+                    rewritten += 1
+
+        self._safe_write(dashboard)
+
+        print(f"Rewrote {rewritten} queries to use the rollups in {self.dashb_outfile}, {skipped} queries need "
+              f"the raw data.")
+
+    def variables(self):
+        # The current values of the dashboard variables
+        dashboard = self.read_dashb()
+        values = {}
+        for rec in dashboard['templating']['list']:
+            current = rec.get('current', {})
+            values[rec['name']] = str(current.get('value', current.get('text', rec.get('query', ''))))
+        return values
+
+
+def map_label(rec, map):
+    # Set the label of a variable from the map. There are two types of variable which have the
+    # label either in a 'label' attributed or under 'current/test', 'current/value',
+    # 'options[0]/text' and 'options[0]/value'
+    nm = rec['name']
+    if nm not in map:
+        return
+    if 'label' in rec:
+        rec['label'] = map[nm]
+    elif 'text' in rec['current']:
+        set_text(rec, map[nm])
+    else:
+        print('Neither "label" nor "text" in templating record. Skipping ...')
+
+
+def set_text(rec, text):
+    # Set the text of a textbox variable
+    rec['current']['text'] = text
+    rec['current']['value'] = text
+    rec['options'][0]['text'] = text
+    rec['options'][0]['value'] = text
+    rec['query'] = text
+
+
+def format_query_freq(query_freq):
+    # Query frequency variable is used for calculations in dashboard so it needs to be a float
+    return str(float(query_freq))
+
+
+def fix_target_datasource(tgt):
+    if 'datasource' in tgt and 'uid' in tgt['datasource']:
+        tgt['datasource']['uid'] = "influxdb"
+
+
+def panels(dashboard):
+    # All panels of a dashboard, including those in (collapsed) rows
+    for panel in dashboard.get('panels', []):
+        yield panel
+        yield from panels(panel)
+
+
+def rollup_query(query):
+    # The Flux query rewritten to read from the rollup buckets, the query itself if it already
+    # does and None if it can't
+    if 'rollup_bucket' in query:
+        return query
+    source = f'from(bucket: "{BUCKET}")'
+    measurement = f'filter(fn: (r) => r["_measurement"] == "{MEASUREMENT}")'
+    windows = re.findall(r'aggregateWindow\(', query)
+    match = re.search(r'aggregateWindow\(every:\s*v\.windowPeriod,\s*fn:\s*(\w+)\b', query)
+    if query.count(source) != 1 or measurement not in query or 'range(start: v.timeRangeStart' not in query \
+            or len(windows) != 1 or match is None or match.group(1) not in ROLLUP_AGGS:
+        return None
+    # Nothing may look at single points before they get aggregated
+    before = query[:match.start()]
+    if any(k in before for k in ('_value', 'map(', 'truncateTimeColumn', 'multiplyBy', 'sum(', 'count(')):
+        return None
+
+    choice = ''.join(f'if int(v: v.windowPeriod) >= int(v: {window}) then "{BUCKET}_{window}"\n    else '
+                     for window, _ in reversed(ROLLUPS))
+    preamble = f'rollup_bucket = {choice}"{BUCKET}"\n\n'
+    query = query.replace(source, 'from(bucket: rollup_bucket)')
+    query = query.replace(measurement, measurement + f'\n  |> filter(fn: (r) => not exists r.agg or r.agg == '
+                                                     f'"{match.group(1)}")\n'
+                                                     f'  |> drop(fn: (column) => column == "agg")', 1)
+    imports, body = split_imports(query)
+    return imports + preamble + body
+
+
+def split_imports(query):
+    # Split a Flux query into its imports, which have to come first, and the rest
+    lines = query.split('\n')
+    n = 0
+    for i, line in enumerate(lines):
+        if line.startswith('import '):
+            n = i + 1
+    imports = '\n'.join(lines[:n])
+    return (imports + '\n\n' if imports else ''), '\n'.join(lines[n:]).lstrip('\n')
+
+
+def duration(seconds):
+    # A Flux duration literal for a number of seconds
+    for unit, length in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds and seconds % length == 0:
+            return f"{seconds // length}{unit}"
+    return f"{seconds}s"
+
+
+def parse_duration(text):
+    # Seconds of a duration like 30m, 12h or 7d
+    return int(text[:-1]) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}[text[-1]]
+
+
+class Influx():
+    # Minimal client for the InfluxDB v2 HTTP API, enough to manage buckets and tasks and to run
+    # queries
+    def __init__(self, url, org, token):
+        # requests is only needed for talking to InfluxDB
+        from requests import Session
+
+        self.url = url.rstrip('/')
+        self.org = org
+        self.session = Session()
+        self.session.headers['Authorization'] = f'Token {token}'
+        self._org_id = None
+
+    def _call(self, method, path, **kwargs):
+        response = self.session.request(method, self.url + path, timeout=(5.0, 300.0), **kwargs)
+        if response.status_code >= 400:
+            raise IOError(f"InfluxDB returned {response.status_code} for {method} {path}: {response.text.strip()}")
+        return response
+
+    def org_id(self):
+        if self._org_id is None:
+            self._org_id = self._call('GET', '/api/v2/orgs', params={'org': self.org}).json()['orgs'][0]['id']
+        return self._org_id
+
+    def ensure_bucket(self, name):
+        # Create the bucket unless it exists. Returns whether it got created
+        buckets = self._call('GET', '/api/v2/buckets', params={'orgID': self.org_id(), 'name': name}).json()
+        if buckets.get('buckets'):
+            return False
+        self._call('POST', '/api/v2/buckets', json={'orgID': self.org_id(), 'name': name, 'retentionRules': []})
+        return True
+
+    def ensure_task(self, name, flux):
+        # Create the task or update its script. Returns whether it got created
+        tasks = self._call('GET', '/api/v2/tasks', params={'orgID': self.org_id(), 'name': name}).json()
+        for task in tasks.get('tasks', []):
+            if task['name'] == name:
+                self._call('PATCH', f"/api/v2/tasks/{task['id']}", json={'flux': flux, 'status': 'active'})
+                return False
+        self._call('POST', '/api/v2/tasks', json={'orgID': self.org_id(), 'flux': flux})
+        return True
+
+    def query(self, flux):
+        # Run a query and return the result as CSV
+        return self._call('POST', '/api/v2/query', params={'org': self.org},
+                          headers={'Accept': 'application/csv', 'Content-Type': 'application/json'},
+                          json={'query': flux, 'type': 'flux', 'dialect': {'annotations': []}}).text
+
+    def close(self):
+        self.session.close()
+
+
+class Rollups():
+    # The rollup buckets of the raw bucket and the tasks computing them. The daily rollups start at
+    # midnight in TIMEZONE of the .client_env config file (standard time), like the client's energy
+    # buckets
+    def __init__(self, org):
+        self.org = org
+        with open(client_env, "rb") as f:
+            settings = toml_load(f)['settings']
+        tz = ZoneInfo(settings['TIMEZONE']) if 'TIMEZONE' in settings else timezone.utc
+        # Seconds after midnight UTC the day starts at
+        self.day_offset = -int(datetime(2000, 1, 1, tzinfo=tz).utcoffset().total_seconds()) % 86400
+
+    def levels(self):
+        # (<window>, <seconds>, <bucket>, <source bucket>, <window offset in seconds>) per rollup
+        source = BUCKET
+        for window, seconds in ROLLUPS:
+            offset = self.day_offset % seconds
+            yield window, seconds, f"{BUCKET}_{window}", source, offset
+            source = f"{BUCKET}_{window}"
+
+    def pipeline(self, source, bucket, seconds, offset, start):
+        return (f'from(bucket: "{source}")\n'
+                f'  |> range(start: {start})\n'
+                f'  |> filter(fn: (r) => r["_measurement"] == "{MEASUREMENT}")\n'
+                f'  |> drop(columns: ["host"])\n'
+                f'  |> rollup(every: {duration(seconds)}, offset: {duration(offset)})\n'
+                f'  |> to(bucket: "{bucket}", org: "{self.org}")\n')
+
+    def task(self, n, window, seconds, bucket, source, offset):
+        # Flux script of the task for a rollup level. Runs a minute per level after the end of
+        # each window, so the level below is complete. Daily rollups get updated every hour with
+        # the data of the current and the previous day
+        name = f"rollup_{bucket}"
+        if seconds < 86400:
+            header = f'option task = {{name: "{name}", every: {window}, offset: {n + 1}m}}\n\n'
+            start = '-task.every'
+        else:
+            header = f'option task = {{name: "{name}", every: 1h, offset: {n + 1}m}}\n\n'
+            header += (f'day = int(v: 1d)\n'
+                       f'start = time(v: (int(v: now()) - int(v: {duration(offset)})) / day * day '
+                       f'+ int(v: {duration(offset)}) - day)\n\n')
+            start = 'start'
+        return name, header + ROLLUP_FN + '\n' + self.pipeline(source, bucket, seconds, offset, start)
+
+    def tasks(self):
+        return [self.task(n, *level) for n, level in enumerate(self.levels())]
+
+    def write(self, path):
+        makedirs(path, exist_ok=True)
+        for name, flux in self.tasks():
+            with open(join(path, name + '.flux'), 'w') as f:
+                f.write(flux)
+        print(f"Wrote {len(ROLLUPS)} rollup tasks to {path}")
+
+    def create(self, influx):
+        for window, seconds, bucket, source, offset in self.levels():
+            print(f"Bucket {bucket} {'created' if influx.ensure_bucket(bucket) else 'exists'}")
+        for name, flux in self.tasks():
+            print(f"Task {name} {'created' if influx.ensure_task(name, flux) else 'updated'}")
+
+    def backfill(self, influx, days, chunk_days=30):
+        # Compute the rollups of the last 'days' days of data, up to where the tasks take over. Runs
+        # level by level, in chunks of 'chunk_days' that start at midnight of the daily rollups
+        now = int(time())
+        first = (now - days * 86400 - self.day_offset) // 86400 * 86400 + self.day_offset
+        for window, seconds, bucket, source, offset in self.levels():
+            end = (now - offset) // seconds * seconds + offset
+            start = first
+            while start < end:
+                stop = min(end, start + chunk_days * 86400)
+                span = (f'{datetime.fromtimestamp(start, timezone.utc).isoformat()}, '
+                        f'stop: {datetime.fromtimestamp(stop, timezone.utc).isoformat()}').replace('+00:00', 'Z')
+                influx.query(ROLLUP_FN + '\n' + self.pipeline(source, bucket, seconds, offset, span))
+                start = stop
+            print(f"Computed the {window} rollups of the last {days} days")
+
+
+def time_queries(dashb, influx, range_text, max_points=1000, repeat=3, top=10):
+    # Run the queries of all panels the way Grafana would for a time range of the last 'range_text'
+    # (e.g. 7d) and print the slowest ones. Grafana asks for about one point per pixel, which
+    # 'max_points' stands in for, rounded to an even interval
+    dashboard = dashb.read_dashb()
+    values = dashb.variables()
+    seconds = parse_duration(range_text)
+    window = next((i for i in GRAFANA_INTERVALS if i >= seconds / max_points), GRAFANA_INTERVALS[-1])
+    v = f'v = {{timeRangeStart: -{range_text}, timeRangeStop: now(), windowPeriod: {duration(window)}}}\n\n'
+
+    # Longer variable names first, so $Cost doesn't get replaced within $CostLabel
+    names = sorted(values, key=len, reverse=True)
+
+    def resolve(text):
+        for name in names:
+            text = text.replace('${' + name + '}', values[name]).replace('$' + name, values[name])
+        return text
+
+    results = []
+    for panel in panels(dashboard):
+        for tgt in panel.get('targets', []):
+            if not tgt.get('query'):
+                continue
+            imports, body = split_imports(resolve(tgt['query']))
+            flux = imports + v + body
+            times = []
+            try:
+                for _ in range(repeat):
+                    start = perf_counter()
+                    csv = influx.query(flux)
+                    times.append(perf_counter() - start)
+                rows = sum(1 for line in csv.splitlines() if line.strip() and not line.startswith(',result'))
+                results.append((median(times), rows, resolve(panel.get('title', '')), tgt.get('refId', ''), ''))
+            except IOError as e:
+                results.append((0.0, 0, resolve(panel.get('title', '')), tgt.get('refId', ''), str(e)))
+
+    results.sort(key=lambda r: r[0], reverse=True)
+    print(f"{len(results)} queries over the last {range_text} with windowPeriod {duration(window)}, "
+          f"median of {repeat} runs")
+    print(f"{'ms':>8} {'rows':>7}  panel")
+    for t, rows, title, ref, error in results[:top]:
+        print(f"{t * 1000:8.1f} {rows:7d}  {title} ({ref})" + (f"  FAILED: {error}" if error else ''))
+    failed = [r for r in results if r[4]]
+    if failed:
+        print(f"{len(failed)} queries failed")
+    print(f"Total {sum(r[0] for r in results) * 1000:.0f} ms")
+
+
+def site_query(query, site):
+    # The Flux query restricted to the data of a site (see the 'site' tag of the client in
+    # multi-site mode)
+    measurement = f'filter(fn: (r) => r["_measurement"] == "{MEASUREMENT}")'
+    return query.replace(measurement, measurement + f'\n  |> filter(fn: (r) => r["site"] == "{site}")')
+
+
+def transform(dashboard, map=None, query_freq=None, fix_datasource=False, rewrite_queries=False, site=None):
+    # Apply all transforms to a dashboard in one pass over its variables and one over its panels.
+    # Same as write_dashb(), set_query_freq(), fix_datasource() and rewrite_queries() of Dashboard
+    # one after the other, plus restricting the queries to a site
+    for rec in dashboard['templating']['list']:
+        if map:
+            map_label(rec, map)
+        if query_freq is not None and rec['name'] == QUERY_FREQ_LABEL:
+            set_text(rec, query_freq)
+
+    for panel in panels(dashboard):
+        for tgt in panel.get('targets', []):
+            if fix_datasource:
+                fix_target_datasource(tgt)
+            query = tgt.get('query')
+            if not query:
+                continue
+            if rewrite_queries:
+                query = rollup_query(query) or query
+            if site is not None:
+                query = site_query(query, site)
+            tgt['query'] = query
+    return dashboard
+
+
+def variant_uid(uid, variant):
+    # Uid of a variant of a dashboard. Grafana needs it unique and allows 40 characters at most
+    if not variant:
+        return uid
+    return f"{uid[:31]}-{sha1(variant.encode()).hexdigest()[:8]}"
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_if_changed(path, text):
+    # Write the file unless it already has that content. Written to a temporary file in the same
+    # directory first, so Grafana never sees half a dashboard. Returns whether it got written
+    data = text.encode()
+    if exists(path) and read_bytes(path) == data:
+        return False
+    with NamedTemporaryFile("wb", dir=dirname(abspath(path)), prefix=".dashb_", delete=False) as f:
+        f.write(data)
+    replace(f.name, path)
+    return True
+
+
+def batch_job(job):
+    # Build one output of the batch. Runs in a worker process. Returns (<output>, <state entry>,
+    # <what happened>) with the state entry holding the hash of everything the output is made of
+    # ('key') and of the output itself ('hash')
+    source = read_bytes(job['input'])
+    map_source = read_bytes(job['map']) if job['map'] else b''
+    params = json_dumps({k: v for k, v in job.items() if k != 'previous'}, sort_keys=True).encode()
+    key = sha256(b'\0'.join((source, map_source, params, read_bytes(__file__)))).hexdigest()
+
+    previous = job['previous']
+    if previous and previous['key'] == key and exists(job['output']) \
+            and sha256(read_bytes(job['output'])).hexdigest() == previous['hash']:
+        return job['output'], previous, 'unchanged'
+
+    dashboard = json_loads(source)
+    map = toml_load(BytesIO(map_source)) if job['map'] else None
+    transform(dashboard, map=map, query_freq=job['query_freq'], fix_datasource=job['fix_datasource'],
+              rewrite_queries=job['rewrite_queries'], site=job['site'])
+    fields = {'title': dashboard.get('title', ''), 'name': job['name'], 'map': job['map_name'] or '',
+              'site': job['site'] or ''}
+    dashboard['title'] = job['title'].format(**fields)
+    dashboard['uid'] = variant_uid(dashboard.get('uid', ''), job['variant'])
+    dashboard['id'] = None
+
+    text = json_dumps(dashboard, indent=4)
+    written = write_if_changed(job['output'], text)
+    return job['output'], {'key': key, 'hash': sha256(text.encode()).hexdigest()}, \
+        'written' if written else 'unchanged'
+
+
+def batch_jobs(manifest, state):
+    # The outputs of a manifest as jobs for batch_job(). Every dashboard gets built for each of
+    # its label maps (or with its own labels if it has none) and each of its sites (or for all
+    # data if it has none)
+    # The site configs of the client are only needed for the batch mode, the other modes work with
+    # this file alone
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+    from sites import load_sites
+
+    output_dir = manifest.get('output_dir', '.')
+    with open(client_env, "rb") as f:
+        env = toml_load(f)
+    sites = load_sites(env)
+
+    jobs = []
+    for dashb in manifest['dashboards']:
+        name = dashb.get('name', splitext(basename(dashb['input']))[0])
+        maps = dashb.get('maps', {None: None})
+        dashb_sites = dashb.get('sites', [None])
+        if dashb_sites == '*' or dashb_sites == ['*']:
+            dashb_sites = list(sites)
+        options = {k: dashb.get(k, manifest.get(k, default)) for k, default in
+                   (('fix_datasource', True), ('query_freq', True), ('rewrite_queries', False))}
+        for map_name, map_path in maps.items():
+            for site in dashb_sites:
+                if site is not None and site not in sites:
+                    raise ValueError(f"Dashboard '{name}' is for site '{site}', which isn't configured")
+                settings = (sites[site] if site is not None else env)['settings']
+                output = dashb.get('output', '{name}' + ('_{map}' if map_name else '')
+                                   + ('_{site}' if site else '') + '.json')
+                output = join(output_dir, output.format(name=name, map=map_name or '', site=site or ''))
+                title = dashb.get('title', '{title}' + (' ({map})' if map_name else '')
+                                  + (' - {site}' if site else ''))
+                jobs.append({'input': dashb['input'], 'name': name, 'map_name': map_name, 'map': map_path,
+                             'site': site, 'output': output, 'title': title,
+                             'variant': '/'.join(v for v in (map_name, site) if v),
+                             'query_freq': format_query_freq(settings['QUERY_FREQUENCY'])
+                             if options['query_freq'] else None,
+                             'fix_datasource': options['fix_datasource'],
+                             'rewrite_queries': options['rewrite_queries'],
+                             'previous': state.get(output)})
+
+    outputs = [job['output'] for job in jobs]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Several variants of the manifest write to the same output. Check the output names.")
+    return jobs
+
+
+def run_batch(manifest_file, jobs=None):
+    # Build all dashboards of a manifest. Returns the number of outputs written
+    with open(manifest_file, "rb") as f:
+        manifest = toml_load(f)
+    output_dir = manifest.get('output_dir', '.')
+    makedirs(output_dir, exist_ok=True)
+    state_path = join(output_dir, batch_state_file)
+    state = json_loads(read_bytes(state_path)) if exists(state_path) else {}
+
+    start = perf_counter()
+    todo = batch_jobs(manifest, state)
+    if jobs == 1 or len(todo) <= 1:
+        results = [batch_job(job) for job in todo]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(batch_job, todo))
+
+    written = 0
+    new_state = {}
+    for output, entry, what in results:
+        new_state[output] = entry
+        if what == 'written':
+            written += 1
+            print(f"Wrote {output}")
+    for output in state:
+        if output not in new_state:
+            print(f"{output} is no longer in the manifest. Remove it if it isn't needed anymore.")
+    if new_state != state:
+        write_if_changed(state_path, json_dumps(new_state, indent=4, sort_keys=True))
+
+    print(f"{len(results)} dashboards, {written} written, {len(results) - written} unchanged in "
+          f"{perf_counter() - start:.2f} s")
+    return written
+
+
+def reload_grafana(url, user, password):
+    # Let Grafana reload the provisioned dashboards, instead of waiting for it to notice
+    # requests is only needed for talking to Grafana
+    from requests import post
+
+    response = post(url.rstrip('/') + '/api/admin/provisioning/dashboards/reload', auth=(user, password),
+                    timeout=(5.0, 60.0))
+    if response.status_code >= 400:
+        raise IOError(f"Grafana returned {response.status_code} for reloading the dashboards: "
+                      f"{response.text.strip()}")
+    print("Grafana reloaded the provisioned dashboards")
 
 
 def get_args():
@@ -168,6 +679,32 @@ the language of the labels.""", \
     parser.add_argument("-fd", "--fix-datasource", help="Fix datasource uids in  dashboard file.", action="store_true")
     parser.add_argument("-cm", "--create-map", help="Create map file from dashboard.", action="store_true")
     parser.add_argument("-qf", "--query-freq", help="Set query frequency.", action="store_true")
+    parser.add_argument("-ru", "--rollups", action="store_true", help="""
+Write the rollup tasks as Flux files to --rollup-dir. With --influx also create the rollup buckets and tasks in
+InfluxDB.""")
+    parser.add_argument("-rd", "--rollup-dir", help="Directory for the rollup task files.", default=rollup_dir)
+    parser.add_argument("-bf", "--backfill-days", type=int, default=0,
+                        help="With --rollups and --influx, also compute the rollups of that many days of existing data.")
+    parser.add_argument("-rq", "--rewrite-queries", help="Let the panel queries read from the rollups.",
+                        action="store_true")
+    parser.add_argument("-tq", "--time-queries", help="Time the panel queries against InfluxDB.", action="store_true")
+    parser.add_argument("--range", help="Time range to run the panel queries over, e.g. 24h, 7d or 52w.", default="7d")
+    parser.add_argument("--repeat", help="Runs per panel query.", type=int, default=3)
+    parser.add_argument("--top", help="Number of slowest panel queries to report.", type=int, default=10)
+    parser.add_argument("--influx", help="Create the rollups in InfluxDB.", action="store_true")
+    parser.add_argument("--influx-url", default=f"http://{getenv('DOCKER_INFLUXDB_INIT_HOST', 'localhost').strip()}:"
+                                                f"{getenv('DOCKER_INFLUXDB_INIT_PORT', '8086').strip()}")
+    parser.add_argument("--influx-org", default=getenv('DOCKER_INFLUXDB_INIT_ORG', 'solar').strip())
+    parser.add_argument("--influx-token", default=getenv('DOCKER_INFLUXDB_INIT_ADMIN_TOKEN', '').strip())
+    parser.add_argument("-b", "--batch", metavar="MANIFEST", help="""
+Build all dashboards of a manifest file (toml) of dashboards x label maps x sites. Only outputs whose inputs changed
+get written.""")
+    parser.add_argument("-j", "--jobs", help="Worker processes for --batch.", type=int, default=cpu_count())
+    parser.add_argument("--reload", action="store_true",
+                        help="With --batch, let Grafana reload the provisioned dashboards if any got written.")
+    parser.add_argument("--grafana-url", default=f"http://localhost:{getenv('GRAFANA_PORT', '3000').strip()}")
+    parser.add_argument("--grafana-user", default=getenv('GF_SECURITY_ADMIN_USER', 'admin').strip())
+    parser.add_argument("--grafana-password", default=getenv('GF_SECURITY_ADMIN_PASSWORD', 'admin').strip())
 
     args = parser.parse_args()
 
@@ -187,6 +724,11 @@ def run():
 
     Dashb = Dashboard(dashb_outfile=args.dashb_out, dashb_infile=args.dashb_in)
 
+    if args.batch:
+        if run_batch(args.batch, jobs=args.jobs) and args.reload:
+            reload_grafana(args.grafana_url, args.grafana_user, args.grafana_password)
+        return
+
     if args.create_map:
         Map.get_map_from_dashboard(Dashb.read_dashb())
         return
@@ -204,7 +746,29 @@ def run():
         Dashb.set_query_freq()
         return
 
-    print(" Need to specificy one of --write-dashb or --read-map. Quitting.")
+    if args.rollups:
+        rollups = Rollups(args.influx_org)
+        rollups.write(args.rollup_dir)
+        if args.influx:
+            influx = Influx(args.influx_url, args.influx_org, args.influx_token)
+            rollups.create(influx)
+            if args.backfill_days:
+                rollups.backfill(influx, args.backfill_days)
+            influx.close()
+        return
+
+    if args.rewrite_queries:
+        Dashb.rewrite_queries()
+        return
+
+    if args.time_queries:
+        influx = Influx(args.influx_url, args.influx_org, args.influx_token)
+        time_queries(Dashb, influx, args.range, repeat=args.repeat, top=args.top)
+        influx.close()
+        return
+
+    print(" Need to specificy one of --write-dashb, --create-map, --fix-datasource, --query-freq, --rollups,"
+          " --rewrite-queries, --time-queries or --batch. Quitting.")
     exit(1)
 
     return
@@ -0,0 +1,61 @@
+# Watching the config files of the Solax PV monitoring client for changes.
+#
+# The files get polled for their modification time, size and inode. That works the same on all
+# platforms and with files bind mounted into a container, where inotify events of the host don't
+# arrive. Only if one of these changed the contents get read and hashed, and only if they differ
+# from what was loaded last the files count as changed. Touching a file or saving it unchanged
+# doesn't trigger a reload.
+
+from hashlib import sha1
+from os import listdir, stat
+from os.path import isdir, join
+
+
+class ConfigWatcher:
+    def __init__(self, paths):
+        # Params:
+        #   :paths:     files to watch. A directory stands for the *.toml files in it, e.g. SITES_DIR
+        self.paths = list(paths)
+        self.stamps = self._stamps()
+        self.digest = self._digest()
+
+    def _files(self):
+        for path in self.paths:
+            if isdir(path):
+                yield from sorted(join(path, f) for f in listdir(path) if f.endswith('.toml'))
+            else:
+                yield path
+
+    def _stamps(self):
+        stamps = {}
+        for f in self._files():
+            try:
+                st = stat(f)
+                stamps[f] = (st.st_mtime_ns, st.st_size, st.st_ino)
+            except FileNotFoundError:
+                stamps[f] = None
+        return stamps
+
+    def _digest(self):
+        h = sha1()
+        for f, stamp in sorted(self.stamps.items()):
+            h.update(f.encode() + b'\0')
+            if stamp is not None:
+                try:
+                    with open(f, 'rb') as fh:
+                        h.update(fh.read())
+                except FileNotFoundError:
+                    pass
+        return h.hexdigest()
+
+    # Whether the contents of the files changed since the last call
+    def changed(self):
+        stamps = self._stamps()
+        if stamps == self.stamps:
+            return False
+        self.stamps = stamps
+        digest = self._digest()
+        if digest == self.digest:
+            return False
+        self.digest = digest
+        return True